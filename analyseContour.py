@@ -1,30 +1,70 @@
 import math
-from classes import Point
+import numpy as np
+from classes import Point, points_to_array
 
 
 class Particle:
+    __slots__ = ('contour', 'center', 'area', 'perimeter', 'radius', 'circularity',
+                 '_radial_average', '_radial_sd', '_radial_sd_consecutive', 'search_id',
+                 'track_id')
+
     def __init__(self, contour):
-        # Ordered list of point objects which constitute the contour of the particle
+        # Nx2 array of the ordered coordinates (x, y) of the points which constitute the contour of the particle
         # No points should be repeated in the contour
-        self.contour = contour
+        self.contour = points_to_array(contour)
         # Point object corresponding to the center in space
-        self.center = get_center(contour)
         # Area of the polygonal approximation of the particle
-        self.area = get_area(contour)
         # Perimeter of the polygonal approximation of the particle
-        self.perimeter = get_perimeter(contour)
         # Radius of the polygonal approximation of the particle, based on a ratio of the area and perimeter
-        self.radius = get_radius(contour)
         # Circularity of the polygonal approximation of the particle
-        self.circularity = get_circularity(contour)
+        # These are all obtained in a single pass over the contour.
+        self.center, self.area, self.perimeter, self.radius, self.circularity = get_contour_metrics(self.contour)
+        # The radial statistics below are rarely used, they are only computed (from the current contour) when asked for
+        self._radial_average = None
+        self._radial_sd = None
+        self._radial_sd_consecutive = None
+        # Index of the search settings with which the particle was found, if known
+        self.search_id = None
+        # Identifier of the track of the particle in a sequence of frames, if known, see tracking.py
+        self.track_id = None
+
+    @property
+    def radial_average(self):
         # Another measure of the radius, based on the average value of the distance between
         # each contour point and the center
-        self.radial_average = get_radial_average(contour)
+        if self._radial_average is None:
+            self._radial_average = get_radial_average(self.contour)
+        return self._radial_average
+
+    @property
+    def radial_sd(self):
         # Standard deviation that accompanies the above radial average
-        self.radial_sd = get_radial_standard_deviation(contour)
+        if self._radial_sd is None:
+            self._radial_sd = get_radial_standard_deviation(self.contour)
+        return self._radial_sd
+
+    @property
+    def radial_sd_consecutive(self):
         # Standard deviation on the radial distance difference between two consecutive contour points.
         # When this value is high, this can indicate that the contour is very 'rough'
-        self.radial_sd_consecutive = get_radial_difference_sd(contour)
+        if self._radial_sd_consecutive is None:
+            self._radial_sd_consecutive = get_radial_difference_sd(self.contour)
+        return self._radial_sd_consecutive
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        # Particles saved by older versions of the program have a list of point objects as contour, and may lack
+        # some of the measures. The missing ones are computed, the saved ones are kept as they are.
+        if isinstance(state, tuple):
+            state = state[1]
+        self.__init__(state['contour'])
+        for key, value in state.items():
+            if key in ('radial_average', 'radial_sd', 'radial_sd_consecutive'):
+                key = '_' + key
+            if key != 'contour':
+                setattr(self, key, value)
 
 
 def get_line_length(a, b):
@@ -39,32 +79,73 @@ def get_triangle_area(a, b, c):
     return area
 
 
+def get_contour_metrics(contour):
+    # --- Method information ---
+    # get_contour_metrics computes, in a single pass, the center, area, perimeter, radius and circularity of a contour.
+    # See get_center, get_area, get_perimeter, get_radius and get_circularity for the details on each of them.
+    #
+    # --- Inputs ---
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
+    #
+    # --- Outputs ---
+    #   center      : Point object
+    #   area        : Float, area of the contour
+    #   perimeter   : Float, perimeter of the contour
+    #   r           : Float, radius of the contour
+    #   c           : Float, circularity of the contour
+
+    contour = points_to_array(contour)
+    n = len(contour)
+    if n == 0:
+        return Point(0, 0), 0, 0, 0, 0
+
+    # Each point is paired with the previous one, the last point being the one before the first
+    x, y = contour[:, 0], contour[:, 1]
+    prev_x, prev_y = np.roll(x, 1), np.roll(y, 1)
+    lengths = np.sqrt((x - prev_x) ** 2 + (y - prev_y) ** 2)
+    perimeter = float(np.sum(lengths))
+
+    # The center is the 'center of mass' of all the contour segments
+    if perimeter != 0:
+        center = Point(float(np.sum(lengths * (x + prev_x) / 2)) / perimeter,
+                       float(np.sum(lengths * (y + prev_y) / 2)) / perimeter)
+    else:
+        center = Point(0, 0)
+
+    # The area is the sum of the areas of the triangles formed by two consecutive points and the center
+    area = float(np.sum(np.abs(x * (prev_y - center.y) + prev_x * (center.y - y) + center.x * (y - prev_y)))) / 2
+
+    if perimeter != 0:
+        r = 2 * area / perimeter
+        # Circular adjustment on the value of r for the number of points in the polygonal approximation
+        # (Comment line below to disable)
+        r = r / math.cos(math.pi / n)
+        c = 4 * math.pi * area / (perimeter ** 2)
+    else:
+        r = 0
+        c = 0
+
+    return center, area, perimeter, r, c
+
+
+def get_radial_distances(contour):
+    # get_radial_distances returns an array of the distances between each contour point and the contour center
+    contour = points_to_array(contour)
+    center = get_center(contour)
+    return np.sqrt((contour[:, 0] - center.x) ** 2 + (contour[:, 1] - center.y) ** 2)
+
+
 def get_center(contour):
     # --- Method information ---
     # get_center finds the center of a polygonal contour, based on the 'center of mass' of all the contour segments
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   center  : Point object
 
-    # There are some precautions to avoid errors and divisions by zero.
-    if len(contour) > 0:
-        moment_0 = Point(0, 0)
-        p = get_perimeter(contour)
-        prev_point = contour[len(contour)-1]
-        for point in contour:
-            moment_0.x += get_line_length(prev_point, point) * (point.x + prev_point.x) / 2
-            moment_0.y += get_line_length(prev_point, point) * (point.y + prev_point.y) / 2
-            prev_point = point
-        if p != 0:
-            center = Point(moment_0.x / p, moment_0.y / p)
-        else:
-            center = Point(0, 0)
-    else:
-        center = Point(0, 0)
-
+    center, _, _, _, _ = get_contour_metrics(contour)
     return center
 
 
@@ -74,21 +155,12 @@ def get_perimeter(contour):
     # the perimeter of the contour
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   perimeter   : Float, perimeter of the contour
 
-    # There are some precautions to avoid errors and divisions by zero.
-    if len(contour) > 0:
-        perimeter = 0
-        prev_point = contour[len(contour) - 1]
-        for point in contour:
-            perimeter += get_line_length(point, prev_point)
-            prev_point = point
-    else:
-        perimeter = 0
-
+    _, _, perimeter, _, _ = get_contour_metrics(contour)
     return perimeter
 
 
@@ -100,22 +172,12 @@ def get_area(contour):
     # is constructed, this condition is always met for this program.
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   area    : Float, area of the contour
 
-    # There are some precautions to avoid errors and divisions by zero.
-    if len(contour) > 0:
-        area = 0
-        center = get_center(contour)
-        prev_point = contour[len(contour) - 1]
-        for point in contour:
-            area += get_triangle_area(point, prev_point, center)
-            prev_point = point
-    else:
-        area = 0
-
+    _, area, _, _, _ = get_contour_metrics(contour)
     return area
 
 
@@ -126,25 +188,12 @@ def get_radius(contour):
     # contour. This is mostly noticeable when the number of points is very low.
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   r   : Float, radius of the contour
 
-    # There are some precautions to avoid errors and divisions by zero.
-    if len(contour) > 0:
-        perimeter = get_perimeter(contour)
-        area = get_area(contour)
-        if perimeter != 0:
-            r = 2 * area / perimeter
-            # Circular adjustment on the value of r for the number of points in the polygonal approximation
-            # (Comment line below to disable)
-            r = r / math.cos(math.pi / len(contour))
-        else:
-            r = 0
-    else:
-        r = 0
-
+    _, _, _, r, _ = get_contour_metrics(contour)
     return r
 
 
@@ -154,24 +203,14 @@ def get_radial_average(contour):
     # thus returns a second approximation for the radius of the particle.
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   r   : Float, radius of the contour
 
     # There are some precautions to avoid errors and divisions by zero.
     if len(contour) > 0:
-        center = get_center(contour)
-        moment_0 = 0
-        moment_1 = 0
-        for point in contour:
-            radius = get_line_length(point, center)
-            moment_0 += 1
-            moment_1 += radius
-        if moment_0 != 0:
-            r = moment_1 / moment_0
-        else:
-            r = 0
+        r = float(np.mean(get_radial_distances(contour)))
     else:
         r = 0
 
@@ -183,26 +222,15 @@ def get_radial_variance(contour):
     # get_radial_variance calculates the variance on the distances between each contour point and the contour center
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   variance: Float, variance on the second evaluation of the radius
 
     # There are some precautions to avoid errors and divisions by zero.
     if len(contour) > 0:
-        center = get_center(contour)
-        average_radius = get_radial_average(contour)
-        moment_0 = 0
-        moment_1 = 0
-        for point in contour:
-            radius = get_line_length(point, center)
-            moment_0 += 1
-            moment_1 += (radius - average_radius) ** 2
-        if moment_0 != 0:
-            variance = moment_1 / moment_0
-        else:
-            variance = 0
-
+        radii = get_radial_distances(contour)
+        variance = float(np.mean((radii - np.mean(radii)) ** 2))
     else:
         variance = 0
 
@@ -221,27 +249,15 @@ def get_radial_difference_variance(contour):
     # between each consecutive contour point
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   variance: Float
 
     # There are some precautions to avoid errors and divisions by zero.
     if len(contour) > 0:
-        center = get_center(contour)
-        prev_radius = get_line_length(contour[len(contour) - 1], center)
-        moment_0 = 0
-        moment_1 = 0
-        for point in contour:
-            radius = get_line_length(point, center)
-            moment_0 += 1
-            moment_1 += (radius - prev_radius) ** 2
-            prev_radius = radius
-        if moment_0 != 0:
-            variance = moment_1 / moment_0
-        else:
-            variance = 0
-
+        radii = get_radial_distances(contour)
+        variance = float(np.mean((radii - np.roll(radii, 1)) ** 2))
     else:
         variance = 0
 
@@ -262,7 +278,7 @@ def get_outliers(contour, r, sd, thresh):
     # It is assumed that these two random variables are normally distributed.
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #   r       : Float, average radius of the particle
     #   sd      : Float, standard deviation on the radius of the particle, or of a set of similar particles
     #   thresh  : Float, threshold value to use for the hypothesis test
@@ -271,33 +287,29 @@ def get_outliers(contour, r, sd, thresh):
     #   outliers: List of the indexes of outlier points
 
     # There are some precautions to avoid errors and divisions by zero.
-    outliers = []
-    i = 0
-    if sd != 0:
-        center = get_center(contour)
-        prev_radius = get_line_length(contour[len(contour) - 1], center)
-        diff_sd = math.sqrt(get_radial_difference_variance(contour))
-        for point in contour:
-            radius = get_line_length(point, center)
-            z1 = (radius - r) / sd
-            z2 = (radius - prev_radius) / diff_sd
-            if abs(z1) > thresh:
-                outliers.append(i)
-            elif abs(z2) > thresh:
-                r1 = radius - r
-                r2 = prev_radius - r
-                if abs(r1) > abs(r2):
-                    outliers.append(i)
-                else:
-                    if i != 0:
-                        outliers.append(i - 1)
-                    else:
-                        outliers.append(len(contour) - 1)
-            i += 1
-            prev_radius = radius
+    if sd == 0 or len(contour) == 0:
+        return []
+
+    n = len(contour)
+    radii = get_radial_distances(contour)
+    prev_radii = np.roll(radii, 1)
+    diff_sd = math.sqrt(float(np.mean((radii - prev_radii) ** 2)))
+    z1 = (radii - r) / sd
+    if diff_sd != 0:
+        z2 = (radii - prev_radii) / diff_sd
+    else:
+        z2 = np.zeros(n)
+
+    # A point far from the average radius is an outlier. Otherwise, a large jump from the previous point makes an
+    # outlier of whichever of the two points is the furthest from the average radius.
+    far = np.abs(z1) > thresh
+    jump = ~far & (np.abs(z2) > thresh)
+    jump_self = jump & (np.abs(radii - r) > np.abs(prev_radii - r))
+    jump_prev = jump & ~jump_self
+    indexes = np.concatenate((np.nonzero(far | jump_self)[0], (np.nonzero(jump_prev)[0] - 1) % n))
 
     # Remove duplicates and reorder list
-    outliers = sorted(list(dict.fromkeys(outliers)))
+    outliers = sorted(set(indexes.tolist()))
 
     return outliers
 
@@ -308,38 +320,106 @@ def get_circularity(contour):
     # contour
     #
     # --- Inputs ---
-    #   contour : Ordered list of point objects corresponding to the closed contour of a polygon
+    #   contour : Nx2 array of the ordered points corresponding to the closed contour of a polygon
     #
     # --- Outputs ---
     #   c   : Float, circularity of the particle
 
-    # There are some precautions to avoid errors and divisions by zero.
-    if len(contour) > 0:
-        perimeter = get_perimeter(contour)
-        area = get_area(contour)
-        if perimeter != 0:
-            c = 4 * math.pi * area / (perimeter ** 2)
-        else:
-            c = 0
-    else:
-        c = 0
-
+    _, _, _, _, c = get_contour_metrics(contour)
     return c
 
 
-def append_particle(particle_list, new_particle, para):
+class ParticleIndex:
+    def __init__(self, cell_size, particles=()):
+        # Side of the square cells of the grid in which the particles are sorted by center, in pixels
+        self.cell_size = max(float(cell_size), 1)
+        # Dictionary of the particles, keyed by a number increasing with each insertion, which keeps them in the order
+        # in which they were inserted, like a list
+        self.particles = {}
+        # Dictionary of the keys of the particles whose center is in a cell, keyed by the (row, column) of the cell
+        self.cells = {}
+        # Largest radius of the particles inserted so far, used to bound the search for overlapping particles
+        self.max_radius = 0
+        self.count = 0
+        for particle in particles:
+            self.insert(particle)
+
+    def __len__(self):
+        return len(self.particles)
+
+    def __iter__(self):
+        return iter(list(self.particles.values()))
+
+    def get_cell(self, x, y):
+        # get_cell returns the (row, column) of the cell containing a location
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, particle):
+        # insert adds a particle to the index and returns its key
+        key = self.count
+        self.count += 1
+        self.particles[key] = particle
+        self.cells.setdefault(self.get_cell(particle.center.x, particle.center.y), {})[key] = particle
+        self.max_radius = max(self.max_radius, particle.radius)
+        return key
+
+    def find(self, particle):
+        # find returns the key of a particle of the index, or None if the particle is not in the index
+        for key, indexed_particle in self.cells.get(self.get_cell(particle.center.x, particle.center.y), {}).items():
+            if indexed_particle is particle:
+                return key
+        return None
+
+    def remove(self, key):
+        # remove takes the particle of a specified key out of the index and returns it
+        particle = self.particles.pop(key)
+        cell = self.get_cell(particle.center.x, particle.center.y)
+        del self.cells[cell][key]
+        if len(self.cells[cell]) == 0:
+            del self.cells[cell]
+        return particle
+
+    def query(self, center, distance):
+        # --- Method information ---
+        # query finds the particles whose center is closer than a specified distance to a location.
+        # Only the cells of the grid overlapping the square around that location are checked.
+        #
+        # --- Inputs ---
+        #   center  : Point object, location around which to look
+        #   distance: Float, maximum distance between the centers
+        #
+        # --- Outputs ---
+        #   keys    : List of the keys of the particles found, in order of insertion
+
+        min_cell = self.get_cell(center.x - distance, center.y - distance)
+        max_cell = self.get_cell(center.x + distance, center.y + distance)
+        keys = []
+        for row in range(min_cell[0], max_cell[0] + 1):
+            for col in range(min_cell[1], max_cell[1] + 1):
+                for key, particle in self.cells.get((row, col), {}).items():
+                    if (particle.center.x - center.x) ** 2 + (particle.center.y - center.y) ** 2 < distance ** 2:
+                        keys.append(key)
+        return sorted(keys)
+
+    def to_list(self):
+        # to_list returns the list of the particles of the index, in order of insertion
+        return list(self.particles.values())
+
+
+def append_particle(particle_list, new_particle, para, evicted=None):
     # --- Method information ---
     # append_particle tries to update the list of particles based on a new particle to be added.
     # If the new particle is good enough to be added, it checks whether it should replace other particles from the list
     # and does so if necessary
     #
     # --- Inputs ---
-    #   particles_list  : List of particle objects to be filled
+    #   particles_list  : List of particle objects to be filled, or ParticleIndex object for faster overlap checks
     #   new_particle    : Particle object to be added to the list
     #   para            : Search object, containing the search settings
+    #   evicted         : List to which the particles removed to add new_particle are appended (optional)
     #
     # --- Outputs ---
-    #   particle_list   : List of particle objects, updated
+    #   particle_list   : List of particle objects or ParticleIndex object, updated
     #   add_particle    : Boolean variable to specify whether the particle was added or not
 
     dist_tol = para.contour_para.dist_tol
@@ -357,6 +437,30 @@ def append_particle(particle_list, new_particle, para):
 
     # Check the new particle does not interfere with any other particles
     # If so, remove interfering particles or specify not to add new particle to list
+    if isinstance(particle_list, ParticleIndex):
+        # Only the particles close enough to possibly interfere are checked
+        if add_particle:
+            search_distance = dist_tol * (new_particle.radius + particle_list.max_radius)
+            for key in particle_list.query(new_particle.center, search_distance):
+                particle = particle_list.particles[key]
+                dist = math.sqrt((particle.center.x - new_particle.center.x) ** 2
+                                 + (particle.center.y - new_particle.center.y) ** 2)
+                if dist < dist_tol*(particle.radius + new_particle.radius):
+                    if new_particle.circularity >= particle.circularity:
+                        flags.append(key)
+                    else:
+                        add_particle = False
+                        break
+
+        if add_particle:
+            for flag in flags:
+                removed = particle_list.remove(flag)
+                if evicted is not None:
+                    evicted.append(removed)
+            particle_list.insert(new_particle)
+
+        return particle_list, add_particle
+
     if len(particle_list) > 0 and add_particle:
         for particle in particle_list:
             dist = math.sqrt((particle.center.x-new_particle.center.x)**2 + (particle.center.y-new_particle.center.y)**2)
@@ -371,6 +475,8 @@ def append_particle(particle_list, new_particle, para):
 
     # If new particle is valid, remove flagged particles from list and/or append the new particle
     if add_particle:
+        if evicted is not None:
+            evicted.extend(particle_list[flag] for flag in flags)
         for flag in reversed(flags):
             particle_list.pop(flag)
         particle_list.append(new_particle)
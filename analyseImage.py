@@ -1,12 +1,19 @@
 import numpy as np
 import cv2
 
-from classes import Point
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from classes import Point, Window
 from constructContour import detect_circle_edge_points, translate_points, scale_points
-from matchObject import create_ellipse, match_template_full
-from analyseContour import Particle, append_particle, get_radial_average, get_radial_standard_deviation, get_outliers
-from optimisation import find_local_maxima
-from skimage.feature import match_template
+from kernels import get_kernel
+from matchObject import template_bank, match_template_full, match_template_pyramid, get_pyramid_levels
+from matchObject import CorrelationEngine, find_circles_hough
+from analyseContour import Particle, ParticleIndex, append_particle, get_outliers
+from analyseContour import get_radial_average, get_radial_standard_deviation
+from optimisation import find_peaks
+from stream import get_events
+from tracing import tracer, bind_tags
 
 
 def resize_image(image, scale_factor):
@@ -85,6 +92,28 @@ def adjust_colors(image, weights):
     return result
 
 
+def normalize_to_uint8(values):
+    # --- Method information ---
+    # normalize_to_uint8 normalizes each column of an array as normalize_image() does, then scales it to [0, 255] and
+    # rounds it to 8-bit integers
+    #
+    # --- Inputs ---
+    #   values  : Numpy array of size N x M, each of the M columns being normalized separately
+    #
+    # --- Outputs ---
+    #   result  : Numpy array of size N x M and type uint8
+
+    min_values = np.amin(values, axis=0)
+    max_values = np.amax(values, axis=0)
+    # As in normalize_image, a column of constant values is left as it is
+    ranges = np.where(max_values != min_values, max_values - min_values, 1)
+    min_values = np.where(max_values != min_values, min_values, 0)
+    result = (values - min_values) * (255 / ranges)
+    np.rint(result, out=result)
+    np.clip(result, 0, 255, out=result)
+    return result.astype(np.uint8)
+
+
 def compose_colors(image, composition):
     # --- Method information ---
     # compose_colors returns a 1D image where each pixel is a linear composition of the colors of this pixel
@@ -94,43 +123,37 @@ def compose_colors(image, composition):
     #   composition : 3x1 list of floats
     #
     # --- Outputs ---
-    #   result  : Numpy array, processed image with each pixel being assigned only one value
-
-    img_copy = image.copy()
-    dim = np.shape(img_copy)
-    result = np.zeros((dim[0], dim[1]))
-    for i in range(0, len(composition)):
-        result[:, :] += img_copy[:, :, i] * composition[i]
-
-    result = 255 * normalize_image(result)
-    # For now, creation of an image to provide a path for Canny method
-    cv2.imwrite('write.jpg', result)
-    result = cv2.imread('write.jpg', 0)
-    return result
+    #   result  : Numpy array of type uint8, processed image with each pixel being assigned only one value, normalized
+    #             between 0 and 255
+
+    dim = np.shape(image)
+    pixels = image.reshape(-1, dim[2]).astype(np.float64)
+    result = pixels @ np.asarray(composition, dtype=np.float64).reshape(-1, 1)
+    result = normalize_to_uint8(result)
+    return result.reshape(dim[0], dim[1])
 
 
 def get_dominant_color(image):
     # This method is not used in the program
 
     # This method will return an image where each pixel will be only of its dominant color
-    img_dim = image.shape
-    result = np.zeros((img_dim[0], img_dim[1]))
-    rgb = [0, 0, 0]
-    for i in range(0, img_dim[0]):
-        for j in range(0, img_dim[1]):
-            maximum = 0
-            for k in range(0, img_dim[2]):
-                if image[i, j, k] > maximum:
-                    maximum = image[i, j, k]
-                    result[i, j] = k
-
-            for n in range(0, img_dim[2]):
-                if result[i, j] == n:
-                    rgb[n] += 1
-
+    kernel = get_kernel('dominant_color')
+    if kernel is not None:
+        result, counts = kernel(image)
+        return result, counts.tolist()
+    # The first of the highest values of each pixel, or 0 if all of them are 0
+    maximum = np.max(image, axis=2)
+    result = np.where(maximum > 0, np.argmax(image, axis=2), 0).astype(np.float64)
+    rgb = np.bincount(result.astype(int).ravel(), minlength=image.shape[2]).tolist()
     return result, rgb
 
 
+# Compositions of the red, green and blue components giving the R - G, R - B and G - B differences, one per column
+COLOR_DIFFERENCES = np.array([[1, 1, 0],
+                              [-1, 0, 1],
+                              [0, -1, -1]], dtype=np.float32)
+
+
 def get_color_differences(image, weights):
     # --- Method information ---
     # get_color_differences returns a 1D image where the values are a weighted sum of the color differences
@@ -140,14 +163,15 @@ def get_color_differences(image, weights):
     #   weights : 3x1 list of floats
     #
     # --- Outputs ---
-    #   result  : Numpy array, processed image with each pixel being assigned only one value
+    #   result  : Numpy array of type uint8, processed image with each pixel being assigned only one value
 
-    diff_rg = compose_colors(image, (1, -1, 0))
-    diff_rb = compose_colors(image, (1, 0, -1))
-    diff_bg = compose_colors(image, (0, 1, -1))
-    difference = cv2.merge([diff_rg, diff_rb, diff_bg])
-    result = compose_colors(difference, weights)
-    return result
+    # All three differences are obtained by a single matrix product, then each one is normalized to 8-bit values
+    dim = np.shape(image)
+    pixels = image.reshape(-1, 3).astype(np.float32)
+    difference = normalize_to_uint8(pixels @ COLOR_DIFFERENCES)
+    # The weighted sum of the normalized differences is normalized in turn
+    result = normalize_to_uint8(difference @ np.asarray(weights, dtype=np.float32).reshape(-1, 1))
+    return result.reshape(dim[0], dim[1])
 
 
 def get_edges(image, gauss, thresh1, thresh2):
@@ -163,13 +187,14 @@ def get_edges(image, gauss, thresh1, thresh2):
     # --- Outputs ---
     #   edges   : Numpy array of the size of the original image, filled with 0s and 1s, where 1 is an edge
 
-    # Apply small Gaussian blur to reduce noise
-    image_blur = cv2.GaussianBlur(image, (gauss, gauss), 0, 0)
-    # Use canny method for edge detection
-    edges = cv2.Canny(image_blur, thresh1, thresh2)
-    # Normalize values of the image for later treatment
-    # Edge pixels should have a value of 1, non-edge pixels should have value 0
-    edges = normalize_image(edges)
+    with tracer.span('get_edges', gauss=gauss):
+        # Apply small Gaussian blur to reduce noise
+        image_blur = cv2.GaussianBlur(image, (gauss, gauss), 0, 0)
+        # Use canny method for edge detection
+        edges = cv2.Canny(image_blur, thresh1, thresh2)
+        # Normalize values of the image for later treatment
+        # Edge pixels should have a value of 1, non-edge pixels should have value 0
+        edges = normalize_image(edges)
     return edges
 
 
@@ -185,7 +210,7 @@ def obtain_picture(image, center, radius, factor):
     #   factor  : Float, factor by which to scale the size of the returned picture, if possible
     #
     # --- Outputs ---
-    #   grid            : Numpy array of the returned picture
+    #   grid            : Numpy array, read-only view of the returned picture in the image
     #   circle_center   : Point object, location of the center of the circle in the returned picture
     #   corner          : Point object, location of the top left corner of the returned picture in the image
 
@@ -198,44 +223,121 @@ def obtain_picture(image, center, radius, factor):
     max_x = int(min(max(0, center.x + grid_half_size), image_size[0]))
     min_y = int(min(max(0, center.y - grid_half_size), image_size[1]))
     max_y = int(min(max(0, center.y + grid_half_size), image_size[1]))
+    window = Window(image, min_x, max_x, min_y, max_y)
     # Translate the location of the center of the circle to account for above correction
     circle_center = Point(center.x - min_x, center.y - min_y)
     # Get top left corner for translation purposes
-    corner = Point(min_x, min_y)
+    corner = window.corner
 
-    image_copy = image.copy()
-    grid = image_copy[min_x:max_x, min_y:max_y]
+    # The picture is a read-only view of the image, none of the candidates copies the image
+    grid = window.view()
 
     return grid, circle_center, corner
 
 
-def preprocess(image_rgb, para):
+class ImageCache:
+    def __init__(self, image_rgb):
+        # RGB image from which all the artifacts are computed
+        self.image_rgb = image_rgb
+        # Dictionary of the artifacts computed so far, keyed by the name of the artifact and the parameters used
+        self.artifacts = {}
+
+    def get_artifact(self, key, compute):
+        # get_artifact returns the artifact stored under key, computing it with the compute function if it is missing
+        if key not in self.artifacts:
+            self.artifacts[key] = compute()
+        return self.artifacts[key]
+
+    def get_array(self, key):
+        # get_array returns the image stored under key, rescaled images being stored along with their scale factor
+        if key[0] == 'rescaled':
+            return self.artifacts[key][0]
+        return self.artifacts[key]
+
+    def get_image(self, use_color_differences, weights=None):
+        # --- Method information ---
+        # get_image returns the full scale 1D image, either grayscale or a weighted sum of the color differences
+        #
+        # --- Inputs ---
+        #   use_color_differences   : Boolean variable, whether to use the color differences or the grayscale image
+        #   weights                 : 3x1 list of floats, weights of the color differences
+        #
+        # --- Outputs ---
+        #   key     : Tuple, key of the returned image in the cache
+        #   image   : Numpy array, 1D image
+
+        if use_color_differences:
+            key = ('colors', tuple(float(w) for w in weights))
+            image = self.get_artifact(key, lambda: get_color_differences(self.image_rgb, weights))
+        else:
+            key = ('gray',)
+            image = self.get_artifact(key, lambda: cv2.cvtColor(self.image_rgb, cv2.COLOR_RGB2GRAY))
+        return key, image
+
+    def get_rescaled(self, image_key, max_dim):
+        # --- Method information ---
+        # get_rescaled returns a rescaled version of a cached image. The color differences are computed directly from
+        # the rescaled RGB image rather than rescaled from the full scale color differences.
+        #
+        # --- Inputs ---
+        #   image_key   : Tuple, key of the full scale image in the cache
+        #   max_dim     : Integer, maximum dimension allowable
+        #
+        # --- Outputs ---
+        #   key         : Tuple, key of the rescaled image in the cache
+        #   img         : Numpy array, rescaled image
+        #   scale_factor: Float, factor by which img is scaled
+
+        key = ('rescaled', image_key, max_dim)
+        if image_key[0] == 'colors':
+            def compute():
+                image_rgb, scale = self.get_artifact(('rescaled', ('rgb',), max_dim),
+                                                     lambda: rescale_image(self.image_rgb, max_dim))
+                return get_color_differences(image_rgb, image_key[1]), scale
+        else:
+            def compute():
+                return rescale_image(self.get_array(image_key), max_dim)
+        img, scale_factor = self.get_artifact(key, compute)
+        return key, img, scale_factor
+
+    def get_edges(self, image_key, gauss, thresh1, thresh2):
+        # get_edges returns the key of the edges map of a cached image and the edges map, see get_edges()
+        key = ('edges', image_key, gauss, thresh1, thresh2)
+        edges = self.get_artifact(key, lambda: get_edges(self.get_array(image_key), gauss, thresh1, thresh2))
+        return key, edges
+
+    def get_engine(self, image_key):
+        # get_engine returns the CorrelationEngine object of a cached image, which keeps its spectrum
+        return self.get_artifact(('engine', image_key), lambda: CorrelationEngine(self.get_array(image_key)))
+
+
+def preprocess(image_rgb, para, cache=None):
     # --- Method information ---
     # preprocess processes the RGB image according to specified search settings
     #
     # --- Inputs ---
     #   image_rgb   : Numpy array, RGB image to be preprocessed
     #   para        : Search object
+    #   cache       : ImageCache object of image_rgb, to reuse the images already computed (optional)
     #
     # --- Outputs ---
     #   image           : Numpy array of the returned picture
     #   img             : Numpy array of the rescaled returned picture
     #   scale_factor    : Float, factor by which img is scaled
 
-    # Obtain the color differences if specified in function
-    if para.use_color_differences:
-        # Downscale image if necessary, to improve computation time.
-        image = get_color_differences(image_rgb, para.color_weights)
-        img, scale_factor = rescale_image(image, para.match_para.max_dim)
-    else:
-        # Convert to grayscale and downscale image if necessary, to improve computation time.
-        image = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
-        img, scale_factor = rescale_image(image, para.match_para.max_dim)
+    if cache is None:
+        cache = ImageCache(image_rgb)
+
+    # Obtain the color differences if specified in function, or convert to grayscale.
+    # Downscale image if necessary, to improve computation time.
+    image_key, image = cache.get_image(para.use_color_differences, para.color_weights)
+    _, img, scale_factor = cache.get_rescaled(image_key, para.match_para.max_dim)
 
     return image, img, scale_factor
 
 
-def find_matches(image, img, edg, scale_factor, particles_list, para, use_found_particle):
+def find_matches(image, img, edg, scale_factor, particles_list, para, use_found_particle, img_engine=None,
+                 edg_engine=None):
     # --- Method information ---
     # find_matches finds all the points of the image that possibly correspond to the center of a particle
     #
@@ -244,12 +346,14 @@ def find_matches(image, img, edg, scale_factor, particles_list, para, use_found_
     #   img                 : Numpy array, rescaled image
     #   edg                 : Numpy array, edges map of the rescaled image
     #   scale_factor        : Float, factor by which img is scaled
-    #   particles_list      : List of particle objects that have previously been found during the search
+    #   particles_list      : List of particle objects (or ParticleIndex object) previously found during the search
     #   para                : Search object containing the search settings
     #   use_found_particle  : Specify whether to use a previously found particle for the matching method
+    #   img_engine          : CorrelationEngine object of img, to reuse between calls (optional)
+    #   edg_engine          : CorrelationEngine object of edg, to reuse between calls (optional)
     #
     # --- Outputs ---
-    #   maxima  : List of point objects corresponding to potential matches
+    #   maxima  : Nx2 array of the points corresponding to potential matches, best first
 
     # Set search parameters in sorter variables for convenience
     radius = para.searched_radius
@@ -260,87 +364,292 @@ def find_matches(image, img, edg, scale_factor, particles_list, para, use_found_
         # NOTE : A potential change would be to choose a random particle from the list, as to ensure some
         # variability in the searches. This could help to find particles that are too different from the 'best',
         # but would remove the repeatability of the algorythm.
-        best_circularity = 0
-        for particle in particles_list:
-            if particle.circularity > best_circularity:
-                picture, circle_center, picture_corner = obtain_picture(image, particle.center, particle.radius, factor)
-                picture = resize_image(picture, scale_factor)
-                best_circularity = particle.circularity
+        best_particle = max(particles_list, key=lambda particle: particle.circularity)
+        picture, _, _ = obtain_picture(image, best_particle.center, best_particle.radius, factor)
+        picture = resize_image(picture, scale_factor)
         # Use the best particle in the image as a mask for finding the other ones
         object_mask = picture
         threshold = 0.4
         # Compare actual image (scaled down) to object mask
-        matches = match_template_full(img, object_mask)
+        search_image, engine = img, img_engine
+        use_hough = False
+
+        def get_mask(level):
+            return resize_image(picture, 0.5 ** level), threshold
 
     else:
         diameter = int(2 * radius * scale_factor)
-        # Create circle mask for comparison
-        mask_size = (round(factor * diameter), round(factor * diameter))
-        circle_size = (diameter, diameter)
-        object_mask = create_ellipse(mask_size, circle_size, para.match_para.sharpness)
-        # Get threshold comparison with near perfect circle
-        perfect_circle = create_ellipse(mask_size, circle_size, 1)
-        threshold = match_template(perfect_circle, object_mask)
-        # Compare edges map to circle template
-        matches = match_template_full(edg, object_mask)
-
-    # Use an optimisation method to find significant maxima in the downscaled image and rescale those points
-    maxima = find_local_maxima(matches, 10, para.match_para.tolerance * threshold)
+
+        def get_mask(level):
+            # Create circle mask for comparison, at the scale of a level of the pyramid
+            level_diameter = round(diameter * 0.5 ** level)
+            mask_size = (round(factor * level_diameter), round(factor * level_diameter))
+            circle_size = (level_diameter, level_diameter)
+            # The threshold is obtained by comparison with a near perfect circle
+            return template_bank.get_template(mask_size, circle_size, para.match_para.sharpness)
+        object_mask, threshold = get_mask(0)
+        # Compare edges map to circle template, or look for circles in the edges map with the Hough transform
+        search_image, engine = edg, edg_engine
+        use_hough = para.match_para.backend == 'hough'
+
+    # Maxima closer than a fraction of the searched radius are suppressed, the best ones come first.
+    min_distance = max(1, round(para.match_para.peak_distance * radius * scale_factor))
+    nb_levels = 0
+    if para.match_para.use_pyramid:
+        nb_levels = get_pyramid_levels(min(np.shape(object_mask)), para.match_para.pyramid_size)
+    if use_hough:
+        # The direction of the gradient is taken from the image the edges map was obtained from
+        gauss = para.edges_para.gauss_2
+        with tracer.span('hough'):
+            rows, cols, _ = find_circles_hough(edg, cv2.GaussianBlur(img, (gauss, gauss), 0, 0),
+                                               radius * scale_factor, para.match_para.hough_radius_tol, min_distance,
+                                               para.match_para.hough_threshold, para.match_para.max_peaks)
+    elif nb_levels > 0:
+        # Search coarse-to-fine, the correlation is only computed for the whole image at the coarsest level
+        if engine is None:
+            engine = CorrelationEngine(search_image)
+        with tracer.span('pyramid', levels=nb_levels):
+            rows, cols, _ = match_template_pyramid(engine, get_mask, nb_levels, min_distance,
+                                                   para.match_para.tolerance * threshold,
+                                                   para.match_para.pyramid_tolerance * para.match_para.tolerance,
+                                                   para.match_para.max_peaks)
+    else:
+        with tracer.span('correlation'):
+            matches = match_template_full(search_image, object_mask, engine)
+        # Use an optimisation method to find significant maxima in the downscaled image
+        with tracer.span('peaks'):
+            rows, cols, _ = find_peaks(matches, min_distance, para.match_para.tolerance * threshold,
+                                       para.match_para.max_peaks)
+    # Rescale the maxima to the full scale image
+    maxima = np.column_stack((rows, cols))
     maxima = scale_points(maxima, Point(1 / scale_factor, 1 / scale_factor), do_round=True)
 
     return maxima
 
 
-def remove_outliers(particle, thresh):
+def find_outliers(particle, thresh):
+    # --- Method information ---
+    # find_outliers finds the outlier points of a particle's contour based on statistical analysis
+    #
+    # --- Inputs ---
+    #   particle    : Particle object
+    #   thresh      : Float, value to specify the threshold for which a value is considered an outlier
+    #
+    # --- Outputs ---
+    #   outliers    : List of the indexes of outlier points, in increasing order
+
+    with tracer.span('outliers'):
+        r = get_radial_average(particle.contour)
+        sd = get_radial_standard_deviation(particle.contour)
+        outliers = get_outliers(particle.contour, r, sd, thresh=thresh)
+    return outliers
+
+
+def remove_outliers(particle, thresh, outliers=None):
     # --- Method information ---
     # remove_outliers removes the outlier points of a particle's contour based on statistical analysis
     #
     # --- Inputs ---
     #   particle    : Particle object
     #   thresh      : Float, value to specify the threshold for which a value is considered an outlier
+    #   outliers    : List of the indexes of outlier points, if already obtained from find_outliers (optional)
     #
     # --- Outputs ---
     #   particle    : Particle object with refined contour
 
-    r = get_radial_average(particle.contour)
-    sd = get_radial_standard_deviation(particle.contour)
-    outliers = get_outliers(particle.contour, r, sd, thresh=thresh)
-    for index in reversed(outliers):
-        particle.contour.pop(index)
+    if outliers is None:
+        outliers = find_outliers(particle, thresh)
+    if len(outliers) > 0:
+        particle.contour = np.delete(particle.contour, outliers, axis=0)
     return particle
 
 
-def analyse(image_rgb, particles_list, para):
+def build_candidate(picture, circle_center, corner, radius, para):
     # --- Method information ---
-    # analyse attempts to find all the particles of a given size in an image, according to the search parameters
-    # entered. The list of particles for this image is then updated with the new particles
+    # build_candidate constructs the contour of what could be a particle in a picture, and evaluates it.
+    # The candidates are independent of each other, thus this method can run in a worker thread or process.
+    #
+    # --- Inputs ---
+    #   picture         : Numpy array, picture of the edges map obtained from obtain_picture()
+    #   circle_center   : Point object, location of the expected center in the picture
+    #   corner          : Point object, location of the top left corner of the picture in the image
+    #   radius          : Float, expected radius of the particle
+    #   para            : Search object, containing the search settings
+    #
+    # --- Outputs ---
+    #   particle    : Particle object, candidate particle in the image
+    #   outliers    : List of the indexes of the outlier points of the contour of the particle
+
+    # From the location of the maximum found, create an ordered list of point objects corresponding to a
+    # potential contour of what could be a particle centered on this location
+    with tracer.span('contour'):
+        contour, _ = detect_circle_edge_points(picture, circle_center, radius, para)
+        contour = translate_points(contour, corner)
+        particle = Particle(contour)
+    outliers = find_outliers(particle, thresh=2.5)
+    return particle, outliers
+
+
+def build_candidate_traced(*args):
+    # build_candidate_traced runs build_candidate() in a worker process, and returns the candidate along with the spans
+    # recorded by the worker for it, to be added to the trace of the main process
+    return build_candidate(*args), tracer.take_events()
+
+
+def init_contour_worker(do_trace):
+    # init_contour_worker enables the tracer of a worker process building the candidates if the tracer of the main
+    # process is enabled, without the spans it may have inherited from the main process
+    tracer.reset()
+    if do_trace:
+        tracer.enable()
+
+
+def get_candidate(future, use_processes):
+    # get_candidate waits for a candidate built by a worker, the spans recorded by a worker process being added to the
+    # trace
+    if not use_processes:
+        return future.result()
+    candidate, events = future.result()
+    tracer.add_events(events)
+    return candidate
+
+
+def build_candidates(tasks, radius, factor, para, executor=None):
+    # --- Method information ---
+    # build_candidates is a generator of the candidates built from a sequence of (maximum, edges map) tasks.
+    # The candidates are yielded in the order of the tasks, whether they are built in the calling thread or by the
+    # workers of an executor. With an executor, only a limited number of tasks are in progress at the same time.
+    #
+    # --- Inputs ---
+    #   tasks       : Iterable of (Point object, Numpy array) tuples, location of the maximum and edges map to use
+    #   radius      : Float, expected radius of the particles
+    #   factor      : Float, factor by which to scale the size of the pictures
+    #   para        : Search object, containing the search settings
+    #   executor    : Executor object used to build the candidates concurrently (optional)
+    #
+    # --- Outputs ---
+    #   Yields the (particle, outliers) tuples returned by build_candidate()
+
+    if executor is None:
+        for maximum, use_edges in tasks:
+            picture, circle_center, corner = obtain_picture(use_edges, maximum, radius, factor)
+            yield build_candidate(picture, circle_center, corner, radius, para)
+        return
+
+    # The spans recorded by worker processes are sent back with the candidates, see build_candidate_traced()
+    use_processes = para.contour_para.use_processes
+    function = build_candidate_traced if use_processes else build_candidate
+    pending = deque()
+    max_pending = 4 * para.contour_para.workers
+    for maximum, use_edges in tasks:
+        picture, circle_center, corner = obtain_picture(use_edges, maximum, radius, factor)
+        # The spans recorded by the workers are tagged as the current search
+        pending.append(executor.submit(bind_tags(function), picture, circle_center, corner, radius, para))
+        if len(pending) >= max_pending:
+            yield get_candidate(pending.popleft(), use_processes)
+    while len(pending) > 0:
+        yield get_candidate(pending.popleft(), use_processes)
+
+
+def analyse_stream(image_rgb, particles_list, para, cache=None, verbose=True):
+    # --- Method information ---
+    # analyse_stream attempts to find all the particles of a given size in an image, according to the search parameters
+    # entered. It is a generator of the changes made to the particles found as the candidates are resolved, such that
+    # they can be used before the end of the search. Once the generator is exhausted, the list of particles for this
+    # image is updated with the new particles
     #
     # --- Inputs ---
     #   image_rgb       : Numpy array, RGB image in which to find the particles
     #   particles_list  : List of particle objects to be filled, must only contain particles of the image processed
     #   para            : Search object, containing the search settings
+    #   cache           : ImageCache object of image_rgb, shared by all the searches on this image so that every
+    #                     intermediate image is only computed once (optional)
+    #   verbose         : Boolean variable to specify whether to inform the user in the terminal
     #
     # --- Outputs ---
-    #   particles_list  : List of found particle objects
+    #   Yields ParticleEvent objects, see get_events()
 
     # Set search parameters in sorter variables for convenience
     radius = para.searched_radius
-    factor = para.match_para.factor
-    n = para.iterations + 1
 
     # Print to terminal
-    print(f'Pre-processing image')
-    # Convert image to usable format
-    image, img, scale_factor = preprocess(image_rgb, para)
+    if verbose:
+        print(f'Pre-processing image')
+    # Convert image to usable format.
+    # Every intermediate image is kept in the cache, and shared with the other searches with the same settings.
+    if cache is None:
+        cache = ImageCache(image_rgb)
+    edges_para = para.edges_para
+    with tracer.span('preprocess'):
+        image_key, image = cache.get_image(para.use_color_differences, para.color_weights)
+        img_key, img, scale_factor = cache.get_rescaled(image_key, para.match_para.max_dim)
+        image_max_key, _ = cache.get_image(False)
 
     # Obtain edges map at full scale and rescaled
-    edges = get_edges(image, para.edges_para.gauss_1, para.edges_para.thresh1_1, para.edges_para.thresh2_1)
-    edg = get_edges(img, para.edges_para.gauss_2, para.edges_para.thresh1_2, para.edges_para.thresh2_2)
+    _, edges = cache.get_edges(image_key, edges_para.gauss_1, edges_para.thresh1_1, edges_para.thresh2_1)
+    edg_key, edg = cache.get_edges(img_key, edges_para.gauss_2, edges_para.thresh1_2, edges_para.thresh2_2)
     # Also obtain an edges map with as much information as possible
     # This is relevant when the use_color_differences option is set to true : edges_max is produced without using
     # this parameter, thus conserving more detail. This helps when constructing the contours.
-    image_max = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
-    edges_max = get_edges(image_max, para.edges_para.gauss_1, para.edges_para.thresh1_1, para.edges_para.thresh2_1)
+    # Without color differences, this is the same map as edges and the cache returns it as is.
+    _, edges_max = cache.get_edges(image_max_key, edges_para.gauss_1, edges_para.thresh1_1, edges_para.thresh2_1)
+
+    # Correlation engines keep the spectra of img and edg for all the iterations, and for the other searches
+    img_engine = cache.get_engine(img_key)
+    edg_engine = cache.get_engine(edg_key)
+
+    # Keep the particles in a spatial index, so that a new particle is only compared to its neighbours
+    particles = ParticleIndex(2 * para.contour_para.dist_tol * radius, particles_list)
+
+    # Workers used to build the candidate contours, if specified
+    executor = None
+    if para.contour_para.workers > 1:
+        if para.contour_para.use_processes:
+            # The multiprocessing modules are only imported when processes are used, to shorten the startup time
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=para.contour_para.workers, initializer=init_contour_worker,
+                                           initargs=(tracer.enabled,))
+        else:
+            executor = ThreadPoolExecutor(max_workers=para.contour_para.workers)
+    try:
+        yield from search_iterations(image, img, edg, edges, edges_max, scale_factor, particles, para, img_engine,
+                                     edg_engine, executor, verbose)
+    finally:
+        # Also reached when the consumer of the events stops early
+        if executor is not None:
+            executor.shutdown()
+
+    # Fill the list of particles, in the order in which they were accepted
+    particles_list[:] = particles.to_list()
+
+
+def search_iterations(image, img, edg, edges, edges_max, scale_factor, particles, para, img_engine, edg_engine,
+                      executor, verbose):
+    # --- Method information ---
+    # search_iterations proceeds to the preliminary search and the iterations of the search specified, see
+    # analyse_stream(), and updates the particles found
+    #
+    # --- Inputs ---
+    #   image           : Numpy array, full scale 1D image
+    #   img             : Numpy array, rescaled image
+    #   edg             : Numpy array, edges map of the rescaled image
+    #   edges           : Numpy array, edges map of the full scale image
+    #   edges_max       : Numpy array, edges map of the full scale grayscale image
+    #   scale_factor    : Float, factor by which img is scaled
+    #   particles       : ParticleIndex object of the particles found
+    #   para            : Search object, containing the search settings
+    #   img_engine      : CorrelationEngine object of img
+    #   edg_engine      : CorrelationEngine object of edg
+    #   executor        : Executor object used to build the candidates concurrently, or None
+    #   verbose         : Boolean variable to specify whether to inform the user in the terminal
+    #
+    # --- Outputs ---
+    #   Yields ParticleEvent objects, see get_events()
+
+    # Set search parameters in sorter variables for convenience
+    radius = para.searched_radius
+    factor = para.match_para.factor
+    n = para.iterations + 1
 
     # Proceed to n searches. This corresponds to a preliminary search using only the edges maps for object
     # detection, then the amount of iterations specified for the complete search.
@@ -352,52 +661,95 @@ def analyse(image_rgb, particles_list, para):
     for i in range(0, n):
         if i == 0:
             # Set the condition for the preliminary search and inform the user in the terminal
-            print('Proceeding with preliminary search')
-            print('...')
+            if verbose:
+                print('Proceeding with preliminary search')
+                print('...')
             use_found_particle = False
         else:
             # Set the conditions for the latter searches and inform the user in the terminal
-            if len(particles_list) == 0:
+            if len(particles) == 0:
                 # In this case, the function will not find any more particles
                 break
             else:
-                print(f'Proceeding with iteration {i} out of {n-1}')
-                print('...')
+                if verbose:
+                    print(f'Proceeding with iteration {i} out of {n-1}')
+                    print('...')
                 use_found_particle = True
 
-        # Find points potentially corresponding to the centers of particles
-        # These points correspond to local maxima from an optimisation standpoint
-        maxima = find_matches(image, img, edg, scale_factor, particles_list, para, use_found_particle)
-
-        # Loop through every maximum detected and construct the contour of a disc of the specified radius
-        for maximum in maxima:
-            # Provide the option to proceed twice, in the case where use_color_differences is set to True.
-            for j in range(0, 2):
-                if j == 0:
-                    use_edges = edges
-                else:
-                    use_edges = edges_max
-                    # This step is redundant if color differences are not used
-                    if not para.use_color_differences:
-                        break
-
-                # From the location of the maximum found, create an ordered list of point objects corresponding to a
-                # potential contour of what could be a particle centered on this location
-                picture, circle_center, corner = obtain_picture(use_edges, maximum, radius, factor)
-                contour, _ = detect_circle_edge_points(picture, circle_center, radius, para)
-                contour = translate_points(contour, corner)
-
+        with tracer.tags(iteration=i):
+            # Find points potentially corresponding to the centers of particles
+            # These points correspond to local maxima from an optimisation standpoint
+            maxima = find_matches(image, img, edg, scale_factor, particles, para, use_found_particle,
+                                  img_engine, edg_engine)
+
+        # Loop through every maximum detected and construct the contour of a disc of the specified radius.
+        # Provide the option to proceed twice, in the case where use_color_differences is set to True.
+        # The second step is redundant if color differences are not used.
+        if para.use_color_differences:
+            edges_list = [edges, edges_max]
+        else:
+            edges_list = [edges]
+        tasks = ((Point(int(maximum[0]), int(maximum[1])), use_edges)
+                 for maximum in maxima for use_edges in edges_list)
+
+        # The candidates may be built concurrently, but they are merged in the order of the maxima, best first,
+        # so that the particles found do not depend on the number of workers.
+        # The tags of the iteration are entered for every step, rather than around the loop, such that they are not
+        # held while the consumer of the events runs.
+        candidates = build_candidates(tasks, radius, factor, para, executor)
+        while True:
+            with tracer.tags(iteration=i):
+                candidate = next(candidates, None)
+                if candidate is None:
+                    break
+                particle, outliers = candidate
                 # Append particle to list if valid
-                particle = Particle(contour)
-                particles_list, added_particle = append_particle(particles_list, particle, para)
-                if added_particle:
+                evicted = []
+                with tracer.span('merge'):
+                    particles, added_particle = append_particle(particles, particle, para, evicted)
+            if added_particle:
+                if verbose:
                     print(f'Found a particle with c={particle.circularity} and N={len(particle.contour)}')
-
-                # Attempt to refine the contour
-                particle = remove_outliers(particle, thresh=2.5)
-                particles_list, adjusted_particle = append_particle(particles_list, particle, para)
-                if adjusted_particle:
+                yield from get_events(particle, evicted, i)
+
+            # Attempt to refine the contour of an accepted particle. A rejected particle would be rejected again,
+            # its measures being kept. The particle is taken out of the index before being merged again, so that
+            # it does not replace itself.
+            if not added_particle or len(outliers) == 0:
+                continue
+            with tracer.tags(iteration=i):
+                particles.remove(particles.find(particle))
+                with tracer.span('outliers_remove'):
+                    particle = remove_outliers(particle, thresh=2.5, outliers=outliers)
+                evicted = []
+                with tracer.span('merge'):
+                    particles, adjusted_particle = append_particle(particles, particle, para, evicted)
+                if not adjusted_particle:
+                    # The refined contour has too few points, the particle is kept as it was accepted
+                    particles.insert(particle)
+            if adjusted_particle:
+                if verbose:
                     print(f'Adjusted particle with c={particle.circularity} and N={len(particle.contour)}')
+                yield from get_events(particle, evicted, i, adjusted=True)
+
+
+def analyse(image_rgb, particles_list, para, cache=None, verbose=True):
+    # --- Method information ---
+    # analyse attempts to find all the particles of a given size in an image, according to the search parameters
+    # entered. The list of particles for this image is then updated with the new particles
+    #
+    # --- Inputs ---
+    #   image_rgb       : Numpy array, RGB image in which to find the particles
+    #   particles_list  : List of particle objects to be filled, must only contain particles of the image processed
+    #   para            : Search object, containing the search settings
+    #   cache           : ImageCache object of image_rgb, see analyse_stream() (optional)
+    #   verbose         : Boolean variable to specify whether to inform the user in the terminal
+    #
+    # --- Outputs ---
+    #   particles_list  : List of found particle objects
+
+    for _ in analyse_stream(image_rgb, particles_list, para, cache, verbose):
+        pass
 
     return particles_list
 
@@ -0,0 +1,212 @@
+import copy
+import math
+import numpy as np
+import cv2
+
+from analyseContour import Particle, ParticleIndex, append_particle
+from analyseImage import analyse, ImageCache
+from constructContour import translate_points
+from classes import Point
+from tracing import tracer
+
+
+def open_image_source(image_src):
+    # --- Method information ---
+    # open_image_source gives access to the pixels of an image without necessarily loading it in memory.
+    # A .npy file (RGB array of size H x W x 3, or grayscale array of size H x W) is memory-mapped, so that only the
+    # tiles being processed are read from the disk. Other formats are decoded by OpenCV as a whole.
+    #
+    # --- Inputs ---
+    #   image_src   : Source of the image file
+    #
+    # --- Outputs ---
+    #   source  : Numpy array (possibly memory-mapped), RGB or grayscale image
+
+    if image_src.lower().endswith('.npy'):
+        return np.load(image_src, mmap_mode='r')
+
+    image_bgr = cv2.imread(image_src)
+    if image_bgr is None:
+        raise FileNotFoundError(f'Could not read image "{image_src}"')
+    return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+
+def save_image_source(image_src, npy_src):
+    # --- Method information ---
+    # save_image_source converts an image file to a .npy file that can be memory-mapped by open_image_source()
+    #
+    # --- Inputs ---
+    #   image_src   : Source of the image file
+    #   npy_src     : Source of the .npy file to write
+
+    np.save(npy_src, open_image_source(image_src))
+
+
+def read_tile(source, box):
+    # --- Method information ---
+    # read_tile reads a rectangular region of an image source as an RGB image held in memory
+    #
+    # --- Inputs ---
+    #   source  : Numpy array (possibly memory-mapped), RGB or grayscale image
+    #   box     : Tuple of integers (min_x, max_x, min_y, max_y), region to read
+    #
+    # --- Outputs ---
+    #   tile_rgb    : Numpy array, RGB image of the region
+
+    min_x, max_x, min_y, max_y = box
+    with tracer.span('decode'):
+        tile = np.ascontiguousarray(source[min_x:max_x, min_y:max_y])
+        if tile.ndim == 2:
+            tile = cv2.cvtColor(tile, cv2.COLOR_GRAY2RGB)
+    return tile
+
+
+def get_halo(search_settings_list):
+    # --- Method information ---
+    # get_halo returns the width of the margin added around every tile, such that the picture of any particle centered
+    # in a tile, as obtained by obtain_picture(), is entirely contained in the tile with its margin. The blur kernel of
+    # the edges detection is added, so that the edges near the particle are not affected by the border of the tile.
+    #
+    # --- Inputs ---
+    #   search_settings_list: List of Search objects
+    #
+    # --- Outputs ---
+    #   halo    : Integer, width of the margin in pixels
+
+    halo = 0
+    for para in search_settings_list:
+        halo = max(halo, math.ceil(para.searched_radius * para.match_para.factor) + para.edges_para.gauss_1)
+    return halo
+
+
+def get_bounds(length, tile_size):
+    # get_bounds returns the limits of the cores of the tiles along one dimension, which are of (nearly) equal sizes,
+    # at least tile_size unless the image is smaller
+    nb_tiles = max(1, length // tile_size)
+    return [round(i * length / nb_tiles) for i in range(0, nb_tiles + 1)]
+
+
+def get_tiles(image_shape, tile_size, halo):
+    # --- Method information ---
+    # get_tiles is a generator of the tiles covering an image. The cores of the tiles form a partition of the image,
+    # and every tile is read with a margin (halo) around its core, clipped to the image. The cores are at least as
+    # large as the margin, such that a tile is always larger than the templates used by find_matches().
+    #
+    # --- Inputs ---
+    #   image_shape : Tuple, shape of the image
+    #   tile_size   : Integer, size of the core of the tiles, the cores being between tile_size and twice tile_size
+    #   halo        : Integer, width of the margin around the core of the tiles
+    #
+    # --- Outputs ---
+    #   Yields (core, box) tuples, where core and box are (min_x, max_x, min_y, max_y) tuples of integers, the region
+    #   of the image owned by the tile and the region read for the tile
+
+    tile_size = max(tile_size, halo, 1)
+    bounds_x = get_bounds(image_shape[0], tile_size)
+    bounds_y = get_bounds(image_shape[1], tile_size)
+    for i in range(0, len(bounds_x) - 1):
+        for j in range(0, len(bounds_y) - 1):
+            core = (bounds_x[i], bounds_x[i + 1], bounds_y[j], bounds_y[j + 1])
+            box = (max(0, core[0] - halo), min(image_shape[0], core[1] + halo),
+                   max(0, core[2] - halo), min(image_shape[1], core[3] + halo))
+            yield core, box
+
+
+def get_tile_settings(para, image_shape, tile_shape):
+    # --- Method information ---
+    # get_tile_settings returns a copy of search settings to be used on a tile. The maximum dimension used to rescale
+    # the images is adjusted such that the tile is scaled by the same factor as the whole image would be.
+    #
+    # --- Inputs ---
+    #   para        : Search object
+    #   image_shape : Tuple, shape of the whole image
+    #   tile_shape  : Tuple, shape of the tile
+    #
+    # --- Outputs ---
+    #   tile_para   : Search object
+
+    scale_factor = min(1, para.match_para.max_dim / max(image_shape[0], image_shape[1]))
+    tile_para = copy.copy(para)
+    tile_para.match_para = copy.copy(para.match_para)
+    tile_para.match_para.max_dim = max(1, round(scale_factor * max(tile_shape[0], tile_shape[1])))
+    return tile_para
+
+
+def search_tiles(source, search_settings_list, tile_size, verbose=True):
+    # --- Method information ---
+    # search_tiles runs all the searches on an image tile by tile, such that the memory used depends on the size of the
+    # tiles rather than on the size of the image. Every tile is analysed with a margin (see get_halo()), only the
+    # particles centered in its core are kept, and the particles of all the tiles are merged with append_particle(),
+    # which resolves the particles found on both sides of the seam between two tiles.
+    # NOTE : The color differences are normalized on every tile rather than on the whole image.
+    #
+    # --- Inputs ---
+    #   source              : Numpy array (possibly memory-mapped), RGB or grayscale image, see open_image_source()
+    #   search_settings_list: List of Search objects
+    #   tile_size           : Integer, size of the core of the tiles, see get_tiles()
+    #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+    #
+    # --- Outputs ---
+    #   particles_img   : List of the particle objects found in the image
+
+    image_shape = np.shape(source)
+    halo = get_halo(search_settings_list)
+
+    # Initialize the particles to be found in the image, in a spatial index sized for the largest particles
+    cell_size = max([2 * para.contour_para.dist_tol * para.searched_radius for para in search_settings_list], default=1)
+    particles_img = ParticleIndex(cell_size)
+
+    tiles = list(get_tiles(image_shape, tile_size, halo))
+    for k in range(0, len(tiles)):
+        core, box = tiles[k]
+        if verbose:
+            print(f'Processing tile {k + 1} / {len(tiles)}, rows {core[0]} to {core[1]}, columns {core[2]} to {core[3]}')
+
+        with tracer.tags(tile=k):
+            particles_img = search_tile(source, box, core, image_shape, search_settings_list, particles_img, verbose)
+
+        if verbose:
+            print(f'{len(particles_img)} particles found so far.')
+            print('')
+
+    return particles_img.to_list()
+
+
+def search_tile(source, box, core, image_shape, search_settings_list, particles_img, verbose):
+    # --- Method information ---
+    # search_tile runs all the searches on a tile and merges the particles centered in its core, see search_tiles()
+    #
+    # --- Inputs ---
+    #   source              : Numpy array (possibly memory-mapped), RGB or grayscale image
+    #   box                 : Tuple of integers (min_x, max_x, min_y, max_y), region read for the tile
+    #   core                : Tuple of integers (min_x, max_x, min_y, max_y), region owned by the tile
+    #   image_shape         : Tuple, shape of the whole image
+    #   search_settings_list: List of Search objects
+    #   particles_img       : ParticleIndex object of the particles found in the image
+    #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+    #
+    # --- Outputs ---
+    #   particles_img   : ParticleIndex object, updated
+
+    tile_rgb = read_tile(source, box)
+    # Intermediate images are shared by all the searches of this tile, and released with it
+    cache = ImageCache(tile_rgb)
+    corner = Point(box[0], box[2])
+
+    for k in range(0, len(search_settings_list)):
+        para = search_settings_list[k]
+        tile_para = get_tile_settings(para, image_shape, np.shape(tile_rgb))
+        particles = analyse(tile_rgb, [], tile_para, cache, verbose=verbose)
+
+        for particle in particles:
+            # Particles centered in the margin belong to a neighbouring tile
+            x = particle.center.x + corner.x
+            y = particle.center.y + corner.y
+            if not (core[0] <= x < core[1] and core[2] <= y < core[3]):
+                continue
+            particle = Particle(translate_points(particle.contour, corner))
+            particle.search_id = k
+            with tracer.span('merge'):
+                particles_img, _ = append_particle(particles_img, particle, para)
+
+    return particles_img
@@ -0,0 +1,212 @@
+import os
+import cv2
+
+from concurrent.futures import as_completed
+from analyseContour import append_particle, ParticleIndex
+from analyseImage import analyse_stream, ImageCache
+from analyseTiles import open_image_source, search_tiles
+from matchObject import template_bank
+from resultCache import hash_file
+from stream import get_events
+from tracing import tracer
+
+
+def load_image(image_src):
+    # load_image reads an image file and returns it as an RGB numpy array
+    with tracer.span('decode'):
+        image_bgr = cv2.imread(image_src)
+        if image_bgr is None:
+            raise FileNotFoundError(f'Could not read image "{image_src}"')
+        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+    return image_rgb
+
+
+def search_image_stream(image_rgb, search_settings_list, particles_list, verbose=True, result_cache=None,
+                        image_hash=None, cached_lists=None):
+    # --- Method information ---
+    # search_image_stream runs all the searches on one image and merges the particles found by each of them. It is a
+    # generator of the changes made to the particles of the image, see analyse_stream(). The particles found by a
+    # search are merged once it is finished, since they may still be replaced during the search, such that every
+    # particle is checked by append_particle() whether it was found or loaded from the result cache. Once the
+    # generator is exhausted, particles_list is filled with the particles of the image.
+    # The particles of the searches already run on this image are loaded from the result cache, if specified.
+    #
+    # --- Inputs ---
+    #   image_rgb           : Numpy array, RGB image (None if all the searches are in cached_lists)
+    #   search_settings_list: List of Search objects
+    #   particles_list      : List to be filled with the particle objects found in the image
+    #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+    #   result_cache        : ResultCache object (optional)
+    #   image_hash          : String, hash of the image file, required with result_cache
+    #   cached_lists        : List of the particles of each search already obtained from result_cache, None for the
+    #                         searches not in the cache (optional)
+    #
+    # --- Outputs ---
+    #   Yields ParticleEvent objects, with the index of the search settings used
+
+    # Initialize the particles to be found in the loaded image, in a spatial index sized for the largest particles
+    cell_size = max([2 * para.contour_para.dist_tol * para.searched_radius for para in search_settings_list], default=1)
+    particles_img = ParticleIndex(cell_size)
+    # Intermediate images are shared by all the searches of this image
+    cache = ImageCache(image_rgb)
+
+    for k in range(0, len(search_settings_list)):
+        para = search_settings_list[k]
+        if verbose:
+            print(f'Looking for particles with r={para.searched_radius}')
+
+        with tracer.tags(search=k):
+            particles = None
+            if cached_lists is not None:
+                particles = cached_lists[k]
+            elif result_cache is not None:
+                particles = result_cache.get(image_hash, para)
+
+            if particles is not None:
+                if verbose:
+                    print('Loaded the particles from the result cache')
+            else:
+                particles = []
+                for _ in analyse_stream(image_rgb, particles, para, cache, verbose=verbose):
+                    pass
+
+            for particle in particles:
+                # Add particle object particles list of this image, if particle is valid
+                particle.search_id = k
+                evicted = []
+                with tracer.span('merge'):
+                    particles_img, added_particle = append_particle(particles_img, particle, para, evicted)
+                if added_particle:
+                    yield from get_events(particle, evicted, search=k)
+
+            if result_cache is not None and (cached_lists is None or cached_lists[k] is None):
+                result_cache.put(image_hash, para, particles)
+
+            if verbose:
+                print(f'Found {len(particles)} particles.')
+                print('')
+
+    particles_list[:] = particles_img.to_list()
+
+
+def search_image(image_src, search_settings_list, verbose=True, tile_size=0, result_cache=None):
+    # --- Method information ---
+    # search_image runs all the searches on one image and merges the particles found by each of them
+    #
+    # --- Inputs ---
+    #   image_src           : Source of the image file
+    #   search_settings_list: List of Search objects
+    #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+    #   tile_size           : Integer, size of the tiles for large images, see search_tiles() (0 to process the image
+    #                         as a whole)
+    #   result_cache        : ResultCache object, to reuse the particles of the searches already run on an identical
+    #                         image (optional, not used with tiles)
+    #
+    # --- Outputs ---
+    #   particles_img   : List of the particle objects found in the image
+
+    with tracer.tags(image=image_src):
+        if tile_size > 0:
+            return search_tiles(open_image_source(image_src), search_settings_list, tile_size, verbose)
+
+        image_hash = None
+        cached_lists = None
+        image_rgb = None
+        if result_cache is not None:
+            image_hash = hash_file(image_src)
+            cached_lists = [result_cache.get(image_hash, para) for para in search_settings_list]
+        # The image is only decoded if a search has to be run
+        if cached_lists is None or any(particles is None for particles in cached_lists):
+            image_rgb = load_image(image_src)
+
+        particles_img = []
+        for _ in search_image_stream(image_rgb, search_settings_list, particles_img, verbose, result_cache, image_hash,
+                                     cached_lists):
+            pass
+    return particles_img
+
+
+def init_worker(templates_src, do_trace):
+    # init_worker fills the template bank of a worker process with the templates saved by a previous run, and enables
+    # its tracer if the tracer of the main process is enabled
+    if templates_src is not None and os.path.exists(templates_src):
+        template_bank.load(templates_src)
+    if do_trace:
+        tracer.enable()
+
+
+def search_image_traced(*args):
+    # search_image_traced runs search_image() in a worker process, and returns the particles found along with the
+    # spans recorded by the worker for this image, to be added to the trace of the main process
+    particles_img = search_image(*args)
+    return particles_img, tracer.take_events()
+
+
+def save_results(i, image_src, particles_img, store, writer, draw=True):
+    # save_results saves the particles found in the image of index i in the results store and on the image, if specified
+    # (the contours are not drawn if draw is False)
+    if store is not None:
+        with tracer.span('export'):
+            store.append_image(i, particles_img, image_src)
+    if writer is not None:
+        writer.save_file(i, image_src, particles_img, draw)
+
+
+def search_images(image_src_list, search_settings_list, workers=1, templates_src=None, tile_size=0, store=None,
+                  result_cache=None, writer=None):
+    # --- Method information ---
+    # search_images runs all the searches on every image of a list. With more than one worker, the images are
+    # distributed over a pool of processes, the largest images being started first so that no worker is left with a
+    # large image at the end. The results are returned in the order of image_src_list in any case.
+    #
+    # --- Inputs ---
+    #   image_src_list      : List of the sources of the image files
+    #   search_settings_list: List of Search objects
+    #   workers             : Integer, number of processes to use, 1 to process the images one after the other
+    #   templates_src       : Source of the file of the saved search templates, to be loaded by every process
+    #   tile_size           : Integer, size of the tiles for large images, see search_image()
+    #   store               : ResultsStore object to which the particles of each image are appended as soon as the
+    #                         image is done, the index of the image in image_src_list being its identifier (optional)
+    #   result_cache        : ResultCache object, see search_image() (optional)
+    #   writer              : OverlayWriter object saving the contours of the particles on each image in the
+    #                         background, as soon as the image is done (optional). The contours are not drawn with
+    #                         tiles, since the whole image would be held in memory to draw them.
+    #
+    # --- Outputs ---
+    #   particles_list  : List of the list of particles, sorted by image
+
+    nb_images = len(image_src_list)
+    particles_list = [[] for _ in range(0, nb_images)]
+
+    if workers <= 1:
+        for i in range(0, nb_images):
+            print(f'Starting search on image "{image_src_list[i]}". ({i + 1} / {nb_images})')
+            particles_list[i] = search_image(image_src_list[i], search_settings_list, True, tile_size, result_cache)
+            save_results(i, image_src_list[i], particles_list[i], store, writer, tile_size == 0)
+        return particles_list
+
+    # Largest files first, the file size being a cheap estimate of the size of the image
+    order = sorted(range(0, nb_images), key=lambda k: os.path.getsize(image_src_list[k]), reverse=True)
+
+    print(f'Starting search on {nb_images} images with {workers} processes')
+    # The multiprocessing modules are only imported when processes are used, to shorten the startup time
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(templates_src, tracer.enabled)) as pool:
+        futures = {}
+        for i in order:
+            future = pool.submit(search_image_traced, image_src_list[i], search_settings_list, False, tile_size,
+                                 result_cache)
+            futures[future] = i
+
+        done = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            particles_list[i], events = future.result()
+            tracer.add_events(events)
+            save_results(i, image_src_list[i], particles_list[i], store, writer, tile_size == 0)
+            done += 1
+            print(f'Finished image "{image_src_list[i]}", {len(particles_list[i])} particles found. '
+                  f'({done} / {nb_images})')
+
+    return particles_list
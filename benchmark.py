@@ -0,0 +1,426 @@
+import math
+import pickle
+import time
+import numpy as np
+import cv2
+
+import kernels
+import settings
+from analyseContour import Particle, ParticleIndex, append_particle
+from analyseImage import preprocess, get_edges, find_matches, obtain_picture, analyse, ImageCache
+from analyseImage import get_dominant_color
+from batch import load_image
+from classes import Point
+from constructContour import detect_circle_edge_points, find_radial_edges
+from matchObject import template_bank, match_template_full, create_ellipse
+from optimisation import find_local_maxima
+
+
+def generate_image(shape, radii, count, min_gap=0.9, noise=8.0, blur=3, color_variation=20.0, seed=0):
+    # --- Method information ---
+    # generate_image draws a synthetic image of discs of known location and radius on a uniform background.
+    # The discs may touch or overlap each other (depending on min_gap), and their colors vary around a base color.
+    # The image is then blurred and noise is added.
+    #
+    # --- Inputs ---
+    #   shape           : Tuple of integers, (rows, columns) of the image
+    #   radii           : List of floats, radii of the discs, one of them being picked at random for each disc
+    #   count           : Integer, number of discs to place
+    #   min_gap         : Float, minimal distance between two centers, relative to the sum of their radii. 1 allows
+    #                     discs to touch, lower values allow them to overlap
+    #   noise           : Float, standard deviation of the Gaussian noise added to the image
+    #   blur            : Odd integer, size of the kernel of the Gaussian blur (0 for no blur)
+    #   color_variation : Float, maximal variation of each color component of the discs
+    #   seed            : Integer, seed of the random generator
+    #
+    # --- Outputs ---
+    #   image_rgb   : Numpy array of type uint8, RGB image
+    #   truth       : Nx3 numpy array, (x, y, r) of the discs placed, where x is the row and y the column
+
+    rng = np.random.default_rng(seed)
+    image = np.empty((shape[0], shape[1], 3), np.float64)
+    image[:, :] = (70, 80, 90)
+    base_color = np.array((200, 170, 120), np.float64)
+
+    truth = []
+    attempts = 0
+    while len(truth) < count and attempts < 100 * count:
+        attempts += 1
+        r = float(rng.choice(radii))
+        x = rng.uniform(r, shape[0] - r)
+        y = rng.uniform(r, shape[1] - r)
+        if all(math.hypot(x - x0, y - y0) >= min_gap * (r + r0) for x0, y0, r0 in truth):
+            truth.append((x, y, r))
+
+    # Discs are drawn with sub-pixel precision, on a grid 16 times finer
+    shift = 4
+    for x, y, r in truth:
+        color = base_color + rng.uniform(-color_variation, color_variation, 3)
+        cv2.circle(image, (round(y * 2 ** shift), round(x * 2 ** shift)), round(r * 2 ** shift), color.tolist(), -1,
+                   cv2.LINE_AA, shift)
+
+    if blur > 0:
+        image = cv2.GaussianBlur(image, (blur, blur), 0)
+    image += rng.normal(0, noise, image.shape)
+    image_rgb = np.clip(np.rint(image), 0, 255).astype(np.uint8)
+    return image_rgb, np.array(truth, np.float64).reshape(-1, 3)
+
+
+def match_particles(particles, truth, tol=0.3):
+    # --- Method information ---
+    # match_particles pairs the particles found with the discs of the ground truth, closest pairs first. A particle
+    # and a disc are paired when the distance between their centers is lower than tol times the radius of the disc.
+    #
+    # --- Inputs ---
+    #   particles   : List of particle objects found
+    #   truth       : Nx3 numpy array, (x, y, r) of the discs
+    #   tol         : Float, tolerance on the distance between the centers, relative to the radius
+    #
+    # --- Outputs ---
+    #   scores  : Dictionary with the precision, the recall, and the mean errors on the center and the radius
+    #             (in pixels) of the paired particles
+
+    found = np.array([(p.center.x, p.center.y, p.radius) for p in particles], np.float64).reshape(-1, 3)
+    dist = np.sqrt((found[:, None, 0] - truth[None, :, 0]) ** 2 + (found[:, None, 1] - truth[None, :, 1]) ** 2)
+    pairs = []
+    used_found, used_truth = set(), set()
+    for i, j in zip(*np.unravel_index(np.argsort(dist, axis=None), dist.shape)):
+        if dist[i, j] >= tol * truth[j, 2]:
+            break
+        if i not in used_found and j not in used_truth:
+            used_found.add(i)
+            used_truth.add(j)
+            pairs.append((i, j))
+
+    nb_pairs = len(pairs)
+    scores = {'found': len(found), 'truth': len(truth),
+              'precision': nb_pairs / len(found) if len(found) > 0 else 1.0,
+              'recall': nb_pairs / len(truth) if len(truth) > 0 else 1.0,
+              'center_error': float(np.mean([dist[i, j] for i, j in pairs])) if nb_pairs > 0 else float('nan'),
+              'radius_error': float(np.mean([abs(found[i, 2] - truth[j, 2]) for i, j in pairs]))
+              if nb_pairs > 0 else float('nan')}
+    return scores
+
+
+def measure(function, repeat=3):
+    # --- Method information ---
+    # measure calls a function several times and returns the lowest duration, and the result of the last call
+    #
+    # --- Inputs ---
+    #   function: Function without argument
+    #   repeat  : Integer, number of calls
+    #
+    # --- Outputs ---
+    #   duration: Float, lowest duration of a call, in seconds
+    #   result  : Result of the last call
+
+    duration = float('inf')
+    result = None
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        result = function()
+        duration = min(duration, time.perf_counter() - start)
+    return duration, result
+
+
+def time_stages(image_rgb, truth, para, repeat=3):
+    # --- Method information ---
+    # time_stages measures separately the duration of each stage of the pipeline on an image. The stages working on
+    # a single candidate (contour construction and evaluation) are timed on the discs of the ground truth, and their
+    # duration is given per candidate.
+    #
+    # --- Inputs ---
+    #   image_rgb   : Numpy array, RGB image
+    #   truth       : Nx3 numpy array, (x, y, r) of the discs
+    #   para        : Search object
+    #   repeat      : Integer, number of measures of each stage, the lowest duration being kept
+    #
+    # --- Outputs ---
+    #   timings : Dictionary of the durations of the stages, in seconds
+
+    timings = {}
+    edges_para = para.edges_para
+    radius = para.searched_radius
+    factor = para.match_para.factor
+
+    timings['preprocess'], (image, img, scale_factor) = measure(lambda: preprocess(image_rgb, para), repeat)
+    timings['get_edges'], edges = measure(lambda: get_edges(image, edges_para.gauss_1, edges_para.thresh1_1,
+                                                            edges_para.thresh2_1), repeat)
+    edg = get_edges(img, edges_para.gauss_2, edges_para.thresh1_2, edges_para.thresh2_2)
+    timings['find_matches'], _ = measure(lambda: find_matches(image, img, edg, scale_factor, [], para, False), repeat)
+
+    # Correlation map of the preliminary search, as in find_matches()
+    diameter = int(2 * radius * scale_factor)
+    mask_size = (round(factor * diameter), round(factor * diameter))
+    object_mask, threshold = template_bank.get_template(mask_size, (diameter, diameter), para.match_para.sharpness)
+    matches = match_template_full(edg, object_mask)
+    min_distance = max(1, round(para.match_para.peak_distance * radius * scale_factor))
+    timings['find_local_maxima'], _ = measure(
+        lambda: find_local_maxima(matches, min_distance, para.match_para.tolerance * threshold), repeat)
+
+    pictures = []
+    for x, y, _ in truth:
+        pictures.append(obtain_picture(edges, Point(round(x), round(y)), radius, factor))
+    nb_candidates = max(len(pictures), 1)
+
+    def build_contours():
+        return [detect_circle_edge_points(grid, center, radius, para)[0] for grid, center, _ in pictures]
+    duration, contours = measure(build_contours, repeat)
+    timings['detect_circle_edge_points'] = duration / nb_candidates
+
+    duration, particles = measure(lambda: [Particle(contour) for contour in contours], repeat)
+    timings['Particle'] = duration / nb_candidates
+
+    def append_all():
+        index = ParticleIndex(2 * para.contour_para.dist_tol * radius)
+        for particle in particles:
+            index, _ = append_particle(index, particle, para)
+        return index
+    duration, _ = measure(append_all, repeat)
+    timings['append_particle'] = duration / nb_candidates
+
+    return timings
+
+
+def run_case(shape, radius, count, para=None, seed=0, repeat=3):
+    # --- Method information ---
+    # run_case generates a synthetic image, times every stage of the pipeline on it, and evaluates the particles found
+    # by a complete search against the ground truth
+    #
+    # --- Inputs ---
+    #   shape   : Tuple of integers, (rows, columns) of the image
+    #   radius  : Float, radius of the discs
+    #   count   : Integer, number of discs
+    #   para    : Search object, a search with n=1 for the specified radius by default
+    #   seed    : Integer, seed of the random generator
+    #   repeat  : Integer, number of measures of each stage
+    #
+    # --- Outputs ---
+    #   result  : Dictionary of the parameters of the case, the timings of the stages and the scores of the search
+
+    if para is None:
+        para = settings.Search(r=radius, n=1, use_color_differences=False)
+    image_rgb, truth = generate_image(shape, [radius], count, seed=seed)
+
+    result = {'shape': shape, 'radius': radius, 'count': len(truth)}
+    result.update(time_stages(image_rgb, truth, para, repeat))
+    start = time.perf_counter()
+    particles = analyse(image_rgb, [], para, ImageCache(image_rgb), verbose=False)
+    result['analyse'] = time.perf_counter() - start
+    result.update(match_particles(particles, truth))
+    return result
+
+
+def run_sweep(shapes, radii, counts, seed=0, repeat=3):
+    # --- Method information ---
+    # run_sweep runs run_case() on every combination of image size, radius and number of discs, and prints the results
+    #
+    # --- Inputs ---
+    #   shapes  : List of tuples of integers, (rows, columns) of the images
+    #   radii   : List of floats, radii of the discs
+    #   counts  : List of integers, numbers of discs
+    #   seed    : Integer, seed of the random generator
+    #   repeat  : Integer, number of measures of each stage
+    #
+    # --- Outputs ---
+    #   results : List of the dictionaries returned by run_case()
+
+    results = []
+    for shape in shapes:
+        for radius in radii:
+            for count in counts:
+                result = run_case(shape, radius, count, seed=seed, repeat=repeat)
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(result):
+    # print_result prints the timings (in milliseconds) and the scores of a case of the benchmark
+    print(f"{result['shape'][0]}x{result['shape'][1]}, r={result['radius']}, {result['count']} discs : "
+          f"precision {result['precision']:.3f}, recall {result['recall']:.3f}, "
+          f"center error {result['center_error']:.2f} px, radius error {result['radius_error']:.2f} px")
+    for stage in STAGES:
+        print(f'    {stage:<28}{1000 * result[stage]:10.3f} ms')
+
+
+def compare_backends(shapes, radii, counts, max_dim=None, seed=0, repeat=3):
+    # --- Method information ---
+    # compare_backends times the preliminary search of find_matches() with each detection backend (see BACKENDS) on
+    # synthetic images, and evaluates the particles found by a complete search with each of them. The correlation
+    # costs the same whatever the number of discs, while the cost of the Hough transform grows with the number of
+    # edge pixels, which is given along with the timings.
+    #
+    # --- Inputs ---
+    #   shapes  : List of tuples of integers, (rows, columns) of the images
+    #   radii   : List of floats, radii of the discs
+    #   counts  : List of integers, numbers of discs
+    #   max_dim : Integer, max_dim of the searches, None to search the images at full scale
+    #   seed    : Integer, seed of the random generator
+    #   repeat  : Integer, number of measures of find_matches()
+    #
+    # --- Outputs ---
+    #   results : List of dictionaries of the parameters of the case, the backend, the number of edge pixels, the
+    #             durations of find_matches() and analyse() and the scores of the search
+
+    results = []
+    for shape in shapes:
+        for radius in radii:
+            for count in counts:
+                image_rgb, truth = generate_image(shape, [radius], count, seed=seed)
+                durations = {}
+                for backend in BACKENDS:
+                    para = settings.Search(r=radius, n=1, use_color_differences=False)
+                    para.match_para.backend = backend
+                    para.match_para.max_dim = max(shape) if max_dim is None else max_dim
+                    edges_para = para.edges_para
+                    image, img, scale_factor = preprocess(image_rgb, para)
+                    edg = get_edges(img, edges_para.gauss_2, edges_para.thresh1_2, edges_para.thresh2_2)
+
+                    result = {'shape': shape, 'radius': radius, 'count': len(truth), 'backend': backend,
+                              'edge_pixels': int(np.count_nonzero(edg))}
+                    result['find_matches'], _ = measure(
+                        lambda: find_matches(image, img, edg, scale_factor, [], para, False), repeat)
+                    start = time.perf_counter()
+                    particles = analyse(image_rgb, [], para, ImageCache(image_rgb), verbose=False)
+                    result['analyse'] = time.perf_counter() - start
+                    result.update(match_particles(particles, truth))
+                    results.append(result)
+                    durations[backend] = result['find_matches']
+
+                    print(f"{shape[0]}x{shape[1]}, r={radius}, {len(truth)} discs, {backend:<12}: "
+                          f"{result['edge_pixels']} edge pixels, find_matches {1000 * result['find_matches']:.1f} ms "
+                          f"({durations[BACKENDS[0]] / result['find_matches']:.1f}x), "
+                          f"analyse {1000 * result['analyse']:.1f} ms, precision {result['precision']:.3f}, "
+                          f"recall {result['recall']:.3f}")
+    return results
+
+
+def compare_kernels(radius=60, repeat=3, seed=0):
+    # --- Method information ---
+    # compare_kernels times each kernel of kernels.py, compiled by numba and in its NumPy version, on inputs of the
+    # size used by a search of particles of a given radius, and checks that both versions give the same results.
+    # Without numba, only the NumPy versions are timed.
+    #
+    # --- Inputs ---
+    #   radius  : Float, radius of the particles searched
+    #   repeat  : Integer, number of measures of each kernel
+    #   seed    : Integer, seed of the random generator
+    #
+    # --- Outputs ---
+    #   results : Dictionary of the results of each kernel, as dictionaries of the durations of both versions, the
+    #             speedup and whether the results are identical
+
+    para = settings.Search(r=radius, n=1, use_color_differences=False)
+    contour_para = para.contour_para
+    size = round(2 * para.match_para.factor * radius)
+    picture = (np.random.default_rng(seed).random((size, size)) < 0.1).astype(np.float64)
+    image_rgb, _ = generate_image((720, 960), [radius], 10, seed=seed)
+    cases = {'ellipse': lambda: create_ellipse((size, size), (2 * radius, 2 * radius), contour_para.sharpness),
+             'ray_maxima': lambda: find_radial_edges(picture, Point(size / 2, size / 2), contour_para.nb_points, 0,
+                                                     size / 2, contour_para.radial_tol),
+             'dominant_color': lambda: get_dominant_color(image_rgb)}
+
+    if kernels.njit is None:
+        print('numba is not installed, only the NumPy versions of the kernels are timed')
+    results = {}
+    use_jit = kernels.use_jit
+    try:
+        for name, function in cases.items():
+            kernels.use_jit = False
+            result = {}
+            result['numpy'], expected = measure(function, repeat)
+            line = f'{name:<16}: NumPy {1000 * result["numpy"]:.3f} ms'
+            if kernels.njit is not None:
+                kernels.use_jit = True
+                # The first call compiles the kernel
+                function()
+                result['jit'], obtained = measure(function, repeat)
+                result['speedup'] = result['numpy'] / result['jit']
+                if not isinstance(expected, tuple):
+                    expected, obtained = (expected,), (obtained,)
+                result['identical'] = all(np.array_equal(a, b) for a, b in zip(expected, obtained))
+                line += (f', numba {1000 * result["jit"]:.3f} ms ({result["speedup"]:.1f}x), '
+                         f'{"identical" if result["identical"] else "DIFFERENT"} results')
+            results[name] = result
+            print(line)
+    finally:
+        kernels.use_jit = use_jit
+    return results
+
+
+# Detection backends of the preliminary search, compared by compare_backends(), the first one being the reference
+BACKENDS = ['correlation', 'hough']
+
+# Stages timed by time_stages(), followed by the complete search. Stages marked per candidate in time_stages() are
+# given for a single candidate.
+STAGES = ['preprocess', 'get_edges', 'find_matches', 'find_local_maxima', 'detect_circle_edge_points', 'Particle',
+          'append_particle', 'analyse']
+
+
+def check_reference(image_src, data_src, search_settings_list, tol=0.05):
+    # --- Method information ---
+    # check_reference runs searches on an image and compares the particles found to the particles stored by a
+    # previous run. Two particles are paired when their centers are closer than tol times the stored radius.
+    #
+    # --- Inputs ---
+    #   image_src           : Source of the image file
+    #   data_src            : Source of the file of the stored particles, as saved by main.search() for this image
+    #   search_settings_list: List of Search objects used for the stored run
+    #   tol                 : Float, tolerance on the distance between the centers, relative to the radius
+    #
+    # --- Outputs ---
+    #   result  : Dictionary with the duration of the searches and the scores of match_particles(), the stored
+    #             particles being used as the ground truth
+
+    with open(data_src, 'rb') as data_file:
+        reference = pickle.load(data_file)
+    truth = np.array([(p.center.x, p.center.y, p.radius) for p in reference], np.float64).reshape(-1, 3)
+
+    image_rgb = load_image(image_src)
+    cache = ImageCache(image_rgb)
+    start = time.perf_counter()
+    # The particles are merged in a spatial index sized for the largest particles, as in search_image_stream()
+    cell_size = max([2 * para.contour_para.dist_tol * para.searched_radius for para in search_settings_list], default=1)
+    particles = ParticleIndex(cell_size)
+    for para in search_settings_list:
+        for particle in analyse(image_rgb, [], para, cache, verbose=False):
+            particles, _ = append_particle(particles, particle, para)
+    result = {'analyse': time.perf_counter() - start}
+    result.update(match_particles(particles.to_list(), truth, tol))
+    return result
+
+
+# Reference runs : image, stored particles, stored search settings and index of the settings used for the stored run
+REFERENCE_RUNS = [('Photos/Air_Soft_1.jpg', 'Searches/data', 'Searches/settings', [0])]
+
+
+def check_references(reference_runs=None):
+    # --- Method information ---
+    # check_references runs check_reference() on every reference run and prints the results
+    #
+    # --- Inputs ---
+    #   reference_runs  : List of (image_src, data_src, settings_src, indexes) tuples, REFERENCE_RUNS by default
+    #
+    # --- Outputs ---
+    #   results : List of the dictionaries returned by check_reference()
+
+    if reference_runs is None:
+        reference_runs = REFERENCE_RUNS
+    results = []
+    for image_src, data_src, settings_src, indexes in reference_runs:
+        with open(settings_src, 'rb') as settings_file:
+            stored_settings = pickle.load(settings_file)
+        result = check_reference(image_src, data_src, [stored_settings[k] for k in indexes])
+        results.append(result)
+        print(f"{image_src} : {result['analyse']:.3f} s, {result['found']} particles for {result['truth']} stored, "
+              f"precision {result['precision']:.3f}, recall {result['recall']:.3f}, "
+              f"center error {result['center_error']:.2f} px, radius error {result['radius_error']:.2f} px")
+    return results
+
+
+if __name__ == '__main__':
+    run_sweep(shapes=[(720, 960), (1440, 1920)], radii=[30, 60], counts=[10, 40])
+    compare_backends(shapes=[(1440, 1920)], radii=[30, 120], counts=[5, 40])
+    compare_kernels()
+    check_references()
@@ -1,5 +1,65 @@
+import numpy as np
+
+
 class Point:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
+    def __getstate__(self):
+        return {'x': self.x, 'y': self.y}
+
+    def __setstate__(self, state):
+        self.x = state['x']
+        self.y = state['y']
+
+
+def points_to_array(points):
+    # --- Method information ---
+    # points_to_array returns the coordinates of a sequence of points as an Nx2 array, where each row is (x, y).
+    # Arrays are returned as float arrays, and lists of point objects (as used by older versions) are converted.
+    #
+    # --- Inputs ---
+    #   points  : Nx2 array or list of point objects
+    #
+    # --- Outputs ---
+    #   array   : Nx2 numpy array of floats
+
+    if len(points) > 0 and isinstance(points[0], Point):
+        return np.array([(point.x, point.y) for point in points], dtype=np.float64)
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+class Window:
+    __slots__ = ('image', 'min_x', 'max_x', 'min_y', 'max_y')
+
+    def __init__(self, image, min_x, max_x, min_y, max_y):
+        # --- Method information ---
+        # A Window is a rectangular region of an image, clipped to the bounds of the image. Its pixels are read from
+        # the image without being copied.
+        #
+        # --- Inputs ---
+        #   image   : Numpy array, image in which the window is
+        #   min_x   : Integer, first row of the window
+        #   max_x   : Integer, row after the last row of the window
+        #   min_y   : Integer, first column of the window
+        #   max_y   : Integer, column after the last column of the window
+
+        self.image = image
+        self.min_x = min_x
+        self.max_x = max_x
+        self.min_y = min_y
+        self.max_y = max_y
+
+    @property
+    def corner(self):
+        # Point object, location of the top left corner of the window in the image
+        return Point(self.min_x, self.min_y)
+
+    def view(self):
+        # view returns the pixels of the window as a read-only view of the image
+        picture = self.image[self.min_x:self.max_x, self.min_y:self.max_y]
+        picture.flags.writeable = False
+        return picture
@@ -0,0 +1,168 @@
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import time
+
+# Time at which the program started, the heavy modules (numpy, OpenCV) being only imported once the arguments are read
+START_TIME = time.perf_counter()
+
+
+def parse_arguments(arguments=None):
+    # --- Method information ---
+    # parse_arguments reads the arguments of the command line
+    #
+    # --- Inputs ---
+    #   arguments   : List of strings, the arguments of the command line by default
+    #
+    # --- Outputs ---
+    #   args    : Namespace object of the arguments
+
+    parser = argparse.ArgumentParser(description='Find the particles in images, without the gui. See main.py for the '
+                                                 'user manual.')
+    parser.add_argument('images', nargs='+',
+                        help='image files or glob patterns (such as "Photos/*.jpg"), or a video file with --sequence')
+    parser.add_argument('-s', '--settings',
+                        help='file of the search settings saved by the gui (such as Current_Search/settings)')
+    parser.add_argument('-r', '--radius', type=int, help='radius of the particles, for a single search without '
+                                                         'a settings file')
+    parser.add_argument('-n', '--iterations', type=int, default=1, help='number of iterations of this search')
+    parser.add_argument('--color', action='store_true', help='use the color differences in this search')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes analysing the images')
+    parser.add_argument('-o', '--results', default='Current_Search/results', help='folder of the results store')
+    parser.add_argument('--overlays', help='folder in which the images are saved with the contours drawn')
+    parser.add_argument('--cache', help='folder of the result cache, the searches already run are not run again')
+    parser.add_argument('--cache-size', type=int, default=1 << 30, help='maximum size of the result cache in bytes')
+    parser.add_argument('--templates', help='file in which the search templates are kept from run to run')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='size of the tiles of large images, 0 for no tiles (no --overlays are saved with tiles)')
+    parser.add_argument('--sequence', action='store_true',
+                        help='track the particles from frame to frame, the images being a sequence, see tracking.py')
+    parser.add_argument('--trace', help='file in which the time spent in each stage is saved')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='print the particles of each image to stdout as JSON lines, as soon as it is done')
+    parser.add_argument('--gui', action='store_true', help='open the settings window before the search')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print the time taken before the first image is started, on stderr')
+    args = parser.parse_args(arguments)
+    if args.settings is None and args.radius is None and not args.gui:
+        parser.error('the search settings are required, either with --settings or with --radius')
+    return args
+
+
+def expand_images(patterns, sequence=False):
+    # --- Method information ---
+    # expand_images returns the sources of the images matching glob patterns, in the order of the patterns, the files
+    # matching a same pattern being sorted by name
+    #
+    # --- Inputs ---
+    #   patterns    : List of strings, sources or glob patterns
+    #   sequence    : Boolean variable, whether a single video file may be given instead of images
+    #
+    # --- Outputs ---
+    #   image_src_list  : List of the sources of the images, or source of the video file
+
+    image_src_list = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise FileNotFoundError(f'No file matches "{pattern}"')
+        image_src_list.extend(matches)
+    if sequence and len(image_src_list) == 1 and os.path.splitext(image_src_list[0])[1].lower() in VIDEO_EXTENSIONS:
+        return image_src_list[0]
+    return image_src_list
+
+
+def get_search_settings(args):
+    # get_search_settings returns the list of Search objects given by the settings file or by the arguments
+    import export
+    import settings
+    if args.settings is not None:
+        return export.open_data(args.settings)
+    return [settings.Search(r=args.radius, n=args.iterations, use_color_differences=args.color)]
+
+
+def run(args, output):
+    # --- Method information ---
+    # run runs the searches specified by the arguments, and saves the particles found
+    #
+    # --- Inputs ---
+    #   args    : Namespace object of the arguments, see parse_arguments()
+    #   output  : Text file object to which the JSON lines are written, if requested
+
+    image_src_list = expand_images(args.images, args.sequence)
+
+    # The modules of the search are imported here, so that the errors in the arguments are reported at once
+    import export
+    import settings
+    from batch import search_images
+    from matchObject import template_bank
+    from resultCache import ResultCache
+    from resultsStore import ResultsStore
+    from tracing import tracer
+    from tracking import track_sequence
+
+    settings.init()
+    if args.gui:
+        # tkinter and PIL are only imported when the window is opened
+        import gui
+        settings_src = args.settings if args.settings is not None else 'Current_Search/settings'
+        image_src_list, search_settings_list = gui.open_window(image_src_list, settings_src)
+        if not settings.do_run_search:
+            return
+        search_settings_list = export.open_data(settings_src)
+    else:
+        search_settings_list = get_search_settings(args)
+
+    if args.trace is not None:
+        tracer.enable()
+    if args.templates is not None and os.path.exists(args.templates):
+        template_bank.load(args.templates)
+
+    store = ResultsStore(args.results, 'w')
+    result_cache = None
+    if args.cache is not None:
+        result_cache = ResultCache(args.cache, args.cache_size)
+    writer = None
+    if args.overlays is not None:
+        os.makedirs(args.overlays, exist_ok=True)
+        writer = export.OverlayWriter(args.overlays)
+    if args.jsonl:
+        writer = export.JsonLinesWriter(output, writer)
+
+    if args.startup_time:
+        print(f'Startup time : {1000 * (time.perf_counter() - START_TIME):.1f} ms', file=sys.stderr)
+
+    if args.sequence:
+        track_sequence(image_src_list, search_settings_list, store, writer)
+    else:
+        search_images(image_src_list, search_settings_list, args.workers, args.templates, args.tile_size, store,
+                      result_cache, writer)
+
+    if writer is not None:
+        writer.close()
+    if args.templates is not None:
+        template_bank.save(args.templates)
+    if args.trace is not None:
+        tracer.save(args.trace)
+        tracer.print_summary()
+
+
+def main(arguments=None):
+    args = parse_arguments(arguments)
+    if args.jsonl:
+        # The standard output only holds the JSON lines, the progress is printed to the standard error instead
+        output = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            run(args, output)
+    else:
+        run(args, sys.stdout)
+
+
+# Extensions of the video files accepted with --sequence
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv', '.wmv')
+
+
+if __name__ == '__main__':
+    main()
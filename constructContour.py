@@ -1,19 +1,40 @@
 import math
 import numpy as np
 
-from classes import Point
+from classes import points_to_array
+from collections import OrderedDict
+from functools import lru_cache
+from kernels import get_kernel
 from matchObject import create_ellipse
 
 
-class Pixel:
-    def __init__(self, value, pixel):
-        self.value = value
-        self.pixel = pixel
-
+def sample_ray_pixels(grid, start_point, offsets_x, offsets_y):
+    # --- Method information ---
+    # sample_ray_pixels returns the pixels of the grid found at specified offsets along one or many rays from a
+    # starting point. As a ray is followed from its starting point, it stops at the first pixel outside the grid.
+    #
+    # --- Inputs ---
+    #   grid        : Numpy array containing the values to be checked
+    #   start_point : Point object defining the starting point of the rays on the grid
+    #   offsets_x   : Numpy array of the x offsets, one row per ray, in increasing distance from the starting point
+    #   offsets_y   : Numpy array of the y offsets, same shape as offsets_x
+    #
+    # --- Outputs ---
+    #   pix_x   : Numpy array of integers, x coordinate of each pixel
+    #   pix_y   : Numpy array of integers, y coordinate of each pixel
+    #   values  : Numpy array, value of each pixel, -inf for the pixels that are not reached
 
-def take_first_element(elem):
-    # take_first_element returns the first element from the list
-    return elem[0]
+    grid_size = np.shape(grid)
+    pix_x = np.round(start_point.x + offsets_x).astype(int)
+    pix_y = np.round(start_point.y + offsets_y).astype(int)
+    inside = (0 <= pix_x) & (pix_x < grid_size[0]) & (0 <= pix_y) & (pix_y < grid_size[1])
+    # A ray starting outside the grid does not reach any pixel
+    if not ((0 <= round(start_point.x) < grid_size[0]) and (0 <= round(start_point.y) < grid_size[1])):
+        inside[...] = False
+    inside = np.logical_and.accumulate(inside, axis=-1)
+    values = np.full(np.shape(pix_x), -np.inf)
+    values[inside] = grid[pix_x[inside], pix_y[inside]]
+    return pix_x, pix_y, values
 
 
 def find_radial_edge(grid, start_point, dir_vector, tol):
@@ -27,84 +48,153 @@ def find_radial_edge(grid, start_point, dir_vector, tol):
     #   tol         : Float, minimum value at which a point is considered acceptable
     #
     # --- Outputs ---
-    #   best_fits   : List of pixel objects found on the line, ordered from highest to lowest value
+    #   best_fits   : Nx2 array of the pixels found on the line, ordered from highest to lowest value
 
-    grid_size = np.shape(grid)
-    vector_list = []
-    best_fits = []
-    dt = 0.5
-
-    pix_x = 0
-    pix_y = 0
-    done = False
-    safety_count = 0
-    for direction in (1, -1):
-        t = 0
-        while (not done) and (safety_count < 1000):
-            x = start_point.x + t * direction * dir_vector.x
-            y = start_point.y + t * direction * dir_vector.y
-
-            if (pix_x != round(x)) or (pix_y != round(y)):
-                pix_x = round(x)
-                pix_y = round(y)
-
-                if (0 <= pix_x < grid_size[0]) and (0 <= pix_y < grid_size[1]):
-                    pixel_value = grid[pix_x, pix_y]
-                    if pixel_value > tol:
-                        vector_list.append(Pixel(pixel_value, Point(pix_x, pix_y)))
-                else:
-                    done = True
-
-            safety_count += 1
-            t += dt
-
-    if len(vector_list) > 0:
-        # sorted_list = sorted(vector_list, key=take_first_element, reverse=True)
-        sorted_list = sorted(vector_list, key=lambda z: getattr(z, 'value'), reverse=True)
-        for element in sorted_list:
-            best_fits.append(element.pixel)
+    # The line is followed by steps of half a pixel, for at most 1000 steps
+    t = np.arange(0, 1000) * 0.5
+    pix_x, pix_y, values = sample_ray_pixels(grid, start_point, t * dir_vector.x, t * dir_vector.y)
 
+    # Every pixel is only considered once
+    new_pixel = np.ones(len(t), dtype=bool)
+    new_pixel[1:] = (pix_x[1:] != pix_x[:-1]) | (pix_y[1:] != pix_y[:-1])
+    new_pixel[0] = (pix_x[0] != 0) or (pix_y[0] != 0)
+    hits = np.nonzero(new_pixel & (values > tol))[0]
+    order = hits[np.argsort(-values[hits], kind='stable')]
+
+    best_fits = np.column_stack((pix_x[order], pix_y[order])).astype(np.float64)
     return best_fits
 
 
+@lru_cache(maxsize=64)
+def get_ray_offsets(n, k_min, k_max):
+    # --- Method information ---
+    # get_ray_offsets returns the table of the offsets of the points sampled along n rays evenly distributed around
+    # a center. Each ray is sampled every half pixel, between k_min / 2 and (k_max - 1) / 2 pixels from the center.
+    #
+    # --- Inputs ---
+    #   n       : Integer, number of rays
+    #   k_min   : Integer, index of the first sample
+    #   k_max   : Integer, index following the last sample
+    #
+    # --- Outputs ---
+    #   offsets_x   : Numpy array of size n x (k_max - k_min), x offset of each sample, one row per ray
+    #   offsets_y   : Numpy array of the same size, y offset of each sample
+
+    t = np.arange(k_min, k_max) * 0.5
+    cos = np.array([math.cos(2 * math.pi * i / n) for i in range(0, n)])
+    sin = np.array([math.sin(2 * math.pi * i / n) for i in range(0, n)])
+    offsets_x = t.reshape(1, -1) * cos.reshape(-1, 1)
+    offsets_y = t.reshape(1, -1) * sin.reshape(-1, 1)
+    offsets_x.setflags(write=False)
+    offsets_y.setflags(write=False)
+    return offsets_x, offsets_y
+
+
+def find_radial_edges(grid, center, n, t_min, t_max, tol):
+    # --- Method information ---
+    # find_radial_edges finds, on each of n rays evenly distributed around a center, the highest valued pixel of the
+    # grid located between two distances from the center. All the rays are sampled at once.
+    #
+    # --- Inputs ---
+    #   grid    : Numpy array containing the values to be checked
+    #   center  : Point object, starting point of the rays
+    #   n       : Integer, number of rays
+    #   t_min   : Float, distance from the center at which to start looking
+    #   t_max   : Float, distance from the center at which to stop looking
+    #   tol     : Float, minimum value at which a point is considered acceptable
+    #
+    # --- Outputs ---
+    #   points  : Nx2 array of the best pixel of each ray where one was found, in order of the rays
+    #   values  : Numpy array of the value of these pixels
+
+    # Rays are sampled every half pixel, for at most 1000 samples
+    k_min = min(max(math.floor(2 * t_min), 0), 1000)
+    k_max = min(max(math.ceil(2 * t_max) + 1, k_min), 1000)
+    if k_max == k_min:
+        return np.zeros((0, 2)), np.zeros(0)
+    offsets_x, offsets_y = get_ray_offsets(n, k_min, k_max)
+    kernel = get_kernel('ray_maxima')
+    if kernel is not None:
+        best_x, best_y, best_values = kernel(grid, float(center.x), float(center.y), offsets_x, offsets_y)
+    else:
+        pix_x, pix_y, values = sample_ray_pixels(grid, center, offsets_x, offsets_y)
+        # The first of the highest valued pixels of each ray is kept
+        best = np.argmax(values, axis=1)
+        rays = np.arange(0, n)
+        best_x, best_y, best_values = pix_x[rays, best], pix_y[rays, best], values[rays, best]
+
+    # The best pixel of a ray is kept if it is acceptable
+    found = best_values > tol
+    points = np.column_stack((best_x, best_y))[found].astype(np.float64)
+    return points, best_values[found]
+
+
 def translate_points(points, trans):
     # --- Method information ---
-    # translate_points is used to translate point objects by a vector
+    # translate_points is used to translate points by a vector
     #
     # --- Inputs ---
-    #   points  : List of point objects to be translated
+    #   points  : Nx2 array of the points to be translated
     #   trans   : Point object containing the translation vector
     #
     # --- Outputs ---
-    #   new_points  : List of point objects, translated points
+    #   new_points  : Nx2 array, translated points
 
-    new_points = []
-    for point in points:
-        new_points.append(Point(point.x + trans.x, point.y + trans.y))
+    new_points = points_to_array(points) + (trans.x, trans.y)
     return new_points
 
 
 def scale_points(points, scale, do_round):
     # --- Method information ---
-    # scale_points is used to scale point objects by a certain factor
+    # scale_points is used to scale points by a certain factor
     #
     # --- Inputs ---
-    #   points  : List of point objects to be scaled by a factor
+    #   points  : Nx2 array of the points to be scaled by a factor
     #   scale   : Point object, factor by which to scale the points x and y component
     #   do_round: Boolean variable to specify if the resulting points' coordinates should be rounded or not
     #
     # --- Outputs ---
-    #   new_points  : List of point objects, scaled points
+    #   new_points  : Nx2 array, scaled points
 
-    new_points = []
-    for point in points:
-        if do_round:
-            new_points.append(Point(round(point.x * scale.x), round(point.y * scale.y)))
-        else:
-            new_points.append(Point(point.x * scale.x, point.y * scale.y))
+    new_points = points_to_array(points) * (scale.x, scale.y)
+    if do_round:
+        new_points = np.round(new_points)
     return new_points
 
 
+def get_circle_mask(r, sharpness, half_size):
+    # --- Method information ---
+    # get_circle_mask returns the mask created by create_ellipse for a circle of radius r centered in a square image,
+    # of half side at least half_size. The masks are kept for each (r, sharpness), and only created again when a
+    # larger one is needed. The value of a pixel only depends on its position relative to the center of the mask,
+    # thus the pixels of the mask are the same whatever its size.
+    #
+    # --- Inputs ---
+    #   r           : Integer, radius of the circle
+    #   sharpness   : Float, sharpness of the circle, see create_ellipse()
+    #   half_size   : Integer, minimal half side of the mask
+    #
+    # --- Outputs ---
+    #   mask    : Numpy array, read-only square image of side 2 * half_size or more, centered on the circle
+
+    key = (r, float(sharpness))
+    mask = circle_masks.get(key)
+    if mask is None or mask.shape[0] < 2 * half_size:
+        mask = create_ellipse((2 * half_size, 2 * half_size), (2 * r, 2 * r), sharpness)
+        mask.setflags(write=False)
+        circle_masks[key] = mask
+        circle_masks.move_to_end(key)
+        while len(circle_masks) > 32:
+            circle_masks.popitem(last=False)
+    else:
+        circle_masks.move_to_end(key)
+    return mask
+
+
+# Masks of the circles used to weight the edge maps, keyed by (radius, sharpness), see get_circle_mask()
+circle_masks = OrderedDict()
+
+
 def detect_circle_edge_points(grid, center, r, para):
     # --- Method information ---
     # detect_circle_edge_points takes in a contour map of an image expected to contain a circle, as well as
@@ -118,8 +208,8 @@ def detect_circle_edge_points(grid, center, r, para):
     #   para    : Search parameters object
     #
     # --- Outputs ---
-    #   list_of_points : Ordered list of points constructing the actual edge of the expected circle
-    #   list_of_directions : A complicated thing to explain, which is not used by the program
+    #   list_of_points : Nx2 array of the ordered points constructing the actual edge of the expected circle
+    #   edge_values    : Numpy array, value of the weighted edge map at each of these points
 
     n = para.contour_para.nb_points
     sharpness = para.contour_para.sharpness
@@ -130,39 +220,40 @@ def detect_circle_edge_points(grid, center, r, para):
     r = round(r)
     x_size = round(max(size[0] - center.x, center.x))
     y_size = round(max(size[1] - center.y, center.y))
-    mask = create_ellipse((2*x_size, 2*y_size), (2*r, 2*r), sharpness)
 
     # Apply circular mask on edge map.
     # Deal with potential "spilling" over the edge from the mask.
-    # create a new grid to store information.
-    grid_weight = grid
     displacement = [0, 0]
     if center.x < (size[0] / 2):
         displacement[0] = int(max(size[0] - 2*center.x, 0))
     if center.y < (size[1] / 2):
         displacement[1] = int(max(size[1] - 2*center.y, 0))
 
-    for i in range(0, size[0]):
-        for j in range(0, size[1]):
-            grid_weight[i, j] = grid[i, j] * mask[(i + displacement[0]), (j + displacement[1])]
-
-    # Create a list of evenly distributed points on the expected edge of the circle.
-    # For every expected edge point, try to find the best actual edge point in the edge map.
-    list_of_points = []
-    list_of_directions = []
-    for i in range(0, n):
-        theta = 2 * math.pi * i / n
-        dir_vector = Point(math.cos(theta), math.sin(theta))
-
-        # Find the highest valued pixels on the corresponding radial direction.
-        # These correspond to the most likely edge pixels.
-        best_fits = find_radial_edge(grid, center, dir_vector, radial_tol)
-        list_of_directions.append(best_fits)
-
-        # Check best_fit is not empty.
-        if len(best_fits) > 0:
-            list_of_points.append(best_fits[0])
-
-    return list_of_points, list_of_directions
-
+    # The mask is centered on the pixel (x_size - displacement[0], y_size - displacement[1]) of the grid, its values
+    # are read from the cached mask around the same center. The weighted edge map is a new array, such that the edge
+    # map shared by all the candidates is not modified.
+    half_size = max(x_size, y_size, size[0] + displacement[0] - x_size, size[1] + displacement[1] - y_size)
+    mask = get_circle_mask(r, sharpness, half_size)
+    top = mask.shape[0] // 2 - x_size + displacement[0]
+    left = mask.shape[1] // 2 - y_size + displacement[1]
+    grid_weight = grid * mask[top:top + size[0], left:left + size[1]]
+
+    # Look for the edge on n evenly distributed rays from the expected center of the circle.
+    # For every ray, the best actual edge point is the highest valued pixel of the weighted edge map.
+    # A pixel can only exceed radial_tol where the mask does, which is an annulus around the expected edge: the rays
+    # are only sampled there. The annulus is widened by the distance between the centers of the mask and of the rays.
+    mask_center = (x_size - 0.5 - displacement[0], y_size - 0.5 - displacement[1])
+    offset = math.sqrt((mask_center[0] - center.x) ** 2 + (mask_center[1] - center.y) ** 2)
+    sharp = (1 - sharpness) ** 2
+    if radial_tol <= 0:
+        t_min, t_max = 0, 500
+    else:
+        if sharp == 0:
+            width = 1.5
+        else:
+            width = r * math.sqrt(sharp * max(1 / radial_tol - 1, 0))
+        t_min = r - width - offset - 1
+        t_max = r + width + offset + 1
+    list_of_points, edge_values = find_radial_edges(grid_weight, center, n, t_min, t_max, radial_tol)
 
+    return list_of_points, edge_values
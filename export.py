@@ -1,5 +1,12 @@
+import json
 import pickle
 import cv2
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from analyseTiles import open_image_source
+from tracing import tracer, bind_tags
 
 
 def save_data(data, filename):
@@ -62,10 +69,109 @@ def save_particles_to_images(images_list, particles_list, images_src):
     # --- Outputs ---
     #   This method does not have a return statement
 
+    writer = OverlayWriter(images_src)
     for i in range(0, len(particles_list)):
-        image = print_particles(images_list[i], particles_list[i])
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(f'{images_src}/image_{i}.jpg', image)
+        writer.save_image(i, images_list[i], particles_list[i])
+    writer.close()
+
+
+def save_overlay(image, particles_list, filename):
+    # save_overlay prints the contours of the particles on an RGB image and saves the resulting image
+    with tracer.span('export'):
+        image = print_particles(image, particles_list)
+        cv2.imwrite(filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+
+def save_overlay_from_file(image_src, particles_list, filename):
+    # save_overlay_from_file reads an image file (or a .npy file, see open_image_source()), then prints the contours of
+    # the particles on it and saves it
+    with tracer.span('export'):
+        image = open_image_source(image_src)
+        if image.ndim == 2:
+            image = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_GRAY2RGB)
+        else:
+            # A memory-mapped .npy file is read-only, the contours are drawn on a copy held in memory
+            image = np.array(image)
+        # The contours are drawn in red, as by print_particles()
+        draw_contours(image, [particle.contour for particle in particles_list], color=(255, 0, 0), thickness=2)
+        cv2.imwrite(filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+
+class OverlayWriter:
+    def __init__(self, images_src, workers=2):
+        # Source of the folder in which the images are to be saved
+        self.images_src = images_src
+        # Threads drawing and encoding the images, which can run while the next image is analysed since OpenCV
+        # releases the GIL
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Images being saved, only a limited number of them are held in memory at the same time
+        self.pending = deque()
+        self.max_pending = 2 * workers
+
+    def submit(self, function, *args):
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(bind_tags(function), *args))
+
+    def save_image(self, i, image, particles_list, image_src=None):
+        # save_image saves the contours of the particles on the RGB image of index i, in the background. The source of
+        # the image is only used by the JsonLinesWriter.
+        self.submit(save_overlay, image, particles_list, f'{self.images_src}/image_{i}.jpg')
+
+    def save_file(self, i, image_src, particles_list, draw=True):
+        # save_file saves the contours of the particles on the image file of index i, read in the background. Nothing
+        # is saved if draw is False, as for the images searched by tiles.
+        if draw:
+            self.submit(save_overlay_from_file, image_src, particles_list, f'{self.images_src}/image_{i}.jpg')
+
+    def close(self):
+        # close waits for all the images to be saved, raising the errors that occurred if any
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+
+def get_particle_record(i, particle):
+    # get_particle_record returns the measures of a particle of the image of index i, as a dictionary of plain values
+    return {'image': i, 'search': particle.search_id, 'track': particle.track_id, 'x': float(particle.center.x),
+            'y': float(particle.center.y), 'radius': float(particle.radius), 'area': float(particle.area),
+            'perimeter': float(particle.perimeter), 'circularity': float(particle.circularity)}
+
+
+class JsonLinesWriter:
+    def __init__(self, stream, writer=None):
+        # --- Method information ---
+        # A JsonLinesWriter prints the particles of every image as soon as the image is done, as JSON lines : one line
+        # per image with the number of particles, followed by one line per particle (see get_particle_record()). It
+        # can be used wherever an OverlayWriter is, and passes the images on to an OverlayWriter if specified.
+        #
+        # --- Inputs ---
+        #   stream  : Text file object, such as sys.stdout
+        #   writer  : OverlayWriter object to which the images are passed on (optional)
+
+        self.stream = stream
+        self.writer = writer
+
+    def write(self, i, image_src, particles_list):
+        lines = [json.dumps({'image': i, 'source': image_src, 'count': len(particles_list)})]
+        for particle in particles_list:
+            lines.append(json.dumps(get_particle_record(i, particle)))
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+    def save_image(self, i, image, particles_list, image_src=None):
+        self.write(i, image_src, particles_list)
+        if self.writer is not None:
+            self.writer.save_image(i, image, particles_list)
+
+    def save_file(self, i, image_src, particles_list, draw=True):
+        self.write(i, image_src, particles_list)
+        if self.writer is not None:
+            self.writer.save_file(i, image_src, particles_list, draw)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
 
 def draw_segment(image, point_a, point_b, color, thickness):
@@ -74,8 +180,8 @@ def draw_segment(image, point_a, point_b, color, thickness):
     #
     # --- Inputs ---
     #   image       : Numpy array, it is the image in which the segment is to be drawn
-    #   point_a     : Point object, starting point of the segment
-    #   point_b     : Point object, end point of the segment
+    #   point_a     : Coordinates (x, y) of the starting point of the segment
+    #   point_b     : Coordinates (x, y) of the end point of the segment
     #   color       : Tuple, color of the line segment in BGR
     #   thickness   : Integer value, thickness of the line segment in pixels
     #
@@ -83,10 +189,30 @@ def draw_segment(image, point_a, point_b, color, thickness):
     #   result      : Numpy array, image with the segment drawn on it
 
     result = image.copy()
-    result = cv2.line(result, (point_a.y, point_a.x), (point_b.y, point_b.x), color, thickness)
+    result = cv2.line(result, (int(point_a[1]), int(point_a[0])), (int(point_b[1]), int(point_b[0])), color, thickness)
     return result
 
 
+def draw_contours(image, contours, color, thickness):
+    # --- Method information ---
+    # draw_contours draws closed contours on an image, all at once and in place
+    #
+    # --- Inputs ---
+    #   image       : Numpy array, it is the image in which the contours are to be drawn, modified in place
+    #   contours    : List of Nx2 arrays of the coordinates (x, y) of the points of the contours
+    #   color       : Tuple, color of the contours
+    #   thickness   : Integer value, thickness of the contours in pixels
+    #
+    # --- Outputs ---
+    #   image       : Numpy array, the same image with the contours drawn on it
+
+    # OpenCV expects (column, row) integer coordinates, truncated as in draw_segment
+    polylines = [np.asarray(contour)[:, ::-1].astype(np.int32) for contour in contours if len(contour) > 0]
+    if len(polylines) > 0:
+        cv2.polylines(image, polylines, True, color, thickness)
+    return image
+
+
 def draw_particle_contour(image, particle, color, thickness):
     # --- Method information ---
     # draw_particle_contour is used to draw the contour of one particle on an image
@@ -100,16 +226,8 @@ def draw_particle_contour(image, particle, color, thickness):
     # --- Outputs ---
     #   result      : Numpy array, image with the contour drawn on it
 
-    contour = particle.contour
     result = image.copy()
-    n = len(contour)
-    if n > 0:
-        prev_point = contour[n - 1]
-        for i in range(0, n):
-            result = draw_segment(result, contour[i], prev_point, color, thickness)
-            prev_point = contour[i]
-
-    return result
+    return draw_contours(result, [particle.contour], color, thickness)
 
 
 def print_particles(image, particles_list):
@@ -124,6 +242,4 @@ def print_particles(image, particles_list):
     #   result      : Numpy array, image all contours drawn on it
 
     results = image.copy()
-    for obj in particles_list:
-        results = draw_particle_contour(results, obj, color=(255, 0, 0), thickness=2)
-    return results
+    return draw_contours(results, [obj.contour for obj in particles_list], color=(255, 0, 0), thickness=2)
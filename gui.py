@@ -1,11 +1,11 @@
+import copy
 import export
 import settings
-import matplotlib.pyplot as plt
 import cv2
 import tkinter as tk
 from PIL import ImageTk, Image
 from tkinter.filedialog import askopenfilename
-from analyseImage import preprocess, get_edges
+from preview import PreviewWorker
 
 global image_src, do_run_search
 
@@ -16,8 +16,10 @@ def open_window(image_src_list, settings_src):
     settings.do_run_search = False
 
     class Setting:
-        def __init__(self, frame, name, def_val, lim, step, style):
+        def __init__(self, frame, name, def_val, lim, step, style, on_change=None):
             self.value = def_val
+            # Function called when the value is changed with the widget, None for the 'def' style
+            self.on_change = on_change
             self.limits = lim
             self.step = step
             self.frm = frame
@@ -34,7 +36,7 @@ def open_window(image_src_list, settings_src):
             elif self.style == 'check_box':
                 self.value = bool(self.value)
                 self.boolVar = tk.BooleanVar()
-                self.check_box = tk.Checkbutton(master=self.frm, text=name, variable=self.boolVar, command=self.update)
+                self.check_box = tk.Checkbutton(master=self.frm, text=name, variable=self.boolVar, command=self.toggle)
             elif self.style == 'buttons':
                 self.value = int(self.value)
                 self.lbl_name = tk.Label(master=self.frm, text=name)
@@ -46,6 +48,14 @@ def open_window(image_src_list, settings_src):
                 self.lbl_value = tk.Entry(master=self.frm, justify='left', textvariable=self.value)
                 self.lbl_value.insert(0, self.value)
 
+        def changed(self):
+            if self.on_change is not None:
+                self.on_change()
+
+        def toggle(self):
+            self.update()
+            self.changed()
+
         def update_checkbox(self):
             self.value = self.boolVar.get()
 
@@ -79,18 +89,21 @@ def open_window(image_src_list, settings_src):
         def val(self, value):
             self.value = value
             self.lbl_value['text'] = f'{self.value}'
+            self.changed()
 
         def increase(self):
             value = int(self.lbl_value['text'])
             value += self.step
             self.value = min(max(value, self.limits[0]), self.limits[1])
             self.lbl_value['text'] = f'{self.value}'
+            self.changed()
 
         def decrease(self):
             value = int(self.lbl_value['text'])
             value -= self.step
             self.value = min(max(value, self.limits[0]), self.limits[1])
             self.lbl_value['text'] = f'{self.value}'
+            self.changed()
 
         def set_in_frame(self, row, col):
             if self.style == 'slider':
@@ -124,26 +137,30 @@ def open_window(image_src_list, settings_src):
         if not filepath:
             return
         image_src = filepath
-        image_bgr = cv2.imread(image_src)
-        cv2.imwrite('write.jpg', image_bgr)
-        image = Image.open('write.jpg')
-        resized_image = fit_image_to_canvas(image, canvas_image_0)
-        canvas_image_0.image = ImageTk.PhotoImage(resized_image)
-        canvas_image_0.create_image(0, 0, image=canvas_image_0.image, anchor='nw')
-        window.title(f'Image Editor - {filepath}')
-
-    def fit_image_to_canvas(image, canvas):
-        basewidth = int(canvas['width'])
-        baseheight = int(canvas['height'])
-        if (basewidth / float(image.size[0])) < (baseheight / float(image.size[1])):
-            wpercent = (basewidth / float(image.size[0]))
-            hsize = int((float(image.size[1]) * float(wpercent)))
-            resized_image = image.resize((basewidth, hsize), Image.ANTIALIAS)
-        else:
-            wpercent = (baseheight / float(image.size[1]))
-            hsize = int((float(image.size[0]) * float(wpercent)))
-            resized_image = image.resize((hsize, baseheight), Image.ANTIALIAS)
-        return resized_image
+        request_preview()
+
+    def request_preview():
+        # The image is decoded, preprocessed and its edges detected by the preview worker, in the background. Only
+        # the latest request is computed, once the settings stopped changing for a moment.
+        if 'image_src' not in globals():
+            return
+        srch_stgs = copy.deepcopy(apply_changes(search_settings))
+        preview_worker.submit(image_src, srch_stgs)
+        window.title(f'Image Editor - {image_src} (computing preview...)')
+
+    def poll_preview():
+        # The window is only updated from the thread of the main loop, which checks for a new preview periodically
+        result = preview_worker.get_result()
+        if result is not None:
+            preview, error = result
+            if error is not None:
+                window.title(f'Image Editor - {image_src} (error: {error})')
+            else:
+                canvas_image_0.image = ImageTk.PhotoImage(Image.fromarray(preview))
+                canvas_image_0.delete('all')
+                canvas_image_0.create_image(0, 0, image=canvas_image_0.image, anchor='nw')
+                window.title(f'Image Editor - {image_src}')
+        window.after(50, poll_preview)
 
     def start_search():
         settings.do_run_search = True
@@ -175,24 +192,9 @@ def open_window(image_src_list, settings_src):
         return srch_stgs
 
     def apply_and_analyze():
-        global image_src
-        _ = apply_changes(search_settings)
-
-        if 'image_src' in globals():
-            image_bgr = cv2.imread(image_src)
-            image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-            image, img, scale_factor = preprocess(image_rgb, search_settings)
-
-            # Obtain edges map at full scale and rescaled
-            edges = get_edges(image, search_settings.edges_para.gauss_1, search_settings.edges_para.thresh1_1,
-                              search_settings.edges_para.thresh2_1)
-            edg = get_edges(img, search_settings.edges_para.gauss_2, search_settings.edges_para.thresh1_2,
-                            search_settings.edges_para.thresh2_2)
-
-            display(image, 1)
-            display(edges, 2)
-            display(edg, 3)
-            plt.show()
+        # The preview shows the 1D image with the edges of the full scale image in red, and those of the downsized
+        # image in green
+        request_preview()
 
     def retrieve_settings(srch_stgs):
         settings_list[0].value = srch_stgs.edges_para.gauss_1
@@ -248,7 +250,6 @@ def open_window(image_src_list, settings_src):
 
     search_settings_list = export.open_data(settings_src)
     search_settings = settings.Search(r=200, n=1, use_color_differences=False)
-    image_src = ''
     window = tk.Tk()
     window.title('Play with settings')
 
@@ -275,6 +276,7 @@ def open_window(image_src_list, settings_src):
     btn_load_settings = tk.Button(frm_buttons, text='Load from selected', command=retrieve_settings_to_current)
 
     canvas_image_0 = tk.Canvas(frm_image, width=700, height=700)
+    preview_worker = PreviewWorker((700, 700))
 
     # Listbox creation for all search settings
     search_listbox = tk.Listbox(frm_buttons, height=6, listvariable=search_settings_list)
@@ -320,6 +322,10 @@ def open_window(image_src_list, settings_src):
         Setting(frm_search, 'Number of search iterations', search_settings.iterations, (0, 20), [], style='def')
     ]
 
+    # The preview is updated when a setting of the preprocessing or of the edges detection is changed
+    for setting in settings_list[:10]:
+        setting.on_change = request_preview
+
     settings_list[0].set_in_frame(row=0, col=0)
     settings_list[1].set_in_frame(row=1, col=0)
     settings_list[2].set_in_frame(row=2, col=0)
@@ -335,42 +341,19 @@ def open_window(image_src_list, settings_src):
     settings_list[12].set_in_frame(row=2, col=0)
     settings_list[13].set_in_frame(row=3, col=0)
 
+    window.after(50, poll_preview)
     window.mainloop()
+    preview_worker.close()
 
     return image_src_list, search_settings_list
 
 
 def display(image, i):
+    # matplotlib is only imported when a figure is displayed
+    import matplotlib.pyplot as plt
     plt.figure(i)
     plt.imshow(image)
 
 
-def draw_segment(image, point_a, point_b, color, thickness):
-    result = image.copy()
-    result = cv2.line(result, (point_a.y, point_a.x), (point_b.y, point_b.x), color, thickness)
-    return result
-
-
-def draw_particle_contour(image, particle, color, thickness):
-    contour = particle.contour
-    result = image.copy()
-    n = len(contour)
-    if n > 0:
-        prev_point = contour[n - 1]
-        for i in range(0, n):
-            result = draw_segment(result, contour[i], prev_point, color, thickness)
-            prev_point = contour[i]
-
-    return result
-
-
 def display_channel(title, image, channel):
     cv2.imshow(title, image[:, :, channel])
-
-
-def print_particles(image, particles_list):
-    results = image.copy()
-    for obj in particles_list:
-        results = draw_particle_contour(results, obj, color=(255, 0, 0), thickness=2)
-
-    return results
@@ -0,0 +1,129 @@
+import math
+import numpy as np
+
+# The kernels below are compiled by numba when it is installed. Otherwise, the NumPy versions written in the modules
+# of the program are used, which give the same results.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# Boolean variable, whether the compiled kernels are used. It can be set to False to use the NumPy versions.
+use_jit = njit is not None
+
+
+def ellipse_loop(size, x_displace, y_displace, x_moy, y_moy, sharp, radius, is_sharp):
+    # --- Method information ---
+    # ellipse_loop computes the image of a diffused ellipse pixel by pixel, as create_ellipse() of matchObject
+    #
+    # --- Inputs ---
+    #   size        : Tuple of integers, size of the image to be created, as given to create_ellipse()
+    #   x_displace  : Float, displacement of the ellipse along the columns
+    #   y_displace  : Float, displacement of the ellipse along the rows
+    #   x_moy       : Float, half of the diagonal of the ellipse along the columns
+    #   y_moy       : Float, half of the diagonal of the ellipse along the rows
+    #   sharp       : Float, (1 - sharpness) ** 2
+    #   radius      : Float, radius of the perfectly sharp ellipse
+    #   is_sharp    : Boolean variable, whether the ellipse is perfectly sharp
+    #
+    # --- Outputs ---
+    #   mask    : Numpy array, image of the created ellipse
+
+    # The squares are written as products, as computed by NumPy
+    mask = np.empty((size[1], size[0]))
+    for i in range(0, size[1]):
+        dy = (i - y_displace + 0.5 - y_moy) / y_moy
+        for j in range(0, size[0]):
+            dx = (j - x_displace + 0.5 - x_moy) / x_moy
+            dist = math.sqrt(dx * dx + dy * dy)
+            if not is_sharp:
+                mask[i, j] = sharp / ((dist - 1) * (dist - 1) + sharp)
+            elif radius - 1 <= radius * dist <= radius + 0.5:
+                mask[i, j] = 1.0
+            else:
+                mask[i, j] = 0.0
+    return mask
+
+
+def ray_maxima_loop(grid, start_x, start_y, offsets_x, offsets_y):
+    # --- Method information ---
+    # ray_maxima_loop finds the first of the highest valued pixels along each ray, as sample_ray_pixels() followed by
+    # an argmax in find_radial_edges() of constructContour. The rays are followed one pixel at a time, none of the
+    # pixels sampled being stored.
+    #
+    # --- Inputs ---
+    #   grid        : Numpy array containing the values to be checked
+    #   start_x     : Float, x coordinate of the starting point of the rays
+    #   start_y     : Float, y coordinate of the starting point of the rays
+    #   offsets_x   : Numpy array of the x offsets, one row per ray, see get_ray_offsets()
+    #   offsets_y   : Numpy array of the y offsets, same shape as offsets_x
+    #
+    # --- Outputs ---
+    #   best_x      : Numpy array of integers, x coordinate of the best pixel of each ray
+    #   best_y      : Numpy array of integers, y coordinate of the best pixel of each ray
+    #   best_values : Numpy array, value of these pixels, -inf for the rays which do not reach any pixel
+
+    n, nb_samples = offsets_x.shape
+    best_x = np.empty(n, dtype=np.int64)
+    best_y = np.empty(n, dtype=np.int64)
+    best_values = np.full(n, -np.inf)
+    # A ray starting outside the grid does not reach any pixel
+    start_inside = 0 <= np.rint(start_x) < grid.shape[0] and 0 <= np.rint(start_y) < grid.shape[1]
+    for i in range(0, n):
+        best = 0
+        for k in range(0, nb_samples if start_inside else 0):
+            pix_x = int(np.rint(start_x + offsets_x[i, k]))
+            pix_y = int(np.rint(start_y + offsets_y[i, k]))
+            # The ray stops at the first pixel outside the grid
+            if not (0 <= pix_x < grid.shape[0] and 0 <= pix_y < grid.shape[1]):
+                break
+            value = float(grid[pix_x, pix_y])
+            if value > best_values[i]:
+                best_values[i] = value
+                best = k
+        best_x[i] = int(np.rint(start_x + offsets_x[i, best]))
+        best_y[i] = int(np.rint(start_y + offsets_y[i, best]))
+    return best_x, best_y, best_values
+
+
+def dominant_color_loop(image):
+    # --- Method information ---
+    # dominant_color_loop finds the dominant color of each pixel pixel by pixel, as get_dominant_color() of
+    # analyseImage
+    #
+    # --- Inputs ---
+    #   image   : Numpy array, image with several values per pixel
+    #
+    # --- Outputs ---
+    #   result  : Numpy array, index of the highest value of each pixel (0 where all the values are 0)
+    #   counts  : Numpy array of integers, number of pixels of each dominant color
+
+    result = np.zeros((image.shape[0], image.shape[1]))
+    counts = np.zeros(image.shape[2], dtype=np.int64)
+    for i in range(0, image.shape[0]):
+        for j in range(0, image.shape[1]):
+            maximum = 0
+            color = 0
+            for k in range(0, image.shape[2]):
+                if image[i, j, k] > maximum:
+                    maximum = image[i, j, k]
+                    color = k
+            result[i, j] = color
+            counts[color] += 1
+    return result, counts
+
+
+# Compiled kernels, keyed by name, compiled at their first call
+KERNELS = {}
+if njit is not None:
+    for kernel_name, kernel in [('ellipse', ellipse_loop), ('ray_maxima', ray_maxima_loop),
+                                ('dominant_color', dominant_color_loop)]:
+        KERNELS[kernel_name] = njit(cache=True, nogil=True)(kernel)
+
+
+def get_kernel(name):
+    # get_kernel returns the compiled kernel of a name, or None if numba is not installed or use_jit is False
+    if not use_jit:
+        return None
+    return KERNELS.get(name)
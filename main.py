@@ -1,40 +1,41 @@
-import cv2
+import os
 import export
-import gui
 import settings
 
-from analyseContour import append_particle, Particle, get_radial_standard_deviation
-from analyseImage import analyse
+from analyseContour import Particle, get_radial_standard_deviation
+from batch import search_images
 from classes import Point
 from constructContour import scale_points
+from matchObject import template_bank
+from resultCache import ResultCache
+from resultsStore import ResultsStore
+from tracing import tracer
+from tracking import track_sequence
 
 
 def search():
-    for i in range(0, len(image_src_list)):
-        print(f'Starting search on image "{image_src_list[i]}". ({i + 1} / {len(image_src_list)})')
-        # Load image and convert to grayscale
-        image_bgr = cv2.imread(image_src_list[i])
-        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-        image_list.append(image_rgb)
-
-        # Initialize the list of particles to be found in the loaded image
-        particles_img = []
-
-        for j in range(0, len(search_settings_list)):
-            # Initialize the particles list for this search in the image
-            particles = []
-            print(f'Looking for particles with r={search_settings_list[j].searched_radius}')
-
-            particles = analyse(image_rgb, particles, search_settings_list[j])
-
-            print(f'Found {len(particles)} particles.')
-            print('')
-
-            for particle in particles:
-                # Add particle object particles list of this image, if particle is valid
-                particles_img, _ = append_particle(particles_img, particle, search_settings_list[j])
-
-        particles_list.append(particles_img)
+    if trace_src is not None:
+        tracer.enable()
+
+    # Reuse the templates built by previous runs, if any
+    if templates_src is not None and os.path.exists(templates_src):
+        template_bank.load(templates_src)
+
+    # Run every search on every image, possibly in parallel.
+    # The particles of each image are saved in the results store as soon as the image is done.
+    # The particles of the (image, search) pairs already run are loaded from the result cache.
+    store = ResultsStore(results_src, 'w')
+    result_cache = None
+    if cache_src is not None:
+        result_cache = ResultCache(cache_src, cache_size)
+    # The contours are drawn on the images in the background, while the next images are analysed.
+    writer = export.OverlayWriter(images_src)
+    if is_sequence:
+        # Each frame is seeded by the particles of the previous one, only the regions which changed are searched
+        particles_list.extend(track_sequence(image_src_list, search_settings_list, store, writer))
+    else:
+        particles_list.extend(search_images(image_src_list, search_settings_list, workers, templates_src,
+                                            tile_size, store, result_cache, writer))
 
     # Get the average radius of all the particles in calibration images
     particle_count = 0
@@ -68,17 +69,21 @@ def search():
                 f'r = {r}, c = {c}, sd = {sd}'
                 f', position : x = {pos_x}, y = {pos_y}')
 
-    # Save data in files
-    data = export.convert_particles_data(particles_list)
-    export.save_data(data, data_src)
-    export.save_particles_to_images(image_list, particles_list, images_src)
+    # Wait for the images to be saved
+    writer.close()
+    if templates_src is not None:
+        template_bank.save(templates_src)
+
+    # Save the time spent in each stage of the search, to be viewed in a trace viewer
+    if trace_src is not None:
+        tracer.save(trace_src)
+        tracer.print_summary()
 
 
 settings.init()             # Run this to initiate the do_run_search global variable
 particles_list = []         # Initialize the list of particles
 image_src_list = []         # Initialize the list image sources
 search_settings_list = []   # Initialize the list of search settings
-image_list = []             # Initialize the list of images
 
 # -*- USER MANUAL -*-
 #
@@ -104,12 +109,16 @@ image_list = []             # Initialize the list of images
 #              Apply button after having opened the image in the gui.
 #           d. There are more settings that can be modified directly from the settings.py module.
 #
-#   5. When the program will be done, all the particles found will be saved as a list of particle objects
-#      in the data.dat file in Current_Search.
+#   5. When the program will be done, all the particles found will be saved in the results folder in Current_Search,
+#      see resultsStore.py. They can be loaded with ResultsStore('Current_Search/results').get_particles(), for all
+#      the images or for one image at a time. Results saved as a list of particle objects by older versions of the
+#      program (data.dat file) can be converted with resultsStore.import_pickle.
 #
 #   If you do not want to use the gui, you can comment out the line where the gui.open_window() is called.
 #   Then, you will need to create the search_settings_list yourself by appending and modifying Search objects as
 #   shown below.
+#
+#   The searches can also be run from the command line, without the gui, see cli.py (python cli.py --help).
 
 
 image_src_list.append('Photos/Air_Soft_1.jpg')
@@ -118,6 +127,16 @@ image_src_list.append('Photos/Air_Soft_1.jpg')
 # image_src_list.append('Photos/Verre_Large_2.jpg')
 # image_src_list.append('Photos/Verre_Small_1.jpg')
 
+# Number of processes used to analyse the images in parallel (1 to analyse them one after the other)
+workers = 1
+# Size of the tiles in which very large images are analysed, to limit the memory used (0 to analyse images as a whole).
+# Images saved as .npy files are read tile by tile from the disk, see analyseTiles.py.
+# The contours are not drawn on the images searched by tiles, which would have to be held in memory as a whole.
+tile_size = 0
+# Whether the images are the frames of a sequence (time-lapse) of the same particles, see tracking.py. The particles
+# then get a track identifier, kept from frame to frame. image_src_list may also be replaced by the source of a video.
+is_sequence = False
+
 calibration_image_index = [0]
 calibration_particle_radius = 100
 
@@ -131,11 +150,20 @@ search_settings_list.append(settings.Search(r=135, n=1, use_color_differences=Fa
 # search_settings_list.append(settings.Search(r=130, n=3, use_color_differences=True))
 
 settings_src = 'Current_Search/settings'
-data_src = 'Current_Search/data'
+results_src = 'Current_Search/results'
 images_src = 'Current_Search/images'
-image_src_list, search_settings_list = gui.open_window(image_src_list, settings_src)
-# NOTE : To disable the gui, comment the line above and be sure to specify the search settings in
-# search_settings_list.
-
-if settings.do_run_search:
-    search()
+templates_src = 'Current_Search/templates'     # Set to None to rebuild the search templates on every run
+cache_src = 'Current_Search/cache'             # Set to None to run every search again on every image
+cache_size = 1 << 30                           # Maximum size of the result cache in bytes
+trace_src = None                               # Set to a file such as 'Current_Search/trace.json' to record the
+                                               # time spent in each stage of the search
+# The lines below only run when main is the program started, not when its module is imported by a worker process
+if __name__ == '__main__':
+    # The gui (tkinter, PIL) is only imported when the window is opened. See cli.py to run searches without it.
+    import gui
+    image_src_list, search_settings_list = gui.open_window(image_src_list, settings_src)
+    # NOTE : To disable the gui, comment the line above and be sure to specify the search settings in
+    # search_settings_list.
+
+    if settings.do_run_search:
+        search()
@@ -1,6 +1,12 @@
+import cv2
 import math
+import pickle
 import numpy as np
-from skimage.feature import match_template
+
+from collections import OrderedDict
+from kernels import get_kernel
+from optimisation import find_peaks
+from tracing import tracer
 
 
 def create_ellipse(size, diagonals, sharpness):
@@ -15,60 +21,403 @@ def create_ellipse(size, diagonals, sharpness):
     # --- Outputs ---
     #   mask    : Numpy array, image of the created ellipse
 
-    mask = np.zeros((size[1], size[0]))
     x_moy = diagonals[0] / 2
     y_moy = diagonals[1] / 2
     x_displace = (size[0] - diagonals[0]) / 2
     y_displace = (size[1] - diagonals[1]) / 2
     radius = math.sqrt(x_moy**2 + y_moy**2)
     sharp = (1 - sharpness) ** 2
-    for i in range(0, size[1]):
-        for j in range(0, size[0]):
-            dist = math.sqrt(((j - x_displace + 0.5 - x_moy) / x_moy) ** 2 + ((i - y_displace + 0.5 - y_moy) / y_moy) ** 2)
-            if sharpness != 1:
-                mask[i][j] = sharp / ((dist - 1) ** 2 + sharp)
-            else:
-                if (radius*dist <= radius+0.5) & (radius*dist >= radius-1):
-                    mask[i][j] = 1
+    kernel = get_kernel('ellipse')
+    if kernel is not None:
+        return kernel(tuple(int(k) for k in size), x_displace, y_displace, x_moy, y_moy, sharp, radius, sharpness == 1)
+    # Normalized distance of every pixel to the center of the ellipse, computed for all pixels at once
+    i = np.arange(size[1]).reshape(-1, 1)
+    j = np.arange(size[0]).reshape(1, -1)
+    dist = np.sqrt(((j - x_displace + 0.5 - x_moy) / x_moy) ** 2 + ((i - y_displace + 0.5 - y_moy) / y_moy) ** 2)
+    if sharpness != 1:
+        mask = sharp / ((dist - 1) ** 2 + sharp)
+    else:
+        mask = ((radius*dist <= radius+0.5) & (radius*dist >= radius-1)).astype(float)
     return mask
 
 
+class TemplateBank:
+    def __init__(self, max_size=32):
+        # Maximum number of templates kept in the bank, the least recently used ones are discarded first
+        self.max_size = max_size
+        # Ordered dictionary of (mask, threshold) tuples, keyed by (size, diagonals, sharpness)
+        self.templates = OrderedDict()
+
+    def get_template(self, size, diagonals, sharpness):
+        # --- Method information ---
+        # get_template returns the ellipse mask created by create_ellipse for the specified arguments, along with
+        # the self-match threshold of this mask (its correlation with a perfectly sharp ellipse of the same size).
+        # Both are only computed the first time they are asked for.
+        #
+        # --- Inputs ---
+        #   size        : 2x1 list of integers, size of the image to be created
+        #   diagonals   : 2x1 list of integers, length of the diagonals of the ellipse
+        #   sharpness   : Float, sharpness of the ellipse, value between 0 and 1, where 1 is perfectly sharp
+        #
+        # --- Outputs ---
+        #   mask        : Numpy array, read-only image of the created ellipse
+        #   threshold   : Float, correlation between the mask and a perfectly sharp ellipse
+
+        key = (tuple(int(k) for k in size), tuple(int(k) for k in diagonals), float(sharpness))
+        if key in self.templates:
+            self.templates.move_to_end(key)
+        else:
+            with tracer.span('template'):
+                mask = create_ellipse(size, diagonals, sharpness)
+                mask.setflags(write=False)
+                perfect_circle = create_ellipse(size, diagonals, 1)
+                threshold = float(CorrelationEngine(perfect_circle).match_template(mask)[0, 0])
+            self.templates[key] = (mask, threshold)
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return self.templates[key]
+
+    def save(self, filename):
+        # save saves the templates of the bank into a file, to be reused by a later run
+        with open(filename, 'wb') as output_file:
+            pickle.dump(list(self.templates.items()), output_file)
+
+    def load(self, filename):
+        # load adds the templates previously saved in a file to the bank
+        with open(filename, 'rb') as input_file:
+            for key, (mask, threshold) in pickle.load(input_file):
+                mask.setflags(write=False)
+                self.templates[key] = (mask, threshold)
+        while len(self.templates) > self.max_size:
+            self.templates.popitem(last=False)
+
+
+# Templates shared by all the searches of the program
+template_bank = TemplateBank()
+
+
 def binarize(image, threshold):
     # This method is not used in the program
 
-    dimensions = np.shape(image)
-    for i in range(0, dimensions[0]):
-        for j in range(0, dimensions[1]):
-            if image[i][j] > threshold:
-                image[i][j] = 1
-            else:
-                image[i][j] = 0
+    # The pixels above the threshold are set to 1 and the others to 0, in place
+    image[...] = image > threshold
     return image
 
 
-def match_template_full(img, obj):
+class CorrelationEngine:
+    def __init__(self, image, direct_max_area=121):
+        # Image in which templates are looked for, as a float array
+        self.image = np.asarray(image, dtype=np.float64)
+        # Templates with at most this number of pixels are correlated directly, larger ones through the DFT
+        self.direct_max_area = direct_max_area
+        # Summed-area tables of the image and of its square, used for the local means and variances
+        self.sum_table = None
+        self.sum_table_2 = None
+        # Fourier transform of the image, zero-padded to an efficient size, computed only once
+        self.spectrum = None
+        # CorrelationEngine object of the image reduced by half, next level of the pyramid, created when first needed
+        self.coarser = None
+
+    def get_coarser(self):
+        # get_coarser returns the CorrelationEngine object of the next level of the Gaussian pyramid of the image
+        if self.coarser is None:
+            self.coarser = CorrelationEngine(cv2.pyrDown(self.image), self.direct_max_area)
+        return self.coarser
+
+    def get_window_sums(self, shape):
+        # --- Method information ---
+        # get_window_sums returns the sum of the image values, and of their squares, over every window of a given
+        # shape fully contained in the image
+        #
+        # --- Inputs ---
+        #   shape   : 2x1 tuple of integers, shape of the windows
+        #
+        # --- Outputs ---
+        #   window_sum  : Numpy array, sum of the values in each window
+        #   window_sum_2: Numpy array, sum of the squared values in each window
+
+        if self.sum_table is None:
+            dim = np.shape(self.image)
+            self.sum_table = np.zeros((dim[0] + 1, dim[1] + 1))
+            self.sum_table_2 = np.zeros((dim[0] + 1, dim[1] + 1))
+            self.sum_table[1:, 1:] = np.cumsum(np.cumsum(self.image, axis=0), axis=1)
+            self.sum_table_2[1:, 1:] = np.cumsum(np.cumsum(self.image ** 2, axis=0), axis=1)
+
+        sums = []
+        for table in (self.sum_table, self.sum_table_2):
+            sums.append(table[shape[0]:, shape[1]:] - table[:-shape[0], shape[1]:]
+                        - table[shape[0]:, :-shape[1]] + table[:-shape[0], :-shape[1]])
+        return sums[0], sums[1]
+
+    def correlate(self, template):
+        # --- Method information ---
+        # correlate returns the cross-correlation between the image and a template, for every position of the
+        # template fully contained in the image. Small templates are correlated directly, larger ones by a product of
+        # spectra, where the spectrum of the image is reused for all the templates.
+        #
+        # --- Inputs ---
+        #   template: Numpy array, 1D image smaller than the image
+        #
+        # --- Outputs ---
+        #   xcorr   : Numpy array, of the size of the image minus the size of the template plus one
+
+        dim_img = np.shape(self.image)
+        dim_obj = np.shape(template)
+        dim_res = (dim_img[0] - dim_obj[0] + 1, dim_img[1] - dim_obj[1] + 1)
+
+        if template.size <= self.direct_max_area:
+            # filter2D computes a correlation, anchored on the top left corner of the template
+            xcorr = cv2.filter2D(self.image, cv2.CV_64F, template, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)
+            return xcorr[:dim_res[0], :dim_res[1]]
+
+        # Padding the image to its own size is enough: the circular wrap only spoils the positions where the
+        # template is not fully contained in the image.
+        if self.spectrum is None:
+            dft_size = (cv2.getOptimalDFTSize(dim_img[0]), cv2.getOptimalDFTSize(dim_img[1]))
+            padded = np.zeros(dft_size)
+            padded[:dim_img[0], :dim_img[1]] = self.image
+            self.spectrum = cv2.dft(padded, flags=cv2.DFT_COMPLEX_OUTPUT)
+        dft_size = np.shape(self.spectrum)[:2]
+        padded = np.zeros(dft_size)
+        padded[:dim_obj[0], :dim_obj[1]] = template[::-1, ::-1]
+        template_spectrum = cv2.dft(padded, flags=cv2.DFT_COMPLEX_OUTPUT, nonzeroRows=dim_obj[0])
+        conv = cv2.idft(cv2.mulSpectrums(self.spectrum, template_spectrum, 0),
+                        flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        return conv[dim_obj[0] - 1:dim_img[0], dim_obj[1] - 1:dim_img[1]]
+
+    def match_template(self, template):
+        # --- Method information ---
+        # match_template computes the normalized cross-correlation between the image and a template, for every
+        # position of the template fully contained in the image (same result as skimage's match_template)
+        #
+        # --- Inputs ---
+        #   template: Numpy array, 1D image smaller than the image
+        #
+        # --- Outputs ---
+        #   response: Numpy array, values between -1 and 1, where 1 is a perfect match
+
+        template = np.asarray(template, dtype=np.float64)
+        dim_img = np.shape(self.image)
+        dim_obj = np.shape(template)
+        if dim_obj[0] > dim_img[0] or dim_obj[1] > dim_img[1]:
+            raise ValueError('Image must be larger than template.')
+
+        template_mean = template.mean()
+        template_volume = template.size
+        template_ssd = np.sum((template - template_mean) ** 2)
+
+        window_sum, window_sum_2 = self.get_window_sums(dim_obj)
+        numerator = self.correlate(template) - window_sum * template_mean
+        denominator = (window_sum_2 - window_sum ** 2 / template_volume) * template_ssd
+        np.maximum(denominator, 0, out=denominator)
+        np.sqrt(denominator, out=denominator)
+
+        response = np.zeros(np.shape(numerator))
+        mask = denominator > np.finfo(np.float64).eps
+        response[mask] = numerator[mask] / denominator[mask]
+        return response
+
+    def match_window(self, template, top, left, size):
+        # --- Method information ---
+        # match_window computes the normalized cross-correlation of match_template only for the positions of a window,
+        # from the part of the image covered by the template at those positions
+        #
+        # --- Inputs ---
+        #   template: Numpy array, 1D image smaller than the image
+        #   top     : Integer, first row of the positions (of the top left corner of the template)
+        #   left    : Integer, first column of the positions
+        #   size    : 2x1 tuple of integers, number of rows and columns of the window
+        #
+        # --- Outputs ---
+        #   response: Numpy array, response for the positions of the window contained in the image
+        #   corner  : 2x1 tuple of integers, position of the first value of the response
+
+        dim_img = np.shape(self.image)
+        dim_obj = np.shape(template)
+        min_x = min(max(top, 0), dim_img[0] - dim_obj[0])
+        min_y = min(max(left, 0), dim_img[1] - dim_obj[1])
+        max_x = max(min(top + size[0], dim_img[0] - dim_obj[0] + 1), min_x + 1)
+        max_y = max(min(left + size[1], dim_img[1] - dim_obj[1] + 1), min_y + 1)
+        window = self.image[min_x:max_x + dim_obj[0] - 1, min_y:max_y + dim_obj[1] - 1]
+        return CorrelationEngine(window, self.direct_max_area).match_template(template), (min_x, min_y)
+
+
+def get_pyramid_levels(size, pyramid_size):
+    # get_pyramid_levels returns the number of times a template can be reduced by half keeping at least pyramid_size
+    return max(0, int(math.floor(math.log2(max(size, 1) / pyramid_size))))
+
+
+def match_template_pyramid(engine, get_mask, nb_levels, min_distance, threshold, coarse_threshold, max_peaks=0,
+                           search=2):
+    # --- Method information ---
+    # match_template_pyramid finds the positions matching a template coarse-to-fine : the candidates are the maxima of
+    # the correlation at the coarsest level of the Gaussian pyramid of the image, where the template is small, then
+    # the position of each candidate is refined in a small window at every finer level. Only the candidates whose
+    # correlation at full scale is above the threshold are kept. Maxima closer than min_distance are suppressed, the
+    # best ones come first, as in find_peaks().
+    #
+    # --- Inputs ---
+    #   engine          : CorrelationEngine object of the image
+    #   get_mask        : Function returning the (mask, threshold) tuple of the template for a level of the pyramid
+    #   nb_levels       : Integer, number of levels above the image, see get_pyramid_levels()
+    #   min_distance    : Integer, suppression distance between maxima at full scale
+    #   threshold       : Float, minimal correlation at full scale
+    #   coarse_threshold: Float, minimal correlation at the coarsest level, relative to the threshold of get_mask
+    #   max_peaks       : Integer, maximum number of maxima to return, the best ones are kept (0 for no limit)
+    #   search          : Integer, number of pixels checked in each direction when refining a position
+    #
+    # --- Outputs ---
+    #   rows    : Numpy array of integers, row index of the center of the template at the maxima, best first
+    #   cols    : Numpy array of integers, column index of the maxima, in the same order
+    #   scores  : Numpy array, correlation at the maxima, in the same order
+
+    engines = [engine]
+    mask, mask_threshold = get_mask(0)
+    masks = [mask]
+    for level in range(1, nb_levels + 1):
+        coarser = engines[-1].get_coarser()
+        mask, level_threshold = get_mask(level)
+        if mask.shape[0] > coarser.image.shape[0] or mask.shape[1] > coarser.image.shape[1]:
+            break
+        engines.append(coarser)
+        masks.append(mask)
+        mask_threshold = level_threshold
+    nb_levels = len(engines) - 1
+
+    # Candidates at the coarsest level
+    grid = match_template_full(engines[-1].image, masks[-1], engines[-1])
+    rows, cols, _ = find_peaks(grid, max(1, min_distance >> nb_levels), coarse_threshold * mask_threshold)
+
+    # Refinement of every candidate down to full scale, the positions being those of the center of the template
+    maxima = []
+    for row, col in zip(rows, cols):
+        center = (int(row), int(col))
+        score = grid[row, col]
+        for level in range(nb_levels - 1, -1, -1):
+            border = (masks[level].shape[0] // 2, masks[level].shape[1] // 2)
+            response, corner = engines[level].match_window(
+                masks[level], 2 * center[0] - border[0] - search, 2 * center[1] - border[1] - search,
+                (2 * search + 1, 2 * search + 1))
+            best = np.unravel_index(np.argmax(response), response.shape)
+            center = (corner[0] + int(best[0]) + border[0], corner[1] + int(best[1]) + border[1])
+            score = response[best]
+        if score >= threshold:
+            maxima.append((score, center[0], center[1]))
+
+    maxima = np.array(maxima).reshape(-1, 3)
+    return suppress_maxima(maxima[:, 1].astype(int), maxima[:, 2].astype(int), maxima[:, 0], min_distance, max_peaks)
+
+
+def suppress_maxima(rows, cols, scores, min_distance, max_peaks=0):
+    # --- Method information ---
+    # suppress_maxima keeps the best of a few candidate maxima, removing every candidate closer than min_distance (in
+    # both directions) to a better one kept. The candidates are sorted into cells of the size of the suppression
+    # distance, such that each of them is only compared to those kept in the neighbouring cells.
+    #
+    # --- Inputs ---
+    #   rows        : Numpy array of integers, row index of the candidates
+    #   cols        : Numpy array of integers, column index of the candidates
+    #   scores      : Numpy array, score of the candidates
+    #   min_distance: Integer, suppression distance
+    #   max_peaks   : Integer, maximum number of maxima to return, the best ones are kept (0 for no limit)
+    #
+    # --- Outputs ---
+    #   rows    : Numpy array of integers, row index of the maxima, best first
+    #   cols    : Numpy array of integers, column index of the maxima, in the same order
+    #   scores  : Numpy array, score of the maxima, in the same order
+
+    cell_size = min_distance + 1
+    cells = {}
+    kept = []
+    for k in np.argsort(-scores, kind='stable'):
+        row, col = int(rows[k]), int(cols[k])
+        cell = (row // cell_size, col // cell_size)
+        neighbours = (cells.get((cell[0] + i, cell[1] + j), []) for i in (-1, 0, 1) for j in (-1, 0, 1))
+        if any(abs(row - rows[m]) <= min_distance and abs(col - cols[m]) <= min_distance
+               for cell_kept in neighbours for m in cell_kept):
+            continue
+        cells.setdefault(cell, []).append(k)
+        kept.append(k)
+        if 0 < max_peaks <= len(kept):
+            break
+    kept = np.array(kept, dtype=int)
+    return rows[kept], cols[kept], scores[kept]
+
+
+def find_circles_hough(edges, image, radius, radius_tol, min_distance, threshold, max_peaks=0):
+    # --- Method information ---
+    # find_circles_hough finds the centers of circles with a gradient-directed Hough transform : every edge pixel
+    # votes for the points located along the direction of the gradient of the image, on both sides, at every distance
+    # of the radius range. Only the edge pixels are processed, such that the cost depends on the number of edge pixels
+    # rather than on the size of the image. The votes of each center are normalized by the circumference of the circle,
+    # a score of 1 meaning that the whole circumference of a circle was found in the edges map.
+    #
+    # --- Inputs ---
+    #   edges       : Numpy array, edges map, where non-zero pixels are edges
+    #   image       : Numpy array, 1D image from which the edges map was obtained, used for the gradient direction
+    #   radius      : Float, radius of the circles in pixels
+    #   radius_tol  : Float, relative tolerance on the radius, the radius range is radius * (1 +/- radius_tol)
+    #   min_distance: Integer, suppression distance between centers
+    #   threshold   : Float, minimal score of a center
+    #   max_peaks   : Integer, maximum number of centers to return, the best ones are kept (0 for no limit)
+    #
+    # --- Outputs ---
+    #   rows    : Numpy array of integers, row index of the centers, best first
+    #   cols    : Numpy array of integers, column index of the centers, in the same order
+    #   scores  : Numpy array, score of the centers, in the same order
+
+    dim = np.shape(edges)
+    rows, cols = np.nonzero(edges)
+    image = np.asarray(image, dtype=np.float32)
+    # Rows are the first axis of the image, that is the y axis of the Sobel operator
+    grad_rows = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)[rows, cols]
+    grad_cols = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)[rows, cols]
+    norm = np.sqrt(grad_rows ** 2 + grad_cols ** 2)
+    valid = norm > 0
+    rows, cols = rows[valid], cols[valid]
+    unit_rows, unit_cols = grad_rows[valid] / norm[valid], grad_cols[valid] / norm[valid]
+
+    radii = np.arange(max(1, math.floor(radius * (1 - radius_tol))), math.ceil(radius * (1 + radius_tol)) + 1)
+    accumulator = np.zeros(dim[0] * dim[1])
+    for sign in (1, -1):
+        center_rows = np.rint(rows + sign * radii[:, None] * unit_rows).astype(np.int64)
+        center_cols = np.rint(cols + sign * radii[:, None] * unit_cols).astype(np.int64)
+        inside = (center_rows >= 0) & (center_rows < dim[0]) & (center_cols >= 0) & (center_cols < dim[1])
+        accumulator += np.bincount(center_rows[inside] * dim[1] + center_cols[inside], minlength=dim[0] * dim[1])
+
+    # The votes of a center are spread by the discretization and by the error on the direction of the gradient (about
+    # a degree), which grows with the radius. They are gathered over neighbourhoods of the size of this spread.
+    size = 2 * max(1, round(0.01 * radius)) + 1
+    accumulator = cv2.boxFilter(accumulator.reshape(dim), -1, (size, size), normalize=False,
+                                borderType=cv2.BORDER_CONSTANT)
+    accumulator /= 2 * math.pi * radius
+    # Only the few centers above the threshold are candidates, each of them being a maximum of its neighbourhood
+    dilated = cv2.dilate(accumulator, np.ones((3, 3), np.uint8))
+    rows, cols = np.nonzero((accumulator >= threshold) & (accumulator >= dilated))
+    return suppress_maxima(rows, cols, accumulator[rows, cols], min_distance, max_peaks)
+
+
+def match_template_full(img, obj, engine=None):
     # --- Method information ---
     # match_template_full runs the match_template method with an image and a specified object,
     # but also fills in the sides of the returned image such that the size matches that of the original image
     #
     # --- Inputs ---
-    #   img : Numpy array, 1D image in which to look for matches
-    #   obj : Numpy array, 1D image of the object to use as a reference for finding matches
+    #   img     : Numpy array, 1D image in which to look for matches
+    #   obj     : Numpy array, 1D image of the object to use as a reference for finding matches
+    #   engine  : CorrelationEngine object of img, to reuse its cached spectrum, created if not specified
     #
     # --- Outputs ---
     #   grid: Numpy array, intensity map where high values correspond to a high correlation
 
-    res = match_template(img, obj)
+    if engine is None:
+        engine = CorrelationEngine(img)
+    res = engine.match_template(obj)
     # Add edges of the image back
     dim_img = np.shape(img)
     dim_obj = np.shape(obj)
     dim_res = np.shape(res)
     grid = np.zeros(dim_img)
     border = (math.floor((dim_obj[0]) / 2), math.floor((dim_obj[1]) / 2))
-    for row in range(0, dim_res[0]):
-        for col in range(0, dim_res[1]):
-            grid[row + border[0]][col + border[1]] = res[row][col]
+    grid[border[0]:border[0] + dim_res[0], border[1]:border[1] + dim_res[1]] = res
     return grid
-
-
-
@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 from classes import Point
 
@@ -12,42 +13,72 @@ def average_value(array):
     # --- Outputs ---
     #   average : Float, average value of the array
 
-    total = 0
-    count = 0
-    for row in array:
-        for pixel in row:
-            if pixel != 0:
-                total += pixel
-                count += 1
-    if count != 0:
-        average = total / count
+    # Only the non-zero pixels are averaged
+    array = np.asarray(array)
+    values = array[array != 0]
+    if len(values) != 0:
+        average = values.sum() / len(values)
     else:
         average = 0
     return average
 
 
-def find_local_maxima(image, order, threshold):
+def find_peaks(image, min_distance, threshold, max_peaks=0):
     # --- Method information ---
-    # find_local_maxima is a very basic optimisation method to find local maxima. For every pixel in the image,
-    # it checks whether this pixel has the highest value of the surrounding pixels, specified by the order variable
+    # find_peaks is a vectorized non-maximum suppression. A pixel is a peak when it is equal to the maximum of the
+    # (2 * min_distance + 1) square window centered on it, which is obtained for every pixel at once by a grey dilation.
+    # Flat peaks (plateaus) produce many equal candidates next to each other, only the candidate closest to the centroid
+    # of each plateau is kept.
     #
     # --- Inputs ---
     #   image       : Numpy array
-    #   order       : Integer, number of pixels to be checked in each direction
+    #   min_distance: Integer, number of pixels to be checked in each direction
     #   threshold   : Float, minimal acceptable value for a pixel to be considered a maximum
+    #   max_peaks   : Integer, maximum number of peaks to return, the best ones are kept (0 for no limit)
     #
     # --- Outputs ---
-    #   list_of_maxima  : List of point objects
-
-    list_of_maxima = []
-    dim = np.shape(image)
-    for row in range(order, dim[0]+1-order):
-        for col in range(order, dim[1]+1-order):
-            if image[row, col] >= threshold:
-                maximum = np.amax(image[row - order:row + order + 1, col - order:col + order + 1])
-                if image[row, col] >= maximum:
-                    list_of_maxima.append(Point(row, col))
-    return list_of_maxima
+    #   rows    : Numpy array of integers, row index of the peaks, ordered from highest to lowest score
+    #   cols    : Numpy array of integers, column index of the peaks, in the same order
+    #   scores  : Numpy array, value of the image at each peak, in the same order
+
+    image = np.asarray(image, dtype=np.float64)
+    size = 2 * max(int(min_distance), 0) + 1
+    dilated = cv2.dilate(image, np.ones((size, size), np.uint8))
+    candidates = (image >= dilated) & (image >= threshold)
 
+    # Reduce every plateau of connected candidates to a single peak
+    nb_labels, labels, _, centroids = cv2.connectedComponentsWithStats(candidates.astype(np.uint8), connectivity=8)
+    rows, cols = np.nonzero(candidates)
+    if nb_labels - 1 < len(rows):
+        pixel_labels = labels[rows, cols]
+        # Centroids are given as (x, y), that is (col, row)
+        dist = (rows - centroids[pixel_labels, 1]) ** 2 + (cols - centroids[pixel_labels, 0]) ** 2
+        order = np.lexsort((dist, pixel_labels))
+        _, first = np.unique(pixel_labels[order], return_index=True)
+        keep = np.sort(order[first])
+        rows, cols = rows[keep], cols[keep]
 
+    # Sort from best to worst, ties are kept in raster order
+    scores = image[rows, cols]
+    order = np.argsort(-scores, kind='stable')
+    if max_peaks > 0:
+        order = order[:max_peaks]
+    return rows[order], cols[order], scores[order]
+
+
+def find_local_maxima(image, order, threshold):
+    # --- Method information ---
+    # find_local_maxima finds local maxima. For every pixel in the image, it checks whether this pixel has the
+    # highest value of the surrounding pixels, specified by the order variable
+    #
+    # --- Inputs ---
+    #   image       : Numpy array
+    #   order       : Integer, number of pixels to be checked in each direction
+    #   threshold   : Float, minimal acceptable value for a pixel to be considered a maximum
+    #
+    # --- Outputs ---
+    #   list_of_maxima  : List of point objects, ordered from highest to lowest value
 
+    rows, cols, _ = find_peaks(image, order, threshold)
+    list_of_maxima = [Point(int(row), int(col)) for row, col in zip(rows, cols)]
+    return list_of_maxima
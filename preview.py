@@ -0,0 +1,228 @@
+import threading
+import time
+import numpy as np
+import cv2
+
+from collections import OrderedDict
+from analyseImage import ImageCache
+from batch import load_image
+
+
+# tan(22.5 degrees) in fixed point with 15 bits, as used by cv2.Canny for the non-maximum suppression
+TG22 = 13573
+CANNY_SHIFT = 15
+
+
+def get_gradient(image_blur):
+    # --- Method information ---
+    # get_gradient computes the part of the Canny method which does not depend on the thresholds : the magnitude of
+    # the gradient (L1 norm of the 3x3 Sobel derivatives) and the non-maximum suppression, done as in cv2.Canny
+    #
+    # --- Inputs ---
+    #   image_blur  : Numpy array of type uint8, blurred 1D image
+    #
+    # --- Outputs ---
+    #   magnitude   : Numpy array of integers, magnitude of the gradient
+    #   maxima      : Numpy array of booleans, True where the magnitude is maximal along the direction of the gradient
+
+    dx = cv2.Sobel(image_blur, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE).astype(np.int32)
+    dy = cv2.Sobel(image_blur, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE).astype(np.int32)
+    magnitude = np.abs(dx) + np.abs(dy)
+    # The magnitude is 0 outside of the image
+    padded = np.pad(magnitude, 1)
+    up, down = padded[:-2, 1:-1], padded[2:, 1:-1]
+    left, right = padded[1:-1, :-2], padded[1:-1, 2:]
+
+    # Direction of the gradient, quantized to horizontal, vertical or one of the diagonals
+    abs_x = np.abs(dx)
+    abs_y = np.abs(dy) << CANNY_SHIFT
+    tg22x = abs_x * TG22
+    horizontal = abs_y < tg22x
+    vertical = ~horizontal & (abs_y > tg22x + (abs_x << (CANNY_SHIFT + 1)))
+    diagonal = ~horizontal & ~vertical
+    same_sign = (dx ^ dy) >= 0
+
+    maxima = horizontal & (magnitude > left) & (magnitude >= right)
+    maxima |= vertical & (magnitude > up) & (magnitude >= down)
+    maxima |= diagonal & same_sign & (magnitude > padded[:-2, :-2]) & (magnitude > padded[2:, 2:])
+    maxima |= diagonal & ~same_sign & (magnitude > padded[:-2, 2:]) & (magnitude > padded[2:, :-2])
+    return magnitude, maxima
+
+
+def apply_hysteresis(magnitude, maxima, thresh1, thresh2):
+    # --- Method information ---
+    # apply_hysteresis ends the Canny method for a pair of thresholds : the maxima above the high threshold are edges,
+    # as well as the maxima above the low threshold connected to them. The connected groups of maxima are labelled
+    # all at once rather than followed pixel by pixel.
+    #
+    # --- Inputs ---
+    #   magnitude   : Numpy array of integers, magnitude of the gradient, see get_gradient()
+    #   maxima      : Numpy array of booleans, see get_gradient()
+    #   thresh1     : Integer, first threshold in the Canny method
+    #   thresh2     : Integer, second threshold in the Canny method
+    #
+    # --- Outputs ---
+    #   edges   : Numpy array of type uint8, filled with 0s and 1s, where 1 is an edge
+
+    low, high = sorted((int(np.floor(thresh1)), int(np.floor(thresh2))))
+    candidates = maxima & (magnitude > low)
+    nb_labels, labels = cv2.connectedComponents(candidates.astype(np.uint8), connectivity=8)
+    strong = np.zeros(nb_labels, dtype=bool)
+    strong[labels[candidates & (magnitude > high)]] = True
+    strong[0] = False
+    return strong[labels].astype(np.uint8)
+
+
+class PreviewCache:
+    def __init__(self, image_src, max_size=4):
+        # Source of the image file previewed
+        self.image_src = image_src
+        # ImageCache object of the decoded image, keeping the images obtained for the settings tried
+        self.cache = ImageCache(load_image(image_src))
+        # Maximum number of blurred images kept, with their gradient, the least recently used ones are discarded first
+        self.max_size = max_size
+        # Ordered dictionary of the (magnitude, maxima) tuples, keyed by (image key, gauss)
+        self.gradients = OrderedDict()
+
+    def get_edges(self, image_key, gauss, thresh1, thresh2):
+        # get_edges returns the same edges map as get_edges() of analyseImage, reusing the blurred image and its
+        # gradient when only the thresholds change
+        key = (image_key, gauss)
+        if key in self.gradients:
+            self.gradients.move_to_end(key)
+        else:
+            image_blur = cv2.GaussianBlur(self.cache.get_array(image_key), (gauss, gauss), 0, 0)
+            self.gradients[key] = get_gradient(image_blur)
+            while len(self.gradients) > self.max_size:
+                self.gradients.popitem(last=False)
+        magnitude, maxima = self.gradients[key]
+        return apply_hysteresis(magnitude, maxima, thresh1, thresh2)
+
+
+def compose_preview(image, edges, edg, display_size):
+    # --- Method information ---
+    # compose_preview shows both edges maps on the 1D image, downsampled to fit a display : the edges of the full scale
+    # image in red, and those of the downsized image in green
+    #
+    # --- Inputs ---
+    #   image           : Numpy array, full scale 1D image
+    #   edges           : Numpy array, edges map of the full scale image
+    #   edg             : Numpy array, edges map of the downsized image
+    #   display_size    : Tuple of integers, (width, height) of the display
+    #
+    # --- Outputs ---
+    #   preview : Numpy array of type uint8, RGB image
+
+    scale = min(display_size[0] / image.shape[1], display_size[1] / image.shape[0], 1)
+    size = (max(1, round(scale * image.shape[1])), max(1, round(scale * image.shape[0])))
+    preview = cv2.cvtColor(cv2.resize(image, size, interpolation=cv2.INTER_AREA), cv2.COLOR_GRAY2RGB)
+    # Any edge pixel in the area of a displayed pixel marks it, so that thin edges remain visible
+    preview[cv2.resize(edges.astype(np.float32), size, interpolation=cv2.INTER_AREA) > 0] = (255, 0, 0)
+    preview[cv2.resize(edg.astype(np.float32), size, interpolation=cv2.INTER_AREA) > 0, 1] = 255
+    return preview
+
+
+def compute_preview(state, image_src, para, display_size, is_cancelled):
+    # --- Method information ---
+    # compute_preview computes the images of the preprocessing and edges detection for search settings, as in
+    # analyse(), and composes the preview. It stops as soon as is_cancelled returns True.
+    #
+    # --- Inputs ---
+    #   state           : PreviewCache object of the previous preview, or None
+    #   image_src       : Source of the image file
+    #   para            : Search object
+    #   display_size    : Tuple of integers, (width, height) of the display
+    #   is_cancelled    : Function returning True when the preview is not needed anymore
+    #
+    # --- Outputs ---
+    #   state   : PreviewCache object of image_src, to be reused by the next preview
+    #   preview : Numpy array, RGB image, or None if cancelled
+
+    if state is None or state.image_src != image_src:
+        state = PreviewCache(image_src)
+    if is_cancelled():
+        return state, None
+
+    edges_para = para.edges_para
+    image_key, image = state.cache.get_image(para.use_color_differences, para.color_weights)
+    img_key, _, _ = state.cache.get_rescaled(image_key, para.match_para.max_dim)
+    if is_cancelled():
+        return state, None
+    edges = state.get_edges(image_key, edges_para.gauss_1, edges_para.thresh1_1, edges_para.thresh2_1)
+    if is_cancelled():
+        return state, None
+    edg = state.get_edges(img_key, edges_para.gauss_2, edges_para.thresh1_2, edges_para.thresh2_2)
+    if is_cancelled():
+        return state, None
+    return state, compose_preview(image, edges, edg, display_size)
+
+
+class PreviewWorker:
+    def __init__(self, display_size, debounce=0.15):
+        # Tuple of integers, (width, height) of the display
+        self.display_size = display_size
+        # Float, time in seconds without new request before a preview is started
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        # Latest request not started yet, as (image source, search settings), and the time it was made
+        self.request = None
+        self.request_time = 0
+        # Integer, number of the latest request, a preview is abandoned as soon as a newer request is made
+        self.generation = 0
+        # Latest preview computed, as (preview, error message), until it is retrieved with get_result()
+        self.result = None
+        self.closed = False
+        # PreviewCache object, only used by the thread of the worker
+        self.state = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_src, para):
+        # submit requests a preview, replacing the request waiting if any and cancelling the preview in progress.
+        # para should not be modified afterwards.
+        with self.condition:
+            self.generation += 1
+            self.request = (image_src, para)
+            self.request_time = time.monotonic()
+            self.condition.notify()
+
+    def get_result(self):
+        # get_result returns the latest preview computed as (preview, error message) and forgets it, or None
+        with self.condition:
+            result = self.result
+            self.result = None
+        return result
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Wait for a request, then until no newer request was made for the debounce time
+                while not self.closed:
+                    if self.request is None:
+                        self.condition.wait()
+                        continue
+                    remaining = self.request_time + self.debounce - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if self.closed:
+                    return
+                image_src, para = self.request
+                self.request = None
+                generation = self.generation
+
+            def is_cancelled():
+                return self.generation != generation or self.closed
+            try:
+                self.state, preview = compute_preview(self.state, image_src, para, self.display_size, is_cancelled)
+                result = (preview, None) if preview is not None else None
+            except Exception as error:
+                result = (None, str(error))
+            with self.condition:
+                if result is not None and not is_cancelled():
+                    self.result = result
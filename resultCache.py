@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+import cv2
+
+import kernels
+
+
+# Modules whose code affects the particles found. The cache is invalidated when any of them is modified.
+CODE_FILES = ['analyseImage.py', 'analyseContour.py', 'constructContour.py', 'matchObject.py', 'optimisation.py',
+              'classes.py', 'kernels.py']
+# Increase to invalidate the cache manually
+CACHE_VERSION = 1
+# Settings which do not affect the particles found, and are thus not part of the key
+IGNORED_SETTINGS = ('workers', 'use_processes')
+
+
+def hash_file(filename):
+    # hash_file returns the SHA-256 hash of the content of a file, as a hexadecimal string
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_canonical_settings(settings):
+    # --- Method information ---
+    # get_canonical_settings converts search settings into plain values, such that equal settings give equal values
+    # whatever the order in which their attributes were set, and whether their numbers are integers or floats
+    #
+    # --- Inputs ---
+    #   settings    : Search object, or any of its attributes
+    #
+    # --- Outputs ---
+    #   canonical   : Dictionary, list, boolean, float or string
+
+    if hasattr(settings, '__dict__'):
+        return {key: get_canonical_settings(value) for key, value in sorted(vars(settings).items())
+                if key not in IGNORED_SETTINGS}
+    if isinstance(settings, (list, tuple)):
+        return [get_canonical_settings(value) for value in settings]
+    if isinstance(settings, (bool, np.bool_)) or settings is None:
+        return None if settings is None else bool(settings)
+    if isinstance(settings, (int, float, np.number)):
+        return float(settings)
+    return str(settings)
+
+
+def hash_settings(para):
+    # hash_settings returns the SHA-256 hash of search settings, see get_canonical_settings()
+    canonical = json.dumps(get_canonical_settings(para), sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get_code_version():
+    # --- Method information ---
+    # get_code_version returns a hash of the code producing the particles : the modules of CODE_FILES, CACHE_VERSION,
+    # the versions of the libraries used, and whether the kernels are compiled
+    #
+    # --- Outputs ---
+    #   version : String, hexadecimal hash
+
+    # The version of numba is only part of the hash when the compiled kernels are used, see kernels.py
+    jit_version = 'none'
+    if kernels.use_jit and kernels.njit is not None:
+        import numba
+        jit_version = numba.__version__
+    digest = hashlib.sha256(f'{CACHE_VERSION} {np.__version__} {cv2.__version__} {jit_version}'.encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for filename in CODE_FILES:
+        with open(os.path.join(directory, filename), 'rb') as code_file:
+            digest.update(code_file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory, max_size=1 << 30):
+        # Source of the folder of the cache, one file per (image, search settings) pair
+        self.directory = directory
+        # Integer, maximum total size of the files of the cache in bytes, the least recently used ones are removed
+        # first when it is exceeded
+        self.max_size = max_size
+        # String, hash of the code, part of every key so that results of a previous version are never used
+        self.code_version = get_code_version()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, image_hash, para):
+        # get_path returns the source of the file of an (image, search settings) pair
+        key = hashlib.sha256(f'{image_hash} {hash_settings(para)} {self.code_version}'.encode()).hexdigest()
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, image_hash, para):
+        # --- Method information ---
+        # get returns the particles found by a search on an image, if they are in the cache
+        #
+        # --- Inputs ---
+        #   image_hash  : String, hash of the image file, see hash_file()
+        #   para        : Search object
+        #
+        # --- Outputs ---
+        #   particles   : List of particle objects, or None if the pair is not in the cache
+
+        path = self.get_path(image_hash, para)
+        try:
+            with open(path, 'rb') as cache_file:
+                particles = pickle.load(cache_file)
+            # Mark the file as recently used
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return particles
+
+    def put(self, image_hash, para, particles):
+        # --- Method information ---
+        # put stores the particles found by a search on an image, then removes the least recently used files if the
+        # cache is too large
+        #
+        # --- Inputs ---
+        #   image_hash  : String, hash of the image file, see hash_file()
+        #   para        : Search object
+        #   particles   : List of particle objects
+
+        path = self.get_path(image_hash, para)
+        # Write to a temporary file first, such that other processes never read a partially written file
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as cache_file:
+            pickle.dump(particles, cache_file)
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # evict removes the least recently used files until the size of the cache is within max_size
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl') and entry.path != keep:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in files)
+        if keep is not None and os.path.exists(keep):
+            total_size += os.path.getsize(keep)
+
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        # clear removes all the files of the cache
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
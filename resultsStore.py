@@ -0,0 +1,215 @@
+import json
+import os
+import pickle
+import numpy as np
+
+from analyseContour import Particle
+from classes import Point
+
+
+# Columns of the store, with one value per particle : name and type of the values. Unknown identifiers are -1.
+COLUMNS = [('image_id', '<i4'), ('search_id', '<i4'), ('center_x', '<f8'), ('center_y', '<f8'), ('area', '<f8'),
+           ('perimeter', '<f8'), ('radius', '<f8'), ('circularity', '<f8'), ('radial_average', '<f8'),
+           ('radial_sd', '<f8'), ('radial_sd_consecutive', '<f8'), ('contour_start', '<i8'), ('contour_length', '<i4'),
+           ('track_id', '<i4')]
+# The points of all the contours are stored one after the other, as (x, y) pairs
+CONTOURS_DTYPE = '<f8'
+VERSION = 2
+
+
+class ResultsStore:
+    def __init__(self, directory, mode='r'):
+        # --- Method information ---
+        # A ResultsStore keeps the particles found in a folder, as one binary file per column (see COLUMNS) plus one
+        # file for the points of all the contours, and a metadata.json file. The particles are appended image by image,
+        # and the metadata file is only updated once the data of an image is written, such that an interrupted run
+        # leaves the images already written readable. The columns and contours are read through memory maps.
+        #
+        # --- Inputs ---
+        #   directory   : Source of the folder of the store
+        #   mode        : String, 'r' to read an existing store, 'a' to append to a store (created if missing), or
+        #                 'w' to create a new store (erasing the content of an existing one)
+
+        # Source of the folder of the store
+        self.directory = directory
+        # String, mode in which the store is opened
+        self.mode = mode
+        # Dictionary of the metadata : number of particles and of contour points, and the location of each image
+        self.metadata = {'version': VERSION, 'count': 0, 'points': 0, 'images': []}
+
+        if mode == 'w' or (mode == 'a' and not os.path.exists(self.get_path('metadata.json'))):
+            os.makedirs(directory, exist_ok=True)
+            for name, _ in COLUMNS:
+                open(self.get_path(f'{name}.bin'), 'wb').close()
+            open(self.get_path('contours.bin'), 'wb').close()
+            self.save_metadata()
+        else:
+            with open(self.get_path('metadata.json'), 'r') as metadata_file:
+                self.metadata = json.load(metadata_file)
+            # Columns added by later versions of the program are unknown (-1) for the particles already stored
+            for name, dtype in COLUMNS:
+                if mode == 'a' and not os.path.exists(self.get_path(f'{name}.bin')):
+                    np.full(self.metadata['count'], -1, dtype=dtype).tofile(self.get_path(f'{name}.bin'))
+            if mode == 'a':
+                # Remove the data of an image whose writing was interrupted
+                for name, dtype in COLUMNS:
+                    self.truncate(f'{name}.bin', self.metadata['count'] * np.dtype(dtype).itemsize)
+                self.truncate('contours.bin', self.metadata['points'] * 2 * np.dtype(CONTOURS_DTYPE).itemsize)
+
+    def __len__(self):
+        return self.metadata['count']
+
+    def get_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def truncate(self, filename, size):
+        with open(self.get_path(filename), 'r+b') as data_file:
+            data_file.truncate(size)
+
+    def save_metadata(self):
+        # save_metadata replaces the metadata file at once, such that it is never left partially written
+        temporary_src = self.get_path('metadata.json.tmp')
+        with open(temporary_src, 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file, indent=1)
+        os.replace(temporary_src, self.get_path('metadata.json'))
+
+    def append_image(self, image_id, particles, source=None):
+        # --- Method information ---
+        # append_image writes the particles found in an image at the end of the store
+        #
+        # --- Inputs ---
+        #   image_id    : Integer, identifier of the image, such as its index in the list of images searched
+        #   particles   : List of particle objects found in the image
+        #   source      : Source of the image file, kept in the metadata (optional)
+
+        if self.mode == 'r':
+            raise ValueError('The results store is opened in read mode.')
+        if any(image['id'] == image_id for image in self.metadata['images']):
+            raise ValueError(f'The particles of image {image_id} are already in the results store.')
+
+        count = len(particles)
+        lengths = np.array([len(particle.contour) for particle in particles], dtype=np.int64)
+        starts = self.metadata['points'] + np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        columns = {'image_id': np.full(count, image_id),
+                   'search_id': [-1 if particle.search_id is None else particle.search_id for particle in particles],
+                   'center_x': [particle.center.x for particle in particles],
+                   'center_y': [particle.center.y for particle in particles],
+                   'area': [particle.area for particle in particles],
+                   'perimeter': [particle.perimeter for particle in particles],
+                   'radius': [particle.radius for particle in particles],
+                   'circularity': [particle.circularity for particle in particles],
+                   'radial_average': [particle.radial_average for particle in particles],
+                   'radial_sd': [particle.radial_sd for particle in particles],
+                   'radial_sd_consecutive': [particle.radial_sd_consecutive for particle in particles],
+                   'contour_start': starts[:count],
+                   'contour_length': lengths,
+                   'track_id': [-1 if particle.track_id is None else particle.track_id for particle in particles]}
+        for name, dtype in COLUMNS:
+            with open(self.get_path(f'{name}.bin'), 'ab') as column_file:
+                np.asarray(columns[name], dtype=dtype).reshape(count).tofile(column_file)
+        with open(self.get_path('contours.bin'), 'ab') as contours_file:
+            for particle in particles:
+                np.asarray(particle.contour, dtype=CONTOURS_DTYPE).tofile(contours_file)
+
+        self.metadata['images'].append({'id': image_id, 'source': source, 'start': self.metadata['count'],
+                                        'stop': self.metadata['count'] + count})
+        self.metadata['count'] += count
+        self.metadata['points'] += int(np.sum(lengths))
+        self.save_metadata()
+
+    def get_column(self, name):
+        # --- Method information ---
+        # get_column returns the values of a column for all the particles, without reading the other columns
+        #
+        # --- Inputs ---
+        #   name    : String, name of the column, see COLUMNS
+        #
+        # --- Outputs ---
+        #   values  : Read-only numpy array (memory-mapped), one value per particle
+
+        dtype = dict(COLUMNS)[name]
+        if self.metadata['count'] == 0:
+            return np.empty(0, dtype=dtype)
+        if not os.path.exists(self.get_path(f'{name}.bin')):
+            # Store written by an older version of the program, without this column
+            return np.full(self.metadata['count'], -1, dtype=dtype)
+        return np.memmap(self.get_path(f'{name}.bin'), dtype=dtype, mode='r', shape=(self.metadata['count'],))
+
+    def get_contours(self):
+        # get_contours returns the points of all the contours, as a read-only Mx2 numpy array (memory-mapped)
+        if self.metadata['points'] == 0:
+            return np.empty((0, 2), dtype=CONTOURS_DTYPE)
+        return np.memmap(self.get_path('contours.bin'), dtype=CONTOURS_DTYPE, mode='r',
+                         shape=(self.metadata['points'], 2))
+
+    def get_image_ids(self):
+        # get_image_ids returns the identifiers of the images in the store, in the order in which they were written
+        return [image['id'] for image in self.metadata['images']]
+
+    def get_rows(self, image_id):
+        # get_rows returns the range of the rows of the particles of an image in the columns
+        for image in self.metadata['images']:
+            if image['id'] == image_id:
+                return range(image['start'], image['stop'])
+        raise KeyError(f'Image {image_id} is not in the results store.')
+
+    def get_particles(self, image_id=None):
+        # --- Method information ---
+        # get_particles rebuilds the particle objects of an image, or of all the images. Only the rows of the image are
+        # read from the columns and the contours. The measures stored are kept as they are.
+        #
+        # --- Inputs ---
+        #   image_id    : Integer, identifier of the image, None for all the particles
+        #
+        # --- Outputs ---
+        #   particles   : List of particle objects
+
+        rows = range(0, len(self)) if image_id is None else self.get_rows(image_id)
+        if len(rows) == 0:
+            return []
+        columns = {name: np.array(self.get_column(name)[rows.start:rows.stop]) for name, _ in COLUMNS}
+        contours = self.get_contours()
+
+        particles = []
+        for k in range(0, len(rows)):
+            start = int(columns['contour_start'][k])
+            contour = np.array(contours[start:start + int(columns['contour_length'][k])])
+            search_id = int(columns['search_id'][k])
+            track_id = int(columns['track_id'][k])
+            state = {'contour': contour, 'center': Point(float(columns['center_x'][k]), float(columns['center_y'][k])),
+                     'search_id': None if search_id < 0 else search_id, 'track_id': None if track_id < 0 else track_id}
+            for name in ('area', 'perimeter', 'radius', 'circularity', 'radial_average', 'radial_sd',
+                         'radial_sd_consecutive'):
+                state[name] = float(columns[name][k])
+            particle = Particle.__new__(Particle)
+            particle.__setstate__(state)
+            particles.append(particle)
+        return particles
+
+
+def import_pickle(data_src, directory, image_id=0, overwrite=False):
+    # --- Method information ---
+    # import_pickle converts a file of particles saved with pickle by an older version of the program into a results
+    # store. The file holds either a list of the lists of particles of each image, or a single list of all
+    # the particles (as saved by main.search()), in which case they are all assigned to image_id.
+    #
+    # --- Inputs ---
+    #   data_src    : Source of the pickle file
+    #   directory   : Source of the folder of the results store, to which the particles are appended (created if
+    #                 missing)
+    #   image_id    : Integer, identifier of the image of the particles of a single list
+    #   overwrite   : Boolean variable, whether to erase the content of an existing store rather than appending to it
+    #
+    # --- Outputs ---
+    #   store   : ResultsStore object, opened in append mode (or in 'w' mode if overwrite is True)
+
+    with open(data_src, 'rb') as data_file:
+        data = pickle.load(data_file)
+
+    store = ResultsStore(directory, 'w' if overwrite else 'a')
+    if len(data) > 0 and isinstance(data[0], list):
+        for k in range(0, len(data)):
+            store.append_image(k, data[k])
+    else:
+        store.append_image(image_id, data)
+    return store
@@ -10,6 +10,11 @@ class EdgesParameters:
         self.thresh1_2 = 0      # Non-negative integer, threshold1 in Canny method for downsized image
         self.thresh2_2 = 250    # Non-negative integer, threshold2 in Canny method for downsized image
 
+    def __setstate__(self, state):
+        # Settings saved with an older version of the program are completed with the default values
+        self.__init__()
+        self.__dict__.update(state)
+
 
 class MatchParameters:
     def __init__(self):
@@ -18,6 +23,19 @@ class MatchParameters:
         self.tolerance = 0.8    # Float [0, 1], tolerance applied on the threshold for finding maxima in find_matches()
         self.factor = 1.2       # Float, factor by which to scale the size of the picture in obtain_picture()
         self.max_dim = 1080     # Integer, specifies the size for which an image should be resized in preprocess()
+        self.peak_distance = 0.3    # Float, suppression distance between maxima in find_matches(), times the radius
+        self.max_peaks = 0          # Integer, maximum number of maxima kept in find_matches(), 0 for no limit
+        self.use_pyramid = False    # Boolean variable, whether find_matches() searches coarse-to-fine in a pyramid
+        self.pyramid_size = 32      # Integer, minimal size (pixels) of the template at the coarsest pyramid level
+        self.pyramid_tolerance = 0.8    # Float [0, 1], tolerance applied on the threshold at the coarsest level
+        self.backend = 'correlation'    # String, 'correlation' or 'hough', detection of the preliminary search
+        self.hough_radius_tol = 0.2     # Float, relative tolerance on the radius of the circles with 'hough'
+        self.hough_threshold = 0.3      # Float, minimal fraction of the circumference found in the edges with 'hough'
+
+    def __setstate__(self, state):
+        # Settings saved with an older version of the program are completed with the default values
+        self.__init__()
+        self.__dict__.update(state)
 
 
 class ContourParameters:
@@ -29,6 +47,13 @@ class ContourParameters:
         self.sharpness = 0.7    # Float [0, 1], sharpness of the circle generated used in detect_circle_edge_points()
         self.radial_tol = 0.5   # Float [0, 1], tolerance on accepting a point in find_radial_edge()
         self.nb_tol = 0.8       # Float [0, 1], tolerance on the number of points in the contour vs nb_points
+        self.workers = 1        # Integer, number of workers building the candidate contours in analyse()
+        self.use_processes = False  # Boolean variable, whether these workers are processes rather than threads
+
+    def __setstate__(self, state):
+        # Settings saved with an older version of the program are completed with the default values
+        self.__init__()
+        self.__dict__.update(state)
 
 
 class Search:
@@ -41,6 +66,11 @@ class Search:
         self.contour_para = ContourParameters()
         self.edges_para = EdgesParameters()
 
+    def __setstate__(self, state):
+        # Settings saved with an older version of the program are completed with the default values
+        self.__init__(state['searched_radius'], state['iterations'], state['use_color_differences'])
+        self.__dict__.update(state)
+
 
 def init():
     # Functional global variable, sadly necessary for the gui (or at least I do not know how to do it differently)
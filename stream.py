@@ -0,0 +1,103 @@
+import threading
+
+
+class ParticleEvent:
+    def __init__(self, kind, particle, iteration=None, search=None):
+        # String, 'accepted' for a new particle, 'replaced' for a new particle that took the place of overlapping
+        # particles, 'evicted' for a particle removed from the results (the replacing particle follows it), or
+        # 'adjusted' for a particle of the results whose contour was refined
+        self.kind = kind
+        # Particle object concerned by the event
+        self.particle = particle
+        # Integer, iteration of the search during which the event occurred, 0 being the preliminary search
+        self.iteration = iteration
+        # Integer, index of the search settings used, when several searches are run on an image
+        self.search = search
+
+
+def get_events(particle, evicted, iteration=None, search=None, adjusted=False):
+    # --- Method information ---
+    # get_events returns the events corresponding to the addition of a particle by append_particle()
+    #
+    # --- Inputs ---
+    #   particle    : Particle object added
+    #   evicted     : List of the particle objects removed to add it
+    #   iteration   : Integer, iteration of the search
+    #   search      : Integer, index of the search settings used
+    #   adjusted    : Boolean variable, whether the particle was already in the results, added again after its contour
+    #                 was refined
+    #
+    # --- Outputs ---
+    #   events  : List of ParticleEvent objects, evictions first
+
+    events = [ParticleEvent('evicted', old_particle, iteration, search) for old_particle in evicted]
+    if adjusted:
+        kind = 'adjusted'
+    else:
+        kind = 'replaced' if len(evicted) > 0 else 'accepted'
+    events.append(ParticleEvent(kind, particle, iteration, search))
+    return events
+
+
+class StreamError:
+    def __init__(self, error):
+        # Exception raised by the generator running in the producer thread, to be raised again for the consumer
+        self.error = error
+
+
+async def stream_async(generator_function, *args, max_buffer=16):
+    # --- Method information ---
+    # stream_async turns a generator of events, such as analyse_stream() or search_image_stream(), into an asynchronous
+    # iterator. The generator runs in a separate thread and its events are passed through a bounded queue: the
+    # generator is paused while max_buffer events wait to be consumed. If the consumer stops early, the generator is
+    # stopped after its current event.
+    #
+    # --- Inputs ---
+    #   generator_function  : Function returning a generator of events
+    #   args                : Arguments of generator_function
+    #   max_buffer          : Integer, maximum number of events waiting to be consumed
+    #
+    # --- Outputs ---
+    #   Yields the events of the generator, in order
+
+    # asyncio is only imported when it is used, it takes a noticeable part of the startup time
+    import asyncio
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max_buffer)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Blocks the producer thread until there is room in the queue
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        generator = generator_function(*args)
+        try:
+            for event in generator:
+                if stop.is_set():
+                    break
+                put(event)
+        except Exception as error:
+            put(StreamError(error))
+            return
+        finally:
+            generator.close()
+        put(done)
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, StreamError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        # Empty the queue until the producer is finished, so that it is never left waiting for room
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait({producer}, timeout=0.05)
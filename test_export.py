@@ -0,0 +1,59 @@
+import io
+import json
+import os
+import cv2
+import numpy as np
+import settings
+
+from batch import search_images
+from benchmark import generate_image
+from export import JsonLinesWriter, OverlayWriter
+from tracking import track_sequence
+
+
+def save_npy_source(tmp_path):
+    # save_npy_source saves a synthetic image as a .npy file and returns its source
+    settings.init()
+    image_rgb, _ = generate_image((480, 640), [40], 6)
+    image_src = str(tmp_path / 'image.npy')
+    np.save(image_src, image_rgb)
+    return image_src
+
+
+def test_overlay_of_npy_source(tmp_path):
+    # The overlay of an image read from a .npy file is saved, as for any other image file
+    image_src = save_npy_source(tmp_path)
+    particles_list = search_images([image_src], [settings.Search(r=40, n=1, use_color_differences=False)],
+                                   tile_size=400)
+    writer = OverlayWriter(str(tmp_path))
+    writer.save_file(0, image_src, particles_list[0])
+    writer.close()
+    assert os.path.exists(tmp_path / 'image_0.jpg')
+
+
+def test_no_overlay_with_tiles(tmp_path):
+    # The images searched by tiles are not drawn, which would hold them in memory as a whole
+    image_src = save_npy_source(tmp_path)
+    writer = OverlayWriter(str(tmp_path))
+    particles_list = search_images([image_src], [settings.Search(r=40, n=1, use_color_differences=False)],
+                                   tile_size=400, writer=writer)
+    writer.close()
+    assert len(particles_list[0]) > 0
+    assert not os.path.exists(tmp_path / 'image_0.jpg')
+
+
+def test_json_lines_of_sequence(tmp_path):
+    # The JSON lines of the frames of a sequence give the source of every frame
+    settings.init()
+    image_rgb, _ = generate_image((480, 640), [40], 6)
+    frames_src = [str(tmp_path / f'frame_{k}.png') for k in range(0, 2)]
+    for frame_src in frames_src:
+        cv2.imwrite(frame_src, cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR))
+
+    stream = io.StringIO()
+    writer = JsonLinesWriter(stream)
+    track_sequence(frames_src, [settings.Search(r=40, n=1, use_color_differences=False)], writer=writer,
+                   verbose=False)
+    writer.close()
+    headers = [record for record in map(json.loads, stream.getvalue().splitlines()) if 'source' in record]
+    assert [record['source'] for record in headers] == frames_src
@@ -0,0 +1,32 @@
+import settings
+
+from analyseImage import analyse_stream
+from benchmark import generate_image
+
+
+def test_no_self_eviction():
+    # No event evicts the particle which replaces the evicted ones, and replaying the events gives the particles found
+    settings.init()
+    image_rgb, _ = generate_image((480, 640), [40], 6)
+    particles = []
+    events = list(analyse_stream(image_rgb, particles, settings.Search(r=40, n=1, use_color_differences=False),
+                                 verbose=False))
+    assert len(particles) > 0
+
+    results = {}
+    evicted = []
+    for event in events:
+        if event.kind == 'evicted':
+            evicted.append(event.particle)
+            continue
+        assert all(particle is not event.particle for particle in evicted)
+        for particle in evicted:
+            del results[id(particle)]
+        evicted = []
+        if event.kind == 'adjusted':
+            assert id(event.particle) in results
+        else:
+            assert id(event.particle) not in results
+        results[id(event.particle)] = event.particle
+    assert len(evicted) == 0
+    assert set(results) == set(id(particle) for particle in particles)
@@ -0,0 +1,33 @@
+import settings
+
+from benchmark import generate_image
+from tracking import Tracker
+
+
+def track_corner_change(corner):
+    # track_corner_change tracks a frame, then the same frame with a small white patch at one of its corners, and
+    # returns the particles of both frames, along with the location of the patch
+    settings.init()
+    image_rgb, _ = generate_image((600, 800), [40], 12, seed=0)
+    tracker = Tracker([settings.Search(r=40, n=1, use_color_differences=False)])
+    first = tracker.process(image_rgb)
+    frame = image_rgb.copy()
+    rows = slice(0, 16) if corner[0] == 0 else slice(-16, None)
+    cols = slice(0, 16) if corner[1] == 0 else slice(-16, None)
+    frame[rows, cols] = 255
+    second = tracker.process(frame)
+    location = (0 if corner[0] == 0 else frame.shape[0], 0 if corner[1] == 0 else frame.shape[1])
+    return first, second, location
+
+
+def test_change_at_corner():
+    # A change smaller than the templates at a corner of the frame is searched without error. The particles away from
+    # the change keep their tracks, and no new track is started.
+    for corner in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        first, second, location = track_corner_change(corner)
+        assert len(first) > 0
+        tracks = set(particle.track_id for particle in second)
+        assert tracks <= set(particle.track_id for particle in first)
+        for particle in first:
+            if abs(particle.center.x - location[0]) + abs(particle.center.y - location[1]) > 4 * particle.radius:
+                assert particle.track_id in tracks
@@ -0,0 +1,190 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+
+# Tags (image, search, iteration, ...) of the work in progress, inherited by the spans recorded
+current_tags = contextvars.ContextVar('current_tags', default={})
+
+
+class NullSpan:
+    # Span used while the tracer is disabled, which does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Span:
+    def __init__(self, tracer, name, tags):
+        # Tracer object to which the span is reported
+        self.tracer = tracer
+        # String, name of the stage
+        self.name = name
+        # Dictionary of the tags of the span
+        self.tags = tags
+        # Wall and CPU times at the start of the span, in nanoseconds
+        self.start_wall = 0
+        self.start_cpu = 0
+
+    def __enter__(self):
+        self.start_cpu = time.thread_time_ns()
+        self.start_wall = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter_ns() - self.start_wall
+        cpu = time.thread_time_ns() - self.start_cpu
+        self.tracer.record(self.name, self.start_wall, wall, cpu, self.tags)
+        return False
+
+
+class TagScope:
+    def __init__(self, tags):
+        # Dictionary of the tags to add to the current ones
+        self.tags = tags
+        self.token = None
+
+    def __enter__(self):
+        tags = dict(current_tags.get())
+        tags.update(self.tags)
+        self.token = current_tags.set(tags)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_tags.reset(self.token)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        # Boolean variable, spans are only recorded when the tracer is enabled
+        self.enabled = False
+        # List of the recorded spans, as trace events
+        self.events = []
+        self.lock = threading.Lock()
+        self.null_span = NullSpan()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+
+    def take_events(self):
+        # take_events returns the spans recorded so far and forgets them, such that a worker process can send them
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def add_events(self, events):
+        # add_events adds spans recorded by another process, obtained with take_events()
+        with self.lock:
+            self.events.extend(events)
+
+    def span(self, name, **tags):
+        # --- Method information ---
+        # span returns a context manager measuring the wall time and the CPU time of the code it contains, recorded
+        # under a stage name along with the current tags. Spans can be nested.
+        #
+        # --- Inputs ---
+        #   name    : String, name of the stage
+        #   tags    : Tags specific to this span
+        #
+        # --- Outputs ---
+        #   span    : Context manager
+
+        if not self.enabled:
+            return self.null_span
+        span_tags = current_tags.get()
+        if len(tags) > 0:
+            span_tags = dict(span_tags)
+            span_tags.update(tags)
+        return Span(self, name, span_tags)
+
+    def tags(self, **tags):
+        # tags returns a context manager adding tags to all the spans recorded in the code it contains
+        return TagScope(tags)
+
+    def record(self, name, start, wall, cpu, tags):
+        # record stores a span as a complete trace event, times being converted to microseconds
+        args = dict(tags)
+        args['cpu_ms'] = cpu / 1e6
+        event = {'name': name, 'ph': 'X', 'ts': start / 1e3, 'dur': wall / 1e3, 'tdur': cpu / 1e3,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, filename):
+        # --- Method information ---
+        # save writes the recorded spans in the trace event format, as a JSON file which can be opened by a trace
+        # viewer (such as chrome://tracing or Perfetto)
+        #
+        # --- Inputs ---
+        #   filename: Source of the file in which the trace is to be saved
+
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(filename, 'w') as trace_file:
+            json.dump(trace, trace_file, default=str)
+
+    def get_summary(self):
+        # --- Method information ---
+        # get_summary aggregates the recorded spans by stage
+        #
+        # --- Outputs ---
+        #   summary : List of (name, count, total wall time, total CPU time, maximal wall time) tuples, times being in
+        #             milliseconds, sorted by decreasing total wall time
+
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                count, wall, cpu, max_wall = totals.get(event['name'], (0, 0, 0, 0))
+                totals[event['name']] = (count + 1, wall + event['dur'] / 1e3, cpu + event['tdur'] / 1e3,
+                                         max(max_wall, event['dur'] / 1e3))
+        summary = [(name,) + values for name, values in totals.items()]
+        summary.sort(key=lambda row: row[2], reverse=True)
+        return summary
+
+    def print_summary(self):
+        # print_summary prints a table of the time spent in each stage. Nested spans are counted in every stage.
+        print(f"{'stage':<20}{'count':>8}{'wall (ms)':>14}{'cpu (ms)':>14}{'mean (ms)':>12}{'max (ms)':>12}")
+        for name, count, wall, cpu, max_wall in self.get_summary():
+            print(f'{name:<20}{count:>8}{wall:>14.1f}{cpu:>14.1f}{wall / count:>12.2f}{max_wall:>12.2f}')
+
+
+def run_with_tags(tags, function, *args):
+    # run_with_tags calls a function with the specified tags, see bind_tags()
+    token = current_tags.set(tags)
+    try:
+        return function(*args)
+    finally:
+        current_tags.reset(token)
+
+
+def bind_tags(function):
+    # --- Method information ---
+    # bind_tags returns a function calling the specified function with the current tags, such that the spans
+    # recorded in a worker thread are tagged as the work that submitted them. The returned function can be pickled.
+    #
+    # --- Inputs ---
+    #   function    : Function defined at the top level of a module
+    #
+    # --- Outputs ---
+    #   bound_function  : Function taking the same arguments
+
+    return functools.partial(run_with_tags, current_tags.get(), function)
+
+
+# Tracer shared by all the modules. Spans recorded by worker processes are sent back with their results, see
+# search_images() of batch.
+tracer = Tracer()
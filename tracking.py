@@ -0,0 +1,261 @@
+import math
+import numpy as np
+import cv2
+
+from analyseContour import ParticleIndex
+from analyseTiles import get_halo, search_tile
+from batch import load_image, save_results
+from tracing import tracer
+
+
+def read_frames(frames_src):
+    # --- Method information ---
+    # read_frames is a generator of the frames of a sequence, given either as a list of image files (such as the
+    # pictures of a time-lapse) or as a video file
+    #
+    # --- Inputs ---
+    #   frames_src  : List of the sources of the image files, or source of the video file
+    #
+    # --- Outputs ---
+    #   Yields (source, image_rgb) tuples, the source of the frame and the RGB image
+
+    if not isinstance(frames_src, str):
+        for image_src in frames_src:
+            yield image_src, load_image(image_src)
+        return
+
+    capture = cv2.VideoCapture(frames_src)
+    if not capture.isOpened():
+        raise FileNotFoundError(f'Could not read video "{frames_src}"')
+    try:
+        k = 0
+        while True:
+            with tracer.span('decode'):
+                is_read, image_bgr = capture.read()
+            if not is_read:
+                break
+            yield f'{frames_src}#{k}', cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+            k += 1
+    finally:
+        capture.release()
+
+
+class Tracker:
+    def __init__(self, search_settings_list, diff_scale=0.25, diff_threshold=20, max_distance=0.5,
+                 full_search_fraction=0.5, verbose=False):
+        # --- Method information ---
+        # A Tracker finds the particles of the successive frames of a sequence, each frame being seeded by the particles
+        # of the previous one. The frames are compared at a low resolution : the particles whose area did not change
+        # are kept as they are, the windows around the particles whose area changed are searched again, as well as the
+        # other regions which changed, where particles may have appeared. Every particle gets the identifier of the
+        # track it belongs to, kept from frame to frame.
+        #
+        # --- Inputs ---
+        #   search_settings_list: List of Search objects
+        #   diff_scale          : Float, scale at which the frames are compared
+        #   diff_threshold      : Integer, difference of gray level above which a pixel is considered changed
+        #   max_distance        : Float, maximal displacement of a particle between two frames, times its radius
+        #   full_search_fraction: Float [0, 1], fraction of the frame above which the whole frame is searched again
+        #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+
+        # List of Search objects
+        self.search_settings_list = search_settings_list
+        self.diff_scale = diff_scale
+        self.diff_threshold = diff_threshold
+        self.max_distance = max_distance
+        self.full_search_fraction = full_search_fraction
+        self.verbose = verbose
+        # Width of the margin around the regions searched, see get_halo()
+        self.halo = get_halo(search_settings_list)
+        # Minimal size of the regions searched, that of the largest template used by find_matches()
+        self.min_size = max([math.ceil(2 * para.match_para.factor * para.searched_radius)
+                             for para in search_settings_list], default=1)
+        # Side of the cells of the spatial index of the particles, sized for the largest particles
+        self.cell_size = max([2 * para.contour_para.dist_tol * para.searched_radius for para in search_settings_list],
+                             default=1)
+        # Grayscale image at low resolution to which the next frame is compared. Every region holds the frame in which
+        # it was last searched, such that slow changes add up until the region is searched again.
+        self.reference = None
+        # List of the particle objects of the previous frame
+        self.particles = []
+        # Integer, identifier of the next track
+        self.next_track_id = 0
+
+    def get_small_image(self, image_rgb):
+        # get_small_image returns the grayscale image at low resolution used to compare the frames
+        gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
+        size = (max(1, round(self.diff_scale * gray.shape[1])), max(1, round(self.diff_scale * gray.shape[0])))
+        # The blur removes most of the noise of the camera
+        return cv2.GaussianBlur(cv2.resize(gray, size, interpolation=cv2.INTER_AREA), (3, 3), 0)
+
+    def get_regions(self, small):
+        # --- Method information ---
+        # get_regions compares a frame to the reference, and sorts the particles of the previous frame into those which
+        # are kept as they are and those to be searched again
+        #
+        # --- Inputs ---
+        #   small   : Numpy array, grayscale image of the frame at low resolution, see get_small_image()
+        #
+        # --- Outputs ---
+        #   kept    : List of the particle objects of the previous frame whose area did not change
+        #   regions : Numpy array of type uint8, at low resolution, where non-zero pixels are to be searched again
+
+        changed = (cv2.absdiff(small, self.reference) > self.diff_threshold).astype(np.uint8)
+        # Isolated pixels are noise rather than particles
+        changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+        regions = changed.copy()
+
+        kept = []
+        for particle in self.particles:
+            x = particle.center.x * self.diff_scale
+            y = particle.center.y * self.diff_scale
+            # Area of the particle, as used to build its contour
+            half_size = particle.radius * self.search_settings_list[0].match_para.factor * self.diff_scale
+            area = changed[max(0, math.floor(x - half_size)):math.ceil(x + half_size) + 1,
+                           max(0, math.floor(y - half_size)):math.ceil(y + half_size) + 1]
+            if not area.any():
+                kept.append(particle)
+                continue
+            # The particle is looked for wherever it may have moved
+            half_size = max(1.0, self.max_distance * particle.radius * self.diff_scale)
+            regions[max(0, math.floor(x - half_size)):math.ceil(x + half_size) + 1,
+                    max(0, math.floor(y - half_size)):math.ceil(y + half_size) + 1] = 1
+        return kept, regions
+
+    def process(self, image_rgb):
+        # --- Method information ---
+        # process finds the particles of the next frame of the sequence. The first frame is searched as a whole.
+        #
+        # --- Inputs ---
+        #   image_rgb   : Numpy array, RGB image of the frame
+        #
+        # --- Outputs ---
+        #   particles   : List of the particle objects of the frame, with their track identifier
+
+        image_shape = np.shape(image_rgb)
+        small = self.get_small_image(image_rgb)
+        full_box = (0, image_shape[0], 0, image_shape[1])
+
+        if self.reference is None or self.reference.shape != small.shape:
+            kept, cores = [], [full_box]
+            self.reference = small
+        else:
+            with tracer.span('frame_difference'):
+                kept, regions = self.get_regions(small)
+            if np.count_nonzero(regions) > self.full_search_fraction * regions.size:
+                kept, cores = [], [full_box]
+                self.reference = small
+            else:
+                nb_regions, _, stats, _ = cv2.connectedComponentsWithStats(regions, connectivity=8)
+                cores = []
+                for left, top, width, height, _ in stats[1:nb_regions]:
+                    # Regions at full resolution, the stats being given as (column, row)
+                    cores.append((math.floor(top / self.diff_scale),
+                                  min(image_shape[0], math.ceil((top + height) / self.diff_scale)),
+                                  math.floor(left / self.diff_scale),
+                                  min(image_shape[1], math.ceil((left + width) / self.diff_scale))))
+                    self.reference[top:top + height, left:left + width] = small[top:top + height, left:left + width]
+
+        if self.verbose:
+            print(f'{len(kept)} particles kept, {len(cores)} regions to search')
+
+        # Search the regions which changed, the particles kept being merged with the new ones
+        particles = ParticleIndex(self.cell_size, kept)
+        for k in range(0, len(cores)):
+            core = self.grow_core(cores[k], image_shape)
+            box = (max(0, core[0] - self.halo), min(image_shape[0], core[1] + self.halo),
+                   max(0, core[2] - self.halo), min(image_shape[1], core[3] + self.halo))
+            with tracer.tags(region=k):
+                particles = search_tile(image_rgb, box, core, image_shape, self.search_settings_list, particles,
+                                        self.verbose)
+
+        particles = particles.to_list()
+        self.assign_tracks(particles)
+        self.particles = particles
+        return particles
+
+    def grow_core(self, core, image_shape):
+        # --- Method information ---
+        # grow_core enlarges a region to be searched to at least the size of the templates, clipped to the image. A
+        # small region is enlarged around its center, and shifted inward at the borders of the image, such that the
+        # region read for the search is never smaller than a template.
+        #
+        # --- Inputs ---
+        #   core        : Tuple of integers, (min_x, max_x, min_y, max_y) of the region
+        #   image_shape : Tuple, shape of the image
+        #
+        # --- Outputs ---
+        #   core    : Tuple of integers, (min_x, max_x, min_y, max_y) of the enlarged region
+
+        bounds = []
+        for axis in range(0, 2):
+            low, high = core[2 * axis], core[2 * axis + 1]
+            if high - low < self.min_size:
+                low = max(0, min((low + high - self.min_size) // 2, image_shape[axis] - self.min_size))
+                high = min(image_shape[axis], low + self.min_size)
+            bounds.extend((low, high))
+        return tuple(bounds)
+
+    def assign_tracks(self, particles):
+        # --- Method information ---
+        # assign_tracks gives a track identifier to the new particles of a frame. A new particle continues the track of
+        # the closest particle of the previous frame within max_distance times its radius, if that track was not
+        # continued by another particle, closest pairs first. Otherwise, a new track starts.
+        #
+        # --- Inputs ---
+        #   particles   : List of the particle objects of the frame, those kept from the previous frame having their
+        #                 track identifier already
+
+        new_particles = [particle for particle in particles if particle.track_id is None]
+        continued = set(particle.track_id for particle in particles if particle.track_id is not None)
+        previous = [particle for particle in self.particles if particle.track_id not in continued]
+
+        pairs = []
+        for i in range(0, len(new_particles)):
+            for j in range(0, len(previous)):
+                distance = math.sqrt((new_particles[i].center.x - previous[j].center.x) ** 2 +
+                                     (new_particles[i].center.y - previous[j].center.y) ** 2)
+                if distance <= self.max_distance * previous[j].radius:
+                    pairs.append((distance, i, j))
+        pairs.sort()
+        for _, i, j in pairs:
+            if new_particles[i].track_id is None and previous[j].track_id not in continued:
+                new_particles[i].track_id = previous[j].track_id
+                continued.add(previous[j].track_id)
+
+        for particle in new_particles:
+            if particle.track_id is None:
+                particle.track_id = self.next_track_id
+                self.next_track_id += 1
+
+
+def track_sequence(frames_src, search_settings_list, store=None, writer=None, verbose=True, **options):
+    # --- Method information ---
+    # track_sequence finds the particles of every frame of a sequence with a Tracker, see Tracker
+    #
+    # --- Inputs ---
+    #   frames_src          : List of the sources of the image files, or source of the video file
+    #   search_settings_list: List of Search objects
+    #   store               : ResultsStore object to which the particles of each frame are appended, the index of the
+    #                         frame being its identifier (optional)
+    #   writer              : OverlayWriter object saving the contours of the particles on each frame (optional)
+    #   verbose             : Boolean variable to specify whether to inform the user in the terminal
+    #   options             : Other arguments of the Tracker
+    #
+    # --- Outputs ---
+    #   particles_list  : List of the list of particles, sorted by frame
+
+    tracker = Tracker(search_settings_list, verbose=verbose, **options)
+    particles_list = []
+    for i, (frame_src, image_rgb) in enumerate(read_frames(frames_src)):
+        if verbose:
+            print(f'Tracking particles in frame {i} ("{frame_src}")')
+        with tracer.tags(image=i):
+            particles = tracker.process(image_rgb)
+        particles_list.append(particles)
+        if verbose:
+            print(f'{len(particles)} particles, {tracker.next_track_id} tracks so far.')
+        save_results(i, frame_src, particles, store, None)
+        if writer is not None:
+            writer.save_image(i, image_rgb, particles, frame_src)
+    return particles_list